@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+
+'''
+	A local stand-in for the parts of the GW2 API this library uses (/v2/items, /v2/commerce/listings
+	and /v2/commerce/prices, plain and ?ids= batched), serving recorded or synthetic fixtures.
+	Latency, 5xx and 429 bursts, redirects and malformed bodies can be injected, so the fetch stack
+	can be load tested and benchmarked repeatably without the real API.
+
+	e.g.
+		server = StandInServer(Fixtures.synthetic(5000), Faults(latency=0.05))
+		server.start()
+		server.install() # Points util.apiCall at the stand-in.
+		...
+		server.stop()
+'''
+
+import http.server
+import json
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import util
+from util import logger
+
+
+class Fixtures:
+	'''
+		The data the stand-in serves: raw item and listing dicts, keyed by id, exactly as the API returns them.
+		Prices are derived from the listings.
+	'''
+	def __init__(self, items=None, listings=None):
+		'''
+			:param items: {id:raw item dict}
+			:param listings: {id:raw listing dict}
+		'''
+		self.items = items or {}
+		self.listings = listings or {}
+		self.prices = {listing_id:self._toPrice(listing) for listing_id, listing in self.listings.items()}
+
+
+	@staticmethod
+	def _toPrice(listing):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The /v2/commerce/prices record for a listing: total quantity and best price per side.
+		'''
+		return {"id":listing["id"], "whitelisted":False, \
+			"buys":{"quantity":sum(buy["quantity"] for buy in listing["buys"]), \
+				"unit_price":max([buy["unit_price"] for buy in listing["buys"]] or [0])}, \
+			"sells":{"quantity":sum(sell["quantity"] for sell in listing["sells"]), \
+				"unit_price":min([sell["unit_price"] for sell in listing["sells"]] or [0])}}
+
+
+	@classmethod
+	def synthetic(cls, item_count=1000, listed_fraction=0.8, max_depth=40, seed=0):
+		'''
+			Generate plausible looking fixtures.
+
+				:param item_count: How many items to make.
+				:param listed_fraction: Roughly what fraction of them have trading post listings.
+				:param max_depth: The most price levels per side of a listing.
+				:param seed: Random seed, so runs are repeatable.
+		'''
+		rng = random.Random(seed)
+		types = ["Weapon", "Armor", "Consumable", "CraftingMaterial", "Trophy", "UpgradeComponent", "Container"]
+		rarities = ["Junk", "Basic", "Fine", "Masterwork", "Rare", "Exotic", "Ascended", "Legendary"]
+		words = ["Tiny", "Snowflake", "Copper", "Ore", "Mithril", "Berserker's", "Sword", "Coat", "Rune", "of", \
+			"the", "Bag", "Dragon", "Ember", "Glob", "Ectoplasm", "Greatsword", "Cured", "Leather", "Square"]
+
+		items = {}
+		listings = {}
+		item_id = 0
+		for i in range(item_count):
+			item_id += rng.randint(1, 5)
+			item_type = rng.choice(types)
+			flags = rng.choice([[], ["NoSalvage"], ["AccountBound", "NoSell"], ["SoulBindOnUse"]])
+			items[item_id] = {"id":item_id, \
+				"name":" ".join(rng.choice(words) for word in range(rng.randint(1, 4))), \
+				"description":rng.choice(["", "Used in crafting.", "Double-click to consume."]), \
+				"type":item_type, "rarity":rng.choice(rarities), "level":rng.choice([0, 0, 80, rng.randint(1, 80)]), \
+				"vendor_value":rng.randint(0, 500), "flags":flags, "game_types":["Activity", "Dungeon", "Pve", "Wvw"], \
+				"restrictions":[], "chat_link":util.makeItemCode(item_id), \
+				"icon":"https://render.guildwars2.com/file/" + hashlib.sha1(str(item_id).encode()).hexdigest().upper() + "/" + str(item_id) + ".png", \
+				"details":{"type":rng.choice(["Sword", "Coat", "Food", "Default"])}}
+
+			if "AccountBound" in flags or rng.random() > listed_fraction:
+				continue
+
+			price = rng.randint(10, 100000)
+			buys = []
+			unit_price = int(price * 0.9)
+			for level in range(rng.randint(0, max_depth)):
+				buys.append({"listings":rng.randint(1, 20), "unit_price":unit_price, "quantity":rng.randint(1, 2500)})
+				unit_price -= rng.randint(1, max(1, price // 50))
+				if unit_price <= 0:
+					break
+			sells = []
+			unit_price = price
+			for level in range(rng.randint(0, max_depth)):
+				sells.append({"listings":rng.randint(1, 20), "unit_price":unit_price, "quantity":rng.randint(1, 2500)})
+				unit_price += rng.randint(1, max(1, price // 50))
+			listings[item_id] = {"id":item_id, "buys":buys, "sells":sells}
+
+		return cls(items, listings)
+
+
+	@classmethod
+	def load(cls, directory):
+		'''
+			Load fixtures saved by save (or recorded by record.)
+
+				:param directory: The directory holding items.json and listings.json.
+		'''
+		with open(os.path.join(directory, "items.json")) as f:
+			items = {item["id"]:item for item in json.load(f)}
+		with open(os.path.join(directory, "listings.json")) as f:
+			listings = {listing["id"]:listing for listing in json.load(f)}
+
+		return cls(items, listings)
+
+
+	def save(self, directory):
+		'''
+			Save these fixtures as items.json and listings.json.
+
+				:param directory: The directory to save into. (created if need be)
+		'''
+		os.makedirs(directory, exist_ok=True)
+		with open(os.path.join(directory, "items.json"), 'w') as f:
+			json.dump(list(self.items.values()), f)
+		with open(os.path.join(directory, "listings.json"), 'w') as f:
+			json.dump(list(self.listings.values()), f)
+
+
+	@classmethod
+	def record(cls, directory, limit=None):
+		'''
+			Record fixtures from whatever util.apiCall currently points at (normally the live API),
+			and save them.
+
+				:param directory: The directory to save into.
+				:param limit: Only record the first this many listed items (and their item data.)
+		'''
+		listing_ids = util.getAllIds('/v2/commerce/listings')[:limit]
+		listings = {listing["id"]:listing for listing in util.idListApiCall('/v2/commerce/listings?ids=', listing_ids)}
+		items = {item["id"]:item for item in util.idListApiCall('/v2/items?ids=', listing_ids)}
+
+		fixtures = cls(items, listings)
+		fixtures.save(directory)
+		return fixtures
+
+
+class Faults:
+	'''
+		What should go wrong, and how often.  Rates are per request probabilities; bursts force
+		the next few requests to fail a particular way.
+	'''
+	def __init__(self, latency=0, latency_jitter=0, error_rate=0, throttle_rate=0, retry_after=1, \
+			redirect_rate=0, malformed_rate=0, seed=None):
+		'''
+			:param latency: Seconds added to every response.
+			:param latency_jitter: Up to this many more seconds added at random (uniformly.)
+			:param error_rate: Chance of answering 503.
+			:param throttle_rate: Chance of answering 429.
+			:param retry_after: Retry-After (seconds) sent with 429s. None to send none.
+			:param redirect_rate: Chance of answering 302 (back to the stand-in itself.)
+			:param malformed_rate: Chance of answering 200 with a truncated json body.
+			:param seed: Random seed, so runs are repeatable.
+		'''
+		self.latency = latency
+		self.latency_jitter = latency_jitter
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.retry_after = retry_after
+		self.redirect_rate = redirect_rate
+		self.malformed_rate = malformed_rate
+
+		self._bursts = [] # [[fault, remaining count]]
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+
+
+	def burst(self, fault, count):
+		'''
+			Make the next count requests fail the given way (after any bursts already queued.)
+
+				:param fault: One of "error" (503), "throttle" (429), "redirect" (302) or "malformed".
+				:param count: How many requests to fail.
+		'''
+		with self._lock:
+			self._bursts.append([fault, count])
+
+
+	def pick(self):
+		'''
+			Decide what happens to the next request.  Returns (fault or None, extra latency in seconds.)
+		'''
+		with self._lock:
+			delay = self.latency + self._random.uniform(0, self.latency_jitter)
+
+			if self._bursts:
+				self._bursts[0][1] -= 1
+				fault = self._bursts[0][0]
+				if self._bursts[0][1] <= 0:
+					self._bursts.pop(0)
+				return fault, delay
+
+			roll = self._random.random()
+			for fault, rate in (("error", self.error_rate), ("throttle", self.throttle_rate), \
+					("redirect", self.redirect_rate), ("malformed", self.malformed_rate)):
+				if roll < rate:
+					return fault, delay
+				roll -= rate
+
+			return None, delay
+
+
+class StandInStats:
+	'''
+		What the stand-in has served: request counts by status and fault, ids served, and how long each
+		request took to answer (including injected latency.)
+	'''
+	def __init__(self):
+		self.reset()
+
+
+	def reset(self):
+		'''
+			Forget everything recorded so far.
+		'''
+		self.requests = 0
+		self.ids_served = 0
+		self.statuses = {}
+		self.faults = {}
+		self.latencies = []
+		self._lock = threading.Lock()
+
+
+	def record(self, status, fault, ids_served, latency):
+		'''
+			NOTE: called by the request handler.
+		'''
+		with self._lock:
+			self.requests += 1
+			self.ids_served += ids_served
+			self.statuses[status] = self.statuses.get(status, 0) + 1
+			if fault:
+				self.faults[fault] = self.faults.get(fault, 0) + 1
+			self.latencies.append(latency)
+
+
+	def percentile(self, fraction):
+		'''
+			The request latency below which the given fraction of requests fell.
+
+				:param fraction: e.g. 0.99 for the 99th percentile.
+		'''
+		with self._lock:
+			latencies = sorted(self.latencies)
+
+		if not latencies:
+			return 0
+		return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+	def summary(self):
+		'''
+			Returns the counters and p50/p95/p99/max latency as a dict.
+		'''
+		with self._lock:
+			summary = {"requests":self.requests, "ids_served":self.ids_served, \
+				"statuses":dict(self.statuses), "faults":dict(self.faults)}
+			max_latency = max(self.latencies or [0])
+
+		summary.update({"p50":self.percentile(0.5), "p95":self.percentile(0.95), "p99":self.percentile(0.99), "max":max_latency})
+		return summary
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+	'''
+		NOTE: INTERNAL CLASS
+		Answers a single request against the server's fixtures and faults.
+	'''
+	protocol_version = "HTTP/1.1" # So connections can be kept alive.
+
+	def log_message(self, format, *args):
+		logger.debug("Stand-in: " + (format % args))
+
+
+	def do_GET(self):
+		started = time.monotonic()
+		server = self.server.stand_in
+		fault, delay = server.faults.pick()
+		if delay:
+			time.sleep(delay)
+
+		status, body, ids_served, headers = self._answer(server, fault)
+
+		etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+		if status == 200 and fault is None:
+			headers["ETag"] = etag
+			headers["Cache-Control"] = "public, max-age=" + str(server.max_age)
+			if self.headers.get("If-None-Match") == etag:
+				status, body = 304, b''
+
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+		server.stats.record(status, fault, ids_served, time.monotonic() - started)
+
+
+	def _answer(self, server, fault):
+		'''
+			Work out (status, body, ids served, extra headers) for the request.
+		'''
+		if fault == "error":
+			return 503, json.dumps({"text":"ErrTimeout"}).encode(), 0, {}
+		if fault == "throttle":
+			headers = {}
+			if server.faults.retry_after is not None:
+				headers["Retry-After"] = str(server.faults.retry_after)
+			return 429, json.dumps({"text":"too many requests"}).encode(), 0, headers
+		if fault == "redirect":
+			return 302, b'', 0, {"Location":"http://" + server.address + self.path}
+
+		parsed_path = urlparse(self.path)
+		collection = {"/v2/items":server.fixtures.items, "/v2/commerce/listings":server.fixtures.listings, \
+			"/v2/commerce/prices":server.fixtures.prices}.get(parsed_path.path.rstrip('/'))
+		if collection is None:
+			return 404, json.dumps({"text":"not found"}).encode(), 0, {}
+
+		query = parse_qs(parsed_path.query)
+		if "ids" in query or "id" in query:
+			try:
+				if "ids" in query:
+					ids = [int(each_id) for each_id in query["ids"][0].split(',') if each_id]
+				else:
+					ids = [int(query["id"][0])]
+			except ValueError:
+				return 400, json.dumps({"text":"invalid id list"}).encode(), 0, {}
+
+			if len(ids) > server.batch_limit:
+				return 400, json.dumps({"text":"id list too long; this endpoint is limited to " + str(server.batch_limit) + " ids at once"}).encode(), 0, {}
+
+			found = [collection[each_id] for each_id in ids if each_id in collection]
+			if not found:
+				return 404, json.dumps({"text":"all ids provided are invalid"}).encode(), 0, {}
+
+			status = 200 if len(found) == len(ids) else 206
+			data = found if "ids" in query else found[0]
+			body = json.dumps(data).encode()
+			ids_served = len(found)
+		else:
+			body = json.dumps(list(collection.keys())).encode()
+			status = 200
+			ids_served = 0
+
+		if fault == "malformed":
+			body = body[:len(body) // 2]
+
+		return status, body, ids_served, {}
+
+
+class StandInServer:
+	'''
+		The stand-in server itself.  Runs on a background thread, answering on 127.0.0.1.
+	'''
+	def __init__(self, fixtures=None, faults=None, port=0, batch_limit=200, max_age=300):
+		'''
+			:param fixtures: The Fixtures to serve; small synthetic ones if not given.
+			:param faults: The Faults to inject; none if not given.
+			:param port: Port to listen on; 0 picks a free one.
+			:param batch_limit: The most ids a ?ids= request may ask for, like the real API's limit.
+			:param max_age: Cache-Control max-age sent with good responses.
+		'''
+		self.fixtures = fixtures or Fixtures.synthetic()
+		self.faults = faults or Faults()
+		self.batch_limit = batch_limit
+		self.max_age = max_age
+		self.stats = StandInStats()
+
+		self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _StandInHandler)
+		self._server.daemon_threads = True
+		self._server.stand_in = self
+		self._thread = None
+		self._previous_endpoint = None
+		self._previous_batch_sizer = None
+
+
+	@property
+	def address(self):
+		'''
+			host:port the stand-in is listening on.
+		'''
+		host, port = self._server.server_address[:2]
+		return host + ":" + str(port)
+
+
+	def start(self):
+		'''
+			Start serving on a background thread.
+		'''
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+
+	def stop(self):
+		'''
+			Stop serving (and point util back where it was, if install was called.)
+		'''
+		self.uninstall()
+		self._server.shutdown()
+		self._server.server_close()
+
+
+	def install(self):
+		'''
+			Point util.apiCall at the stand-in, dropping any pooled connections to the old endpoint.  Batch sizes
+			are learned afresh (and not saved) while it's installed, so its limits never reach the real API's.
+		'''
+		if self._previous_endpoint is None:
+			self._previous_endpoint = (util.api_host, util.api_protocol)
+			self._previous_batch_sizer = util.batch_sizer
+			util.batch_sizer = util.BatchSizer(state_file=None)
+		util.setApiEndpoint(self.address, "http")
+		util.connection_pool.closeAll()
+
+
+	def uninstall(self):
+		'''
+			Point util.apiCall back to where it was before install.
+		'''
+		if self._previous_endpoint is not None:
+			util.setApiEndpoint(*self._previous_endpoint)
+			util.batch_sizer = self._previous_batch_sizer
+			self._previous_endpoint = None
+			self._previous_batch_sizer = None
+			util.connection_pool.closeAll()
+
+
+	def __enter__(self):
+		self.start()
+		self.install()
+		return self
+
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+
+def benchmarkSweep(server, sweeps=3, resource='/v2/commerce/listings?ids='):
+	'''
+		Time full sweeps of a resource against a running, installed stand-in.  Returns a dict of
+		per sweep wall times, ids per second, and the server's request latency percentiles.
+
+			:param server: The StandInServer (already started and installed.)
+			:param sweeps: How many sweeps to time.
+			:param resource: The ?ids= resource to sweep.
+	'''
+	ids = util.getAllIds(resource.split('?')[0])
+	server.stats.reset()
+
+	sweep_times = []
+	for sweep in range(sweeps):
+		started = time.monotonic()
+		util.idListApiCall(resource, ids)
+		sweep_times.append(time.monotonic() - started)
+
+	results = server.stats.summary()
+	results["sweep_times"] = sweep_times
+	results["ids_per_second"] = len(ids) * sweeps / max(sum(sweep_times), 1e-9)
+	return results
+
+
+if __name__ == "__main__":
+	# e.g. ./apistandin.py 20000 0.05 bench
+	logger.setLevel(30)
+	item_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+	server = StandInServer(Fixtures.synthetic(item_count), Faults(latency=latency))
+	server.start()
+
+	if "bench" in sys.argv:
+		server.install()
+		print(json.dumps(benchmarkSweep(server), indent=4))
+		server.stop()
+	else:
+		print("Serving " + str(item_count) + " items on http://" + server.address)
+		try:
+			while 1:
+				time.sleep(1)
+		except KeyboardInterrupt:
+			server.stop()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import changejournal
 import datetime
 import items
 import listings
+import os
+import rollingstats
 import signal
 import sys
 import threading
@@ -28,6 +31,10 @@ class WatcherTrigger:
 			sell_volume_floor=None, \
 			buy_volume_ceiling=None, \
 			buy_volume_floor=None,
+			volatility_ceiling=None,
+			needs_depth=None,
+			item_criteria=None,
+			item_exclude=None,
 			override_trigger=None):
 		'''
 			Initialize a new trigger.  Specify the various potential triggers. (all arguments optional)
@@ -40,6 +47,14 @@ class WatcherTrigger:
 				:param sell_volume_floor: If sell volume goes below this, trigger.
 				:param buy_volume_ceiling: If buy volume goes above this, trigger.
 				:param buy_volume_floor: If buy volume goes below this, trigger.
+				:param volatility_ceiling: If price volatility goes above this, trigger.  (see rollingstats.RollingStatistics.getVolatility)
+				:param needs_depth: If false, triggered data is ItemPrices (top of book only) from the much
+					lighter prices API, rather than full ItemListings.  The builtin thresholds only need top of book,
+					so None (the default) means false unless volatility_ceiling is set (the rolling statistics are
+					fed by full listings.)  Pass True if the callbacks read order book depth. (buys, sells...)
+				:param item_criteria: Also watch every item (known to the watcher's item api) matching these
+					attributes, picked from its bitmap indexes each run. (see items.Items.getItemIdsByAttributes)
+				:param item_exclude: Attributes of items to leave out of those picked by item_criteria.
 				:param override_trigger: Call another function instead of the builtin run.  
 					Must take (trigger, context), and return [] on non trigger, [populated] on success.
 		'''
@@ -56,6 +71,12 @@ class WatcherTrigger:
 		self.sell_volume_floor = sell_volume_floor
 		self.buy_volume_ceiling = buy_volume_ceiling
 		self.buy_volume_floor = buy_volume_floor
+		self.volatility_ceiling = volatility_ceiling
+		if needs_depth is None:
+			needs_depth = volatility_ceiling is not None
+		self.needs_depth = needs_depth
+		self.item_criteria = item_criteria
+		self.item_exclude = item_exclude
 
 		self._run_override = override_trigger
 
@@ -69,7 +90,13 @@ class WatcherTrigger:
 		if self._run_override:
 			return self._run_override(self, context)
 
-		item_listings = context.listing_api.getListingsById(self.item_ids, use_cache=True)
+		listing_api = context.listing_api
+		if not self.needs_depth and context.price_api is not None:
+			listing_api = context.price_api
+		item_ids = self.item_ids
+		if self.item_criteria:
+			item_ids = sorted(set(item_ids).union(context.item_api.getItemIdsByAttributes(self.item_criteria, self.item_exclude)))
+		item_listings = listing_api.getListingsById(item_ids, use_cache=True)
 
 		if self.run_interval:
 			curr_time = time.time()
@@ -81,6 +108,7 @@ class WatcherTrigger:
 				return item_listings
 
 		items_of_interest = []
+		listing_stats = context.listing_stats
 
 		for item_listing in item_listings:
 			if (self.buy_ceiling and item_listing.max_buy > self.buy_ceiling) \
@@ -88,7 +116,8 @@ class WatcherTrigger:
 			or (self.sell_volume_ceiling and item_listing.sell_volume > self.sell_volume_ceiling) \
 			or (self.sell_volume_floor and item_listing.sell_volume < self.sell_volume_floor) \
 			or (self.buy_volume_ceiling and item_listing.buy_volume > self.buy_volume_ceiling) \
-			or (self.buy_volume_floor and item_listing.buy_volume < self.buy_volume_floor):
+			or (self.buy_volume_floor and item_listing.buy_volume < self.buy_volume_floor) \
+			or (self.volatility_ceiling and listing_stats is not None and (listing_stats.getVolatility(item_listing.id) or 0) > self.volatility_ceiling):
 				items_of_interest.append(item_listing)
 
 		return items_of_interest
@@ -170,7 +199,7 @@ class WatcherThread:
 		for any data that callable might need, including what should happen if the event being
 		watched for occurs.
 	'''
-	def __init__(self, trigger_batches = [], item_api = None, listing_api = None):
+	def __init__(self, trigger_batches = [], item_api = None, listing_api = None, listing_stats = None, price_api = None):
 		'''
 			Initialize the thread.
 
@@ -178,6 +207,8 @@ class WatcherThread:
 				:param waiters: A list of callable objects to be run if the watcher triggers them. (must each take a data object)
 				:param item_api: an instance of the items api to utilize.
 				:param listing_api: an instance of the listings api to utilize.
+				:param listing_stats: a rollingstats.RollingStatistics fed by listing_api, for triggers to read.
+				:param price_api: an instance of the prices api (listings.Prices), for triggers that don't need depth.
 		'''
 		self.poll_interval = 30
 
@@ -189,6 +220,8 @@ class WatcherThread:
 		self.trigger_batches = trigger_batches
 		self.item_api = item_api
 		self.listing_api = listing_api
+		self.listing_stats = listing_stats
+		self.price_api = price_api
 
 		self.halt = False
 
@@ -243,7 +276,18 @@ class Watcher:
 
 		self.listing_api = listing_api
 		if listing_api == None:
-			self.listing_api = listings.Listings()
+			# Listings fetched within the current poll get shared between triggers, but anything
+			# from a previous poll gets refetched.  Triggers tend to read only a statistic or two,
+			# so the rest are left to be worked out if something asks for them.
+			self.listing_api = listings.Listings(max_age=self.default_poll_interval / 2, lazy=True)
+
+		# For triggers that only need top of book.
+		self.price_api = listings.Prices(max_age=self.default_poll_interval / 2)
+
+		# Kept up to date from every listing (or price) fetched, so triggers can read volatility and flow at once.
+		self.listing_stats = rollingstats.RollingStatistics()
+		self.listing_stats.attach(self.listing_api)
+		self.listing_stats.attach(self.price_api)
 
 
 	def _createWatcherThread(self, trigger_batches, item_api = None, listing_api = None):
@@ -260,7 +304,8 @@ class Watcher:
 		if not listing_api:
 			listing_api = self.listing_api
 
-		new_watcher_thread = WatcherThread(trigger_batches, item_api, listing_api)
+		listing_stats = self.listing_stats if listing_api is self.listing_api else None
+		new_watcher_thread = WatcherThread(trigger_batches, item_api, listing_api, listing_stats, self.price_api)
 		new_watcher_thread.setPollInterval(self.default_poll_interval)
 		self.watcher_threads.append(new_watcher_thread)
 		new_watcher_thread.start()
@@ -297,15 +342,19 @@ class Watcher:
 		# this can be way more encapsulated.
 		def watchForNewItems(trigger, context):
 			if "all_ids" not in dir(trigger):
-				trigger.all_ids = id_query()
+				trigger.all_ids = set(id_query())
 			else:
 				new_all_ids = id_query()
 
-				if set(trigger.all_ids) != set(new_all_ids):
+				# The set is kept between runs, and only rebuilt when ids have also gone.
+				ret = [item_id for item_id in new_all_ids if item_id not in trigger.all_ids]
+				if len(new_all_ids) != len(trigger.all_ids) + len(ret):
 					print("found distinct sets: " + str(len(trigger.all_ids)) + "," + str(len(new_all_ids)))
-					ret = list(set(new_all_ids) - set(trigger.all_ids))
-					trigger.all_ids = new_all_ids
-					return ret
+					trigger.all_ids = set(new_all_ids)
+				elif ret:
+					print("found distinct sets: " + str(len(trigger.all_ids)) + "," + str(len(new_all_ids)))
+					trigger.all_ids.update(ret)
+				return ret
 			return []
 
 		trigger = WatcherTrigger()
@@ -316,13 +365,28 @@ class Watcher:
 		return new_watcher_thread
 
 
-	def watchForNewItems(self, onChangeFunctions):
+	def watchForNewItems(self, onChangeFunctions, recheck_count=0):
 		'''
-			Creates a watcher for if new item IDs appear in the items API.
+			Creates a watcher for if new item IDs appear in the items API.  Each run syncs the item api
+			(see items.Items.sync), so new items are fetched into it as they're found, and reads the new
+			ids off its journal.  The first run only catches the catalog up (loading a snapshot into the
+			item api first keeps that cheap.)
 
 				:param onChangeFunctions: A list of callable objects to call when a change is noticed. (must each take a data object)
+				:param recheck_count: Items to refetch each run for changes (which go in the journal, but aren't reported.)
 		'''
-		return self._watchForNewIds(self.item_api.getAllIds, onChangeFunctions)
+		def syncItems(trigger, context):
+			entries = context.item_api.sync(recheck_count)
+			if "synced" not in dir(trigger):
+				trigger.synced = True
+				return []
+			return [entry.item_id for entry in entries if entry.kind == changejournal.ADDED]
+
+		trigger = WatcherTrigger()
+		trigger.overrideRunWith(syncItems)
+		trigger_batch = WatcherTriggerBatch([trigger], onChangeFunctions)
+
+		return self._createWatcherThread([trigger_batch])
 
 
 	def watchForNewListings(self, onChangeFunctions):
@@ -361,6 +425,8 @@ if __name__ == "__main__":
 	logger.setLevel(0)
 
 	item_api = items.Items()
+	if os.path.exists("items.snapshot"):
+		item_api.loadSnapshot("items.snapshot")
 	w = Watcher(item_api)
 
 	def handler(signal, frame):
@@ -374,7 +440,7 @@ if __name__ == "__main__":
 	#w.batchWatchListings([([t], [print])])
 
 	def convertData(data_list):
-		return [{"name":item_api.getItemById(item_id).name, \
+		return [{"name":item_api.getItemById(item_id, use_cache=True).name, \
 				"id":item_id, \
 				"code":util.makeItemCode(item_id)} \
 			 for item_id in data_list]
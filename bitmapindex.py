@@ -0,0 +1,272 @@
+'''
+	Bitmap indexes over categorical item fields (type, rarity, level, flags...), for multi criteria
+	filters without calling a lambda on every item.
+
+	Each value of each indexed field has a bitmap: a Python int with bit n set if item n has that value.
+	A filter ORs together the bitmaps of the values wanted for each field, ANDs the fields, and clears
+	the bits of anything excluded; counting the result is a popcount, so count only queries never
+	touch an item object.  Adding and removing items only touches a set of ids per value; a value's
+	bitmap is built from its set the first time a query needs it after a change, so loading a whole
+	catalog doesn't rebuild a catalog sized int for every item.
+	e.g.
+		index.count({'rarity':'Exotic', 'type':'Weapon', 'level':80}, exclude={'flags':'AccountBound'})
+'''
+
+import threading
+
+
+# The set bit positions of each byte value, for reading ids back out of a bitmap.
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def fieldValues(artifact, field):
+	'''
+		The values an artifact has for a field, as a tuple: empty if it doesn't have the field, one
+		value for most fields, every element for list fields (e.g. flags.)  Dotted fields reach into
+		nested objects. (e.g. 'details.type')
+
+			:param artifact: The item (or any object.)
+			:param field: The field name.
+	'''
+	value = artifact
+	for part in field.split('.'):
+		value = getattr(value, part, None)
+		if value is None:
+			return ()
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return tuple(value)
+	return (value,)
+
+
+def bitmapIds(bitmap):
+	'''
+		The ids whose bits are set in a bitmap, ascending.
+
+			:param bitmap: An int bitmap.
+	'''
+	item_ids = []
+	for byte_number, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+		if byte:
+			base = byte_number * 8
+			item_ids.extend(base + bit for bit in _BYTE_BITS[byte])
+	return item_ids
+
+
+def _idsBitmap(item_ids):
+	'''
+		NOTE: INTERNAL FUNCTION
+		The bitmap with the bits of the given ids set, built in one go.
+	'''
+	if not item_ids:
+		return 0
+	bits = bytearray((max(item_ids) >> 3) + 1)
+	for item_id in item_ids:
+		bits[item_id >> 3] |= 1 << (item_id & 7)
+	return int.from_bytes(bits, 'little')
+
+
+def _wanted(values):
+	'''
+		NOTE: INTERNAL FUNCTION
+		A criterion's values as a tuple; a list, tuple or set of values means any of them.
+	'''
+	if isinstance(values, (list, tuple, set, frozenset)):
+		return tuple(values)
+	return (values,)
+
+
+def matches(artifact, criteria, exclude=None):
+	'''
+		Whether an artifact passes a filter, checked directly rather than through an index.  Same
+		meaning as BitmapIndex.select.
+
+			:param artifact: The item (or any object.)
+			:param criteria: {field:value or list of values}
+			:param exclude: {field:value or list of values} to reject.
+	'''
+	for field, values in criteria.items():
+		if not set(fieldValues(artifact, field)).intersection(_wanted(values)):
+			return False
+	for field, values in (exclude or {}).items():
+		if set(fieldValues(artifact, field)).intersection(_wanted(values)):
+			return False
+	return True
+
+
+class BitmapIndex:
+	'''
+		Bitmaps of item ids for each value of a few fields.
+	'''
+	def __init__(self, fields):
+		'''
+			:param fields: The field names to index. (dotted for nested fields, see fieldValues)
+		'''
+		self.fields = tuple(fields)
+		self.value_ids = {field:{} for field in self.fields} # field:{value:set of ids}
+		self._bitmaps = {field:{} for field in self.fields} # field:{value:bitmap}, for values unchanged since last built
+		self._all_ids = None # bitmap of every indexed id, None until next built
+		self._values = {} # id:{field:values}, to take an item out of its values' sets when it's replaced
+		self._lock = threading.Lock()
+
+
+	def add(self, artifact):
+		'''
+			Index an artifact (by its id), replacing what was indexed for it before.
+
+				:param artifact: The item to index.
+		'''
+		item_id = artifact.id
+		values = {field:fieldValues(artifact, field) for field in self.fields}
+		with self._lock:
+			self._remove(item_id)
+			for field, field_values in values.items():
+				field_ids, field_bitmaps = self.value_ids[field], self._bitmaps[field]
+				for value in field_values:
+					value_ids = field_ids.get(value)
+					if value_ids is None:
+						value_ids = field_ids[value] = set()
+					value_ids.add(item_id)
+					field_bitmaps.pop(value, None)
+			self._all_ids = None
+			self._values[item_id] = values
+
+
+	def remove(self, item_id):
+		'''
+			Drop an id from the index, if it's there.
+
+				:param item_id: The item id.
+		'''
+		with self._lock:
+			self._remove(item_id)
+
+
+	def _remove(self, item_id):
+		'''
+			NOTE: INTERNAL FUNCTION.  Call with the lock held.
+		'''
+		values = self._values.pop(item_id, None)
+		if values is None:
+			return
+		for field, field_values in values.items():
+			field_ids, field_bitmaps = self.value_ids[field], self._bitmaps[field]
+			for value in field_values:
+				value_ids = field_ids[value]
+				value_ids.discard(item_id)
+				if not value_ids:
+					del field_ids[value]
+				field_bitmaps.pop(value, None)
+		self._all_ids = None
+
+
+	def _valueBitmap(self, field, value):
+		'''
+			NOTE: INTERNAL FUNCTION.  Call with the lock held.
+			A value's bitmap, built from its ids if it has changed since it was last built.
+		'''
+		field_bitmaps = self._bitmaps[field]
+		bitmap = field_bitmaps.get(value)
+		if bitmap is None:
+			value_ids = self.value_ids[field].get(value)
+			if not value_ids:
+				return 0
+			bitmap = field_bitmaps[value] = _idsBitmap(value_ids)
+		return bitmap
+
+
+	def _bitmap(self, field, values):
+		'''
+			NOTE: INTERNAL FUNCTION.  Call with the lock held.
+		'''
+		bitmap = 0
+		for value in _wanted(values):
+			bitmap |= self._valueBitmap(field, value)
+		return bitmap
+
+
+	def bitmap(self, field, values):
+		'''
+			The bitmap of ids having any of the given values for a field.
+
+				:param field: An indexed field.
+				:param values: A value, or a list of values.
+		'''
+		with self._lock:
+			return self._bitmap(field, values)
+
+
+	@property
+	def all_ids(self):
+		'''
+			The bitmap of every indexed id.
+		'''
+		with self._lock:
+			return self._allIds()
+
+
+	def _allIds(self):
+		'''
+			NOTE: INTERNAL FUNCTION.  Call with the lock held.
+		'''
+		if self._all_ids is None:
+			self._all_ids = _idsBitmap(self._values)
+		return self._all_ids
+
+
+	def select(self, criteria, exclude=None):
+		'''
+			The bitmap of ids matching every criterion and no exclusion.  A list of values for a field
+			means any of them; a list field (e.g. flags) matches if it holds any of them.
+
+				:param criteria: {field:value or list of values}; every field must match.
+				:param exclude: {field:value or list of values}; ids matching any of these are left out.
+		'''
+		with self._lock:
+			bitmap = self._allIds()
+			# The rarest field first empties the bitmap soonest.
+			for field, values in sorted(criteria.items(), key=lambda criterion: self._bitmap(*criterion).bit_count()):
+				bitmap &= self._bitmap(field, values)
+				if not bitmap:
+					return 0
+			for field, values in (exclude or {}).items():
+				bitmap &= ~self._bitmap(field, values)
+		return bitmap
+
+
+	def count(self, criteria, exclude=None):
+		'''
+			How many ids match a filter. (see select)
+
+				:param criteria: {field:value or list of values}
+				:param exclude: {field:value or list of values}
+		'''
+		return self.select(criteria, exclude).bit_count()
+
+
+	def ids(self, criteria, exclude=None):
+		'''
+			The ids matching a filter, ascending. (see select)
+
+				:param criteria: {field:value or list of values}
+				:param exclude: {field:value or list of values}
+		'''
+		return bitmapIds(self.select(criteria, exclude))
+
+
+	def values(self, field):
+		'''
+			Every value indexed for a field, with how many ids have it, as a dict.
+
+				:param field: An indexed field.
+		'''
+		with self._lock:
+			return {value:len(value_ids) for value, value_ids in self.value_ids[field].items()}
+
+
+	def __contains__(self, item_id):
+		return item_id in self._values
+
+
+	def __len__(self):
+		return len(self._values)
+
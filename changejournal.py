@@ -0,0 +1,118 @@
+'''
+	An append only journal of changes to a catalog (items added, removed or changed), numbered in
+	order so consumers can tail it: remember the last sequence number seen, and ask for what came after.
+
+	The journal keeps its most recent entries in memory, and can also append every entry to a file
+	as a line of JSON, which is read back (for the sequence numbering and recent entries) on open.
+	e.g.
+		last_seen = 0
+		...
+		for entry in item_api.journal.tail(last_seen):
+			last_seen = entry.sequence
+'''
+
+import collections
+import json
+import threading
+import time
+
+
+ADDED, REMOVED, CHANGED = 'added', 'removed', 'changed'
+
+# data is the raw record: as it is now for added and changed, as it last was for removed.
+JournalEntry = collections.namedtuple('JournalEntry', 'sequence time kind item_id data')
+
+
+class ChangeJournal:
+	'''
+		Numbered change entries, oldest first.
+	'''
+	def __init__(self, path=None, max_entries=100000):
+		'''
+			:param path: A file to append entries to (and resume from); in memory only if None.
+			:param max_entries: How many of the latest entries to keep in memory for tail.
+		'''
+		self.path = path
+		self.entries = collections.deque(maxlen=max_entries)
+		self.last_sequence = 0
+		self._lock = threading.Lock()
+
+		if path is not None:
+			try:
+				with open(path) as f:
+					for line in f:
+						if line.strip():
+							self.entries.append(JournalEntry(**json.loads(line)))
+			except FileNotFoundError:
+				pass
+			if self.entries:
+				self.last_sequence = self.entries[-1].sequence
+
+
+	def append(self, kind, item_id, data=None, timestamp=None):
+		'''
+			Add an entry, returning it.
+
+				:param kind: ADDED, REMOVED or CHANGED.
+				:param item_id: The id of the record that changed.
+				:param data: The raw record.
+				:param timestamp: When it changed; now if None.
+		'''
+		return self.extend([(kind, item_id, data)], timestamp)[0]
+
+
+	def extend(self, changes, timestamp=None):
+		'''
+			Add a batch of entries at once (written to the file together), returning them.
+
+				:param changes: Iterable of (kind, item_id, data).
+				:param timestamp: When they changed; now if None.
+		'''
+		if timestamp is None:
+			timestamp = time.time()
+
+		with self._lock:
+			new_entries = []
+			for kind, item_id, data in changes:
+				self.last_sequence += 1
+				new_entries.append(JournalEntry(self.last_sequence, timestamp, kind, item_id, data))
+
+			if self.path is not None and new_entries:
+				with open(self.path, 'a') as f:
+					f.write(''.join(json.dumps(entry._asdict()) + '\n' for entry in new_entries))
+			self.entries.extend(new_entries)
+
+		return new_entries
+
+
+	def tail(self, after_sequence=0, kinds=None):
+		'''
+			The entries after a sequence number, oldest first.  Entries too old to still be held in
+			memory are left out; check first_sequence if that matters.
+
+				:param after_sequence: The last sequence number already seen; 0 for everything held.
+				:param kinds: Only entries of these kinds (e.g. (ADDED,)); all if None.
+		'''
+		with self._lock:
+			if not self.entries or after_sequence >= self.last_sequence:
+				return []
+			# Sequence numbers are consecutive, so the position is a subtraction away.
+			start = max(after_sequence + 1 - self.entries[0].sequence, 0)
+			entries = [self.entries[position] for position in range(start, len(self.entries))]
+
+		if kinds is not None:
+			entries = [entry for entry in entries if entry.kind in kinds]
+		return entries
+
+
+	@property
+	def first_sequence(self):
+		'''
+			The sequence number of the oldest entry held in memory, or None if there are none.
+		'''
+		with self._lock:
+			return self.entries[0].sequence if self.entries else None
+
+
+	def __len__(self):
+		return len(self.entries)
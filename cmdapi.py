@@ -1,36 +1,202 @@
+import bitmapindex
+import collections
 import listings
 import items
-import copy
+import heapq
 import util
 
 
+class _Scan:
+	'''
+		NOTE: INTERNAL CLASS
+		Plan node reading one table, with any where clauses that come straight after it.  Each clause
+		sees a single reused {table_name:artifact} dict, so only rows that pass are given one of their own.
+	'''
+	def __init__(self, table_name, artifacts):
+		self.table_name = table_name
+		self.artifacts = artifacts
+		self.tables = {table_name}
+		self.filters = []
+
+
+	def rows(self):
+		table_name, filters = self.table_name, self.filters
+		if not filters:
+			for artifact in self.artifacts:
+				yield {table_name:artifact}
+			return
+
+		candidate = {}
+		for artifact in self.artifacts:
+			candidate[table_name] = artifact
+			if all(row_filter(candidate) for row_filter in filters):
+				yield {table_name:artifact}
+
+
+class _Join:
+	'''
+		NOTE: INTERNAL CLASS
+		Plan node for Join, with the where clauses that come after it.  Clauses that only read tables from
+		before the join, and not the joined one (left_filters), are checked against the row each join value ends up with before the
+		joined table is looked through, so rows they reject are never matched or copied; the rest are
+		checked against each joined row before it's copied out.
+	'''
+	def __init__(self, left, table_name, artifacts, field, original_field):
+		self.left = left
+		self.table_name = table_name
+		self.artifacts = artifacts
+		self.field = field
+		self.original_field = original_field
+		self.tables = (left.tables if left is not None else set()) | {table_name}
+		self.left_filters = []
+		self.filters = []
+		self.pruned = False # Nothing reads the joined table, so don't look through it.
+
+
+	def rows(self):
+		if self.left is None:
+			return
+
+		# One row per join value (the last with that value), for rows that have the field at all.
+		joinable_index = {}
+		uses = collections.Counter() # id(row):how many join values it's under
+		for artifact_group in self.left.rows():
+			for artifact in artifact_group.values():
+				try:
+					joinable_index[getattr(artifact, self.original_field)] = artifact_group
+					uses[id(artifact_group)] += 1
+				except AttributeError:
+					pass
+
+		# Rows sharing a join value are merged into the last of them before any clause sees them, so
+		# the clauses check the row that won, not every row. (Checking earlier would let an earlier row win.)
+		left_filters = self.left_filters
+		if left_filters:
+			passed = {} # id(row):whether it passed, for rows under more than one join value
+			for join_value, artifact_group in list(joinable_index.items()):
+				row_passed = passed.get(id(artifact_group))
+				if row_passed is None:
+					row_passed = passed[id(artifact_group)] = all(row_filter(artifact_group) for row_filter in left_filters)
+				if not row_passed:
+					del joinable_index[join_value]
+
+		# The last artifact with each join value.
+		matches = {}
+		if not self.pruned:
+			for artifact in self.artifacts:
+				try:
+					join_value = getattr(artifact, self.field)
+				except AttributeError:
+					continue
+				if join_value in joinable_index:
+					matches[join_value] = artifact
+
+		table_name, filters = self.table_name, self.filters
+		candidate = {}
+		for join_value, artifact_group in joinable_index.items():
+			match = matches.get(join_value)
+			if filters:
+				candidate.clear()
+				candidate.update(artifact_group)
+				if match is not None:
+					candidate[table_name] = match
+				if not all(row_filter(candidate) for row_filter in filters):
+					continue
+
+			# A row under only one join value comes out once, so needn't be copied.
+			if uses[id(artifact_group)] > 1:
+				artifact_group = dict(artifact_group)
+			if match is not None:
+				artifact_group[table_name] = match
+			yield artifact_group
+
+
+class _Filter:
+	'''
+		NOTE: INTERNAL CLASS
+		Plan node for where clauses that can't go any lower (e.g. after Top), fused into one pass.
+	'''
+	def __init__(self, child):
+		self.child = child
+		self.tables = child.tables
+		self.filters = []
+
+
+	def rows(self):
+		filters = self.filters
+		for artifact_group in self.child.rows():
+			if all(row_filter(artifact_group) for row_filter in filters):
+				yield artifact_group
+
+
+class _Top:
+	'''
+		NOTE: INTERNAL CLASS
+	'''
+	def __init__(self, child, k, key):
+		self.child = child
+		self.tables = child.tables
+		self.k = k
+		self.key = key
+
+
+	def rows(self):
+		return iter(heapq.nlargest(self.k, self.child.rows(), key=self.key))
+
+
 class Query:
 	'''
 		Query object, presents the ability to chain additional filters or produce an evaluation of the result space,
 		merging the various api channels for the relevent artifact type.
+		Chaining only records what to do; nothing is read until Evaluate (or results) is asked for, when the
+		steps are planned together: where clauses right after From are checked as the table is read, ones
+		declared (see Where) to only read tables from before a Join (other than the one it joins) are checked before the joined table is
+		looked through, adjacent ones are checked in one pass, and joined tables nothing reads are skipped.
+		None of this changes what a query returns.
 	'''
-	results = []
 	fields = []
 	tables = {}
+	indexes = {}
+	operations = ()
 
 
-	def __init__(self, parent, results=None):
+	def __init__(self, parent, operation=None, indexes=None):
 		'''
 			Initialize a new query.  Takes either a set of tables (as {table_name:[objects]} ) for the
-			initial declaration of a query stanza, or a parent query and a set of results to inherit
+			initial declaration of a query stanza, or a parent query and an operation to add to its plan
 			if further down the chain.
 
 				:param parent: Either the tables to start a query stanza against, or the parent query.
-				:param results: If a parent query is specified, these are the results to inherit.
+				:param operation: If a parent query is specified, the step this query adds to it, as a tuple
+					(e.g. ('where', query, tables)), or None to just copy it.
+				:param indexes: For a new stanza, {table_name:api object} for tables with indexes: a Listings
+					object for sorted field indexes (see WhereRange), an Items object for attribute bitmaps. (see WhereAttributes)
 		'''
+		self._results = None
+
 		#Initial setup from the api wrapper.
-		if results == None:
+		if not isinstance(parent, Query):
 			self.tables = parent
+			self.indexes = indexes or {}
 			return
 
 		self.fields = parent.fields
 		self.tables = parent.tables
-		self.results = results
+		self.indexes = parent.indexes
+		self.operations = parent.operations
+		if operation is not None:
+			self.operations = self.operations + (operation,)
+
+
+	@property
+	def results(self):
+		'''
+			The rows this query produces (as {table_name:artifact} dicts), worked out the first time they're asked for.
+		'''
+		if self._results is None:
+			plan = self._plan()
+			self._results = list(plan.rows()) if plan is not None else []
+		return self._results
 
 
 	def Select(self, *fields):
@@ -39,7 +205,7 @@ class Query:
 
 				:param fields: The names of the fields to return in a list of tuples.
 		'''
-		query = Query(self, self.results)
+		query = Query(self)
 		query.fields = fields
 		return query
 
@@ -51,8 +217,9 @@ class Query:
 				:param artifact_type: The type to query.  Must be from within the table dict passed in during
 					initial query stanza initialization.
 		'''
-		results = [{artifact_type:artifact} for artifact in self.tables[artifact_type]]
-		return Query(self, results)
+		if artifact_type not in self.tables:
+			raise KeyError(artifact_type)
+		return Query(self, ('from', artifact_type))
 
 
 	#Not a huge fan of how I do join, but "it works" I guess.
@@ -60,6 +227,7 @@ class Query:
 		'''
 			Perform a join with another type specified in the tables dict.  Utilize shared field.  If field isn't shared,
 			specify the original field in the final arg.
+			Results without a match are kept; results sharing a value for the field are merged into the last of them.
 
 				:param artifact_type: Which new table to join.
 				:param field: Name of the field to join the new table to results with.
@@ -68,39 +236,168 @@ class Query:
 		'''
 		if original_field == None:
 			original_field = field
+		if artifact_type not in self.tables:
+			raise KeyError(artifact_type)
 
-		joinable_index = {}
-		for artifact_group in self.results:
-			for artifact in artifact_group.values():
-				try:
-					joinable_index[getattr(artifact, original_field)] = copy.deepcopy(artifact_group)
-				except AttributeError:
-					pass
- 
-		for artifact in self.tables[artifact_type]:
-			try:
-				joinable_index[getattr(artifact, field)][artifact_type] = artifact
-			except KeyError:
-				pass
-			except AttributeError:
-				pass
-
-		return Query(self, list(joinable_index.values()))
+		return Query(self, ('join', artifact_type, field, original_field))
 		
 
 
-	def Where(self, query):
+	def Where(self, query, tables=None):
 		'''
 			Add a where clause to the query.  Returns a new query object that has been filtered accordingly.
 
 				:param query: The lambda to examine each object for validity.
+				:param tables: The tables the lambda reads, if it's known to read no others (e.g. ('items',) for
+					lambda artifact_group: artifact_group['items'].level == 80), so it can be checked before later
+					joined tables are looked through.  None if it may read any of them.
 		'''
-		results = []
-		for artifact_group in self.results:
-			if query(artifact_group):
-				results.append(artifact_group)
-		
-		return Query(self, results)
+		return Query(self, ('where', query, frozenset(tables) if tables is not None else None))
+
+
+	def WhereRange(self, artifact_type, **ranges):
+		'''
+			Keep results whose artifact of the given type has every given field in range (inclusive.)
+			Uses the table's sorted indexes when it has them, rather than checking every result.
+			e.g. WhereRange('listings', min_sell=(100, 500), sell_volume=(1000, None))
+
+				:param artifact_type: Which table's artifact to check.
+				:param ranges: field=(low, high); either bound may be None for unbounded.
+		'''
+		index = self.indexes.get(artifact_type)
+		if index is not None and hasattr(index, 'searchListingsByRange'):
+			matching_ids = {artifact.id for artifact in index.searchListingsByRange(**ranges)}
+			return self.Where(lambda artifact_group: artifact_type in artifact_group \
+				and artifact_group[artifact_type].id in matching_ids, tables=(artifact_type,))
+
+		def inRanges(artifact_group):
+			artifact = artifact_group.get(artifact_type)
+			if artifact is None:
+				return False
+			for field, (low, high) in ranges.items():
+				value = getattr(artifact, field, None)
+				if value is None or (low is not None and value < low) or (high is not None and value > high):
+					return False
+			return True
+
+		return self.Where(inRanges, tables=(artifact_type,))
+
+
+	def WhereAttributes(self, artifact_type, criteria, exclude=None):
+		'''
+			Keep results whose artifact of the given type matches every criterion and no exclusion.
+			Uses the table's bitmap indexes when it has them, rather than checking every result.
+			e.g. WhereAttributes('items', {'rarity':'Exotic', 'type':'Weapon', 'level':80}, exclude={'flags':'AccountBound'})
+
+				:param artifact_type: Which table's artifact to check.
+				:param criteria: {field:value or list of values}; a list means any of them.
+				:param exclude: {field:value or list of values} to leave out.
+		'''
+		index = self.indexes.get(artifact_type)
+		if index is not None and hasattr(index, 'getItemIdsByAttributes'):
+			matching_ids = set(index.getItemIdsByAttributes(criteria, exclude))
+			return self.Where(lambda artifact_group: artifact_type in artifact_group \
+				and artifact_group[artifact_type].id in matching_ids, tables=(artifact_type,))
+
+		return self.Where(lambda artifact_group: artifact_type in artifact_group \
+			and bitmapindex.matches(artifact_group[artifact_type], criteria, exclude), tables=(artifact_type,))
+
+
+	def Top(self, k, key):
+		'''
+			Keep only the k results with the highest key, best first.  Cheaper than sorting every
+			result when k is small.
+
+				:param k: How many results to keep.
+				:param key: The lambda giving each result's score.
+		'''
+		return Query(self, ('top', k, key))
+
+
+	def _plan(self, prune=False):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Turn the recorded operations into a tree of plan nodes, with where clauses pushed down and fused.
+
+				:param prune: Skip joined tables that neither later steps nor the selected fields read. (Only
+					for Evaluate; results still has every table's artifacts.)
+		'''
+		plan = None
+		joins = [] # (join node, position of the operation)
+		for position, operation in enumerate(self.operations):
+			kind = operation[0]
+			if kind == 'from':
+				plan = _Scan(operation[1], self.tables[operation[1]])
+			elif kind == 'join':
+				artifact_type, field, original_field = operation[1:]
+				plan = _Join(plan, artifact_type, self.tables[artifact_type], field, original_field)
+				joins.append((plan, position))
+			elif kind == 'where':
+				if plan is not None:
+					plan = self._pushDown(plan, operation[1], operation[2])
+			elif kind == 'top':
+				if plan is not None:
+					plan = _Top(plan, operation[1], operation[2])
+
+		if prune:
+			for join, position in joins:
+				join.pruned = not self._isRead(join.table_name, self.operations[position + 1:])
+
+		return plan
+
+
+	def _pushDown(self, plan, row_filter, tables):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Add a where clause to a plan as low down as it can go, returning the new top of the plan.
+		'''
+		if isinstance(plan, _Scan):
+			plan.filters.append(row_filter)
+			return plan
+		if isinstance(plan, _Join):
+			# Not below the join itself: that would change which of the rows sharing a join value wins.  Nor
+			# ahead of it if it reads the joined table, which may replace an artifact of the same name.
+			if tables is not None and plan.left is not None and tables <= plan.left.tables \
+					and plan.table_name not in tables and not plan.filters:
+				plan.left_filters.append(row_filter)
+			else:
+				plan.filters.append(row_filter)
+			return plan
+		if not isinstance(plan, _Filter):
+			plan = _Filter(plan)
+		plan.filters.append(row_filter)
+		return plan
+
+
+	def _isRead(self, table_name, later_operations):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Whether anything after a join could read the joined table: a later where clause not declared to
+			read only other tables, a Top key, a later join (which looks up its field on every artifact), or a
+			selected field any of its artifacts has.
+		'''
+		for operation in later_operations:
+			kind = operation[0]
+			if kind in ('join', 'top'):
+				return True
+			if kind == 'where' and (operation[2] is None or table_name in operation[2]):
+				return True
+
+		if not self.fields:
+			return False
+		# Every artifact has to be asked: records keep fields outside their schema (e.g. _CompactRecord's
+		# overflow) per artifact, so neither the class nor one sample says what the rest have.
+		fields = self.fields
+		schema_classes = {} # class:whether its schema has a selected field
+		for artifact in self.tables[table_name]:
+			artifact_class = type(artifact)
+			in_schema = schema_classes.get(artifact_class)
+			if in_schema is None:
+				schema = getattr(artifact_class, '_fields', ())
+				in_schema = schema_classes[artifact_class] = any(field in schema for field in fields)
+			if in_schema or any(hasattr(artifact, field) for field in fields):
+				return True
+		return False
 
 
 	#TODO: don't like how I do missing columns right now, they just get left out from the results.
@@ -108,9 +405,14 @@ class Query:
 		'''
 			Get the fields specified via select for each joined object, and return a list of tuples.
 		'''
+		if self._results is not None:
+			artifact_groups = self._results
+		else:
+			plan = self._plan(prune=True)
+			artifact_groups = plan.rows() if plan is not None else ()
 
 		selected_results = []
-		for artifact_group in self.results:
+		for artifact_group in artifact_groups:
 			result_batch = {}
 			for field in self.fields:
 				for artifact in artifact_group.values():
@@ -134,22 +436,49 @@ class Api:
 	'''
 
 	data = {}
+	indexes = {}
+
+	# Listing fields kept in sorted indexes, for Query.WhereRange.
+	indexed_fields = ('min_sell', 'max_buy', 'margin', 'buy_volume', 'sell_volume')
 
-	def __init__(self):
+	def __init__(self, item_snapshot=None, needs_depth=True):
 		'''
 			Prime the API with current data.  This takes a bit.
+
+				:param item_snapshot: Optional item snapshot file to load the item catalog from, rather
+					than downloading it. (It is downloaded and written there if it doesn't exist yet.)
+				:param needs_depth: If false, the listings table holds ItemPrices (top of book only) from the
+					prices API, which is far quicker to fetch, rather than full ItemListings.
 		'''
-		listing_api = listings.Listings()
+		listing_api = listings.Listings(indexed_fields=self.indexed_fields) if needs_depth \
+			else listings.Prices(indexed_fields=self.indexed_fields)
 		self.data['listings'] = listing_api.getAllListings()
+		self.indexes['listings'] = listing_api
 
 		item_api = items.Items()
-		self.data['items'] = item_api.getAllItems()
+		if item_snapshot:
+			item_api.loadSnapshotOrGetAllItems(item_snapshot)
+			self.data['items'] = item_api.items.values()
+		else:
+			self.data['items'] = item_api.getAllItems()
+		self.indexes['items'] = item_api
 
 
 	def Query(self):
 		'''
 			Begin a query stanza.  
 		'''
-		return Query(self.data)
+		return Query(self.data, indexes=self.indexes)
+
+
+	def CountItems(self, criteria, exclude=None):
+		'''
+			Count the items matching every criterion and no exclusion, straight from the bitmap indexes.
+			(see items.Items.countItemsByAttributes)
+
+				:param criteria: {field:value or list of values}
+				:param exclude: {field:value or list of values} to leave out.
+		'''
+		return self.indexes['items'].countItemsByAttributes(criteria, exclude)
 
 
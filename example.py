@@ -3,16 +3,18 @@
 import datetime
 import items
 import listings
+import listingstore
 import sys
 import time
 
 
-def logItemData(item, poll_interval=30):
+def logItemData(item, poll_interval=30, store=None):
 	'''
 		This function indefinitely polls the API for a certain items listing data and logs it.
 
 			:param item: The item to gather data on
 			:param poll_interval: The number of seconds between polls
+			:param store: A listingstore.ListingStore to record samples in, rather than item_data.log.
 	'''
 	l = listings.Listings()
 	
@@ -40,8 +42,11 @@ def logItemData(item, poll_interval=30):
 				+ " buy_volume: " + str(item_listing.buy_volume) + " sell_volume: " + str(item_listing.sell_volume) + '\n'
 	
 			print(item_data)
-			with open("item_data.log", 'a') as f:
-				f.write(item_data)
+			if store is not None:
+				store.append([item_listing])
+			else:
+				with open("item_data.log", 'a') as f:
+					f.write(item_data)
 		else:
 			time.sleep(int(poll_interval - delta))
 
@@ -88,8 +93,9 @@ if __name__ == "__main__":
 
 	if "log" in sys.argv:
 		i = items.Items()
-		i.getAllItems()
-		logItemData(i.searchItemsByName('tiny', 'snowflake')[0])
+		i.loadSnapshotOrGetAllItems("items.snapshot")
+		with listingstore.ListingStore("item_data.store") as store:
+			logItemData(i.searchItemsByName('tiny', 'snowflake')[0], store=store)
 	elif "alert" in sys.argv:
 		def foundItemsCallback(new_items):
 			found_string = "\nFOUND ITEMS:\n"
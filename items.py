@@ -1,33 +1,192 @@
+import bitmapindex
+import changejournal
+import itemsnapshot
+import json
+import os
+import struct
+import sys
+import textindex
 import util
 import time
 
-class ItemDetails:
+
+# Shared copies of repeated lists of strings (flags, game_types...), keyed by their contents.
+_shared_string_tuples = {}
+
+def _compact(value):
 	'''
-		Item details, contains context specific information about the item.
+		NOTE: INTERNAL FUNCTION
+		A compact equivalent of a raw API value: strings are interned, lists of strings become
+		shared tuples, and other lists and dicts are compacted throughout.
+	'''
+	value_type = type(value)
+	if value_type is str:
+		return sys.intern(value)
+	if value_type is list:
+		try:
+			shared = _shared_string_tuples.get(tuple(value))
+		except TypeError: # Unhashable elements, so not a list of strings.
+			shared = None
+		if shared is not None:
+			return shared
+		if all(type(element) is str for element in value):
+			shared = tuple(sys.intern(element) for element in value)
+			return _shared_string_tuples.setdefault(shared, shared)
+		return [_compact(element) for element in value]
+	if value_type is dict:
+		return {sys.intern(key):_compact(element) for key, element in value.items()}
+	return value
+
+
+def _expand(value):
+	'''
+		NOTE: INTERNAL FUNCTION
+		The raw API value a compacted one came from.
+	'''
+	if isinstance(value, _CompactRecord):
+		return value._dir
+	if isinstance(value, (tuple, list)):
+		return [_expand(element) for element in value]
+	if isinstance(value, dict):
+		return {key:_expand(element) for key, element in value.items()}
+	return value
+
+
+class _CompactRecord:
 	'''
-	def __init__(self, item_dir = {}):
-		self._dir = item_dir
-		util._setAttrsFromDir(self, item_dir)
+		NOTE: INTERNAL CLASS
+		Base for compactly stored API records.  Fields in the class' known schema (_fields) live in
+		__slots__, anything else in an overflow dict, and values are compacted (see _compact.)
+		The raw dict (_dir) isn't kept, but rebuilt whenever it's asked for.
+	'''
+	__slots__ = ('_extra',)
+	_fields = ()
+	_slot_names = frozenset(('_extra',))
+	_record_fields = {} # field:class, for fields that are records of their own (e.g. an item's details.)
+
+	def __init__(self, raw_dir = {}):
+		extra = None
+		slot_names = self._slot_names
+		record_fields = self._record_fields
+		set_slot = object.__setattr__
+		for field, value in raw_dir.items():
+			if field in record_fields and type(value) is dict:
+				value = record_fields[field](value)
+			else:
+				value = _compact(value)
+
+			if field in slot_names:
+				set_slot(self, field, value)
+			else:
+				if extra is None:
+					extra = {}
+				extra[sys.intern(field)] = value
+		set_slot(self, '_extra', extra)
+
+
+	def __getattr__(self, name):
+		# Only reached for fields outside the schema, and schema fields this record doesn't have.
+		if name != '_extra':
+			extra = self._extra
+			if extra is not None and name in extra:
+				return extra[name]
+		raise AttributeError(name)
+
+
+	def __setattr__(self, name, value):
+		if name in self._slot_names:
+			object.__setattr__(self, name, value)
+			return
+		if self._extra is None:
+			object.__setattr__(self, '_extra', {})
+		self._extra[name] = value
+
+
+	def __getstate__(self):
+		# Values as stored, so unpickling (e.g. of items parsed on util's parse processes) needn't compact them again.
+		values = []
+		for field in self._fields:
+			try:
+				values.append((field, object.__getattribute__(self, field)))
+			except AttributeError:
+				pass
+		return (values, self._extra)
+
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# A raw dict, as older pickles hold.
+			self.__init__(state)
+			return
+
+		values, extra = state
+		set_slot = object.__setattr__
+		for field, value in values:
+			# Strings and string tuples come out of a pickle as fresh copies; share them again.
+			value_type = type(value)
+			if value_type is str:
+				value = sys.intern(value)
+			elif value_type is tuple:
+				shared = _shared_string_tuples.get(value)
+				if shared is None:
+					shared = tuple(sys.intern(element) for element in value)
+					shared = _shared_string_tuples.setdefault(shared, shared)
+				value = shared
+			set_slot(self, field, value)
+		set_slot(self, '_extra', extra)
+
+
+	@property
+	def _dir(self):
+		raw_dir = {}
+		for field in self._fields:
+			try:
+				raw_dir[field] = _expand(object.__getattribute__(self, field))
+			except AttributeError:
+				pass
+		if self._extra:
+			for field, value in self._extra.items():
+				raw_dir[field] = _expand(value)
+		return raw_dir
+
 
 	def __str__(self):
 		return str(self._dir)
 
 
-class Item:
+class ItemDetails(_CompactRecord):
+	'''
+		Item details, contains context specific information about the item.
+	'''
+	# The fields most item types' details have; the rest go in the overflow dict.
+	_fields = ('type', 'weight_class', 'defense', 'damage_type', 'min_power', 'max_power', 'infusion_slots', \
+		'attribute_adjustment', 'infix_upgrade', 'suffix_item_id', 'secondary_suffix_item_id', 'stat_choices', \
+		'flags', 'infusion_upgrade_flags', 'description', 'duration_ms', 'unlock_type', 'recipe_id', 'charges', \
+		'size', 'bonuses')
+	__slots__ = _fields
+	_slot_names = frozenset(_fields + ('_extra',))
+
+
+class Item(_CompactRecord):
 	'''
 		Primary item object.  Contains data about the item, as well as a potential item.details metadata object.
+		Strings are interned and lists of strings (e.g. flags) are shared tuples, so a full catalog stays small.
 	'''
-	def __init__(self, item_dir = {}):
-		self._dir = item_dir
-		util._setAttrsFromDir(self, item_dir)
-		
-		try:
-			self.details = ItemDetails(self.details)
-		except AttributeError:
-			pass
+	_fields = ('id', 'chat_link', 'name', 'icon', 'description', 'type', 'rarity', 'level', 'vendor_value', \
+		'default_skin', 'flags', 'game_types', 'restrictions', 'upgrades_into', 'upgrades_from', 'details')
+	__slots__ = _fields
+	_slot_names = frozenset(_fields + ('_extra',))
+	_record_fields = {'details':ItemDetails}
 
-	def __str__(self):
-		return str(self._dir)
+
+def parseItems(body):
+	'''
+		Item objects for a raw /v2/items?ids= response body.  Run on util's parse processes for large
+		fetches (see util.setParseProcesses), so it has to stay a module level function.
+
+			:param body: The response body, as bytes.
+	'''
+	return [Item(raw_item) for raw_item in json.loads(body)]
 
 
 #TODO: NEED to make cached vs uncached versions of the calls.
@@ -35,9 +194,27 @@ class Items:
 	'''
 		Primary items object, use this to query the items API.
 	'''
-	def __init__(self, items = []):
+	# Categorical fields kept in bitmap indexes, for searchItemsByAttributes.
+	attribute_fields = ('type', 'rarity', 'level', 'flags', 'details.type')
+
+	def __init__(self, items = [], index_descriptions=False, journal=None):
+		'''
+			Initialize the items object, optionally with some items already indexed.
+
+				:param items: Item objects to start with.
+				:param index_descriptions: If true, searches on description use a text index too, not just name.
+				:param journal: A changejournal.ChangeJournal for sync to record changes in; a new in memory one if None.
+		'''
 		self.items = {}
-		self.name_index = {}
+		self.tombstones = {} # id:item, for items sync found removed from the API
+		self.journal = journal if journal is not None else changejournal.ChangeJournal()
+		self._recheck_position = 0 # where the next sync's recheck slice starts, in id order
+		self.name_index = {} # name:list of items with that name, oldest first
+		self.attribute_index = bitmapindex.BitmapIndex(self.attribute_fields)
+
+		# field:TextIndex, built on the first search of each field. (see textindex)
+		self.text_index_fields = ('name', 'description') if index_descriptions else ('name',)
+		self.text_indexes = {}
 
 		for item in items:
 			self._indexItem(item)
@@ -47,18 +224,88 @@ class Items:
 		'''
 			Populate this object with all existant listings.
 		'''
-		return self.getItemsById(self.getAllIds(), use_cache)
+		return util.runSync(self.getAllItemsAsync(use_cache))
+
+
+	async def getAllItemsAsync(self, use_cache=False):
+		'''
+			Awaitable version of getAllItems.
+		'''
+		return await self.getItemsByIdAsync(await self.getAllIdsAsync(), use_cache)
+
+
+	def sync(self, recheck_count=0, keep_tombstones=True):
+		'''
+			Bring this object up to date with the API for a few requests, rather than refetching every item:
+			the id list is diffed against the items held, and only new ids are fetched.  Items no longer
+			listed are dropped (and kept in tombstones if asked.)  Every change is appended to journal.
+			Returns the journal entries for this sync.
+
+				:param recheck_count: Also refetch this many held items, a different slice each sync (cycling
+					through them all in id order), and record any whose fields have changed.
+				:param keep_tombstones: If true, removed items stay available in tombstones.
+		'''
+		return util.runSync(self.syncAsync(recheck_count, keep_tombstones))
+
+
+	async def syncAsync(self, recheck_count=0, keep_tombstones=True):
+		'''
+			Awaitable version of sync.
+		'''
+		live_ids = set(await self.getAllIdsAsync())
+		held_ids = sorted(self.items)
+
+		added_ids = sorted(live_ids.difference(held_ids))
+		removed_ids = [item_id for item_id in held_ids if item_id not in live_ids]
+
+		recheck_ids = []
+		still_held = [item_id for item_id in held_ids if item_id in live_ids]
+		if recheck_count and still_held:
+			start = self._recheck_position % len(still_held)
+			recheck_ids = (still_held[start:] + still_held[:start])[:recheck_count]
+			self._recheck_position = start + len(recheck_ids)
+
+		changes = []
+		for item_id in removed_ids:
+			item = self._unindexItem(item_id)
+			if keep_tombstones:
+				self.tombstones[item_id] = item
+			changes.append((changejournal.REMOVED, item_id, item._dir))
+
+		if added_ids or recheck_ids:
+			old_records = {item_id:self.items[item_id]._dir for item_id in recheck_ids}
+			for raw_item in await util.asyncCoalescedIdListApiCall('/v2/items?ids=', added_ids + recheck_ids):
+				item = self._indexItem(Item(raw_item))
+				item_id = item.id
+				if item_id in old_records:
+					if item._dir != old_records[item_id]:
+						changes.append((changejournal.CHANGED, item_id, item._dir))
+				else:
+					self.tombstones.pop(item_id, None)
+					changes.append((changejournal.ADDED, item_id, item._dir))
+
+		return self.journal.extend(changes)
 
 
 	def getItemByName(self, name):
 		'''
 			Get the item for a given name.  Requires this object to exist.
 			(e.g. getItemByID must have been called; if you don't know the ID,
-			getAllItems)
+			getAllItems)  If several items share the name, the last one indexed.
+			(see getItemsByName)
 
 				:param item_id: the item ID to query for.
 		'''
-		return self.name_index[name]
+		return self.name_index[name][-1]
+
+
+	def getItemsByName(self, name):
+		'''
+			Get every indexed item with exactly the given name.  (Many items share names.)
+
+				:param name: the name to look for.
+		'''
+		return list(self.name_index.get(name, []))
 
 
 	def getItemById(self, item_id, use_cache=False):
@@ -70,12 +317,30 @@ class Items:
 		return self.getItemsById([item_id], use_cache)[0]
 
 
+	async def getItemByIdAsync(self, item_id, use_cache=False):
+		'''
+			Awaitable version of getItemById.
+		'''
+		return (await self.getItemsByIdAsync([item_id], use_cache))[0]
+
+
 	def getItemsById(self, item_ids, use_cache=False):
 		'''
 			Populate this object with the items for a list of IDs
 
 				:param item_ids: The list of IDs to query for.
 		'''
+		return util.runSync(self.getItemsByIdAsync(item_ids, use_cache))
+
+
+	async def getItemsByIdAsync(self, item_ids, use_cache=False):
+		'''
+			Awaitable version of getItemsById.  Many of these can share one event loop;
+			the requests they make are bounded by util.setFetchConcurrency, and are shared
+			with any other callers after the same ids at the same time. (see util.SingleFlight)
+
+				:param item_ids: The list of IDs to query for.
+		'''
 		# This section handles getting any cached entries, and pruning the query id list if so
 		cached_results = []
 		if use_cache:
@@ -84,8 +349,12 @@ class Items:
 			item_ids = list(set(item_ids) - set(cached_ids))
 
 		# This gets any ids left in the item_ids list from the api.
-		if item_ids:
-			raw_items = util.idListApiCall('/v2/items?ids=', item_ids)
+		if item_ids and util.parse_processes and len(item_ids) >= util.parse_min_ids:
+			# Big fetches are parsed into Item objects on the parse processes.
+			for item in await util.asyncParsedIdListApiCall('/v2/items?ids=', item_ids, parseItems):
+				self._indexItem(item)
+		elif item_ids:
+			raw_items = await util.asyncCoalescedIdListApiCall('/v2/items?ids=', item_ids)
 
 			for raw_item in raw_items:
 				self._indexItem(Item(raw_item))
@@ -94,6 +363,36 @@ class Items:
 		return cached_results + [self.items[int(item_id)] for item_id in item_ids if int(item_id) in self.items]
 		
 
+	def iterAllItems(self, use_cache=False, index=False):
+		'''
+			Generator version of getAllItems; see iterItemsById.
+		'''
+		return self.iterItemsById(self.getAllIds(), use_cache, index)
+
+
+	def iterItemsById(self, item_ids, use_cache=False, index=False):
+		'''
+			Generator version of getItemsById.  Yields item objects batch by batch as each response
+			arrives, holding only a few batches in memory at once.  Results are not in id order.
+
+				:param item_ids: The list of IDs to query for.
+				:param use_cache: If true, yield already indexed items first rather than refetching them.
+				:param index: If true, also index the items into this object (which then holds all of them.)
+		'''
+		if use_cache:
+			cached_ids = [item_id for item_id in item_ids if int(item_id) in self.items]
+			for item_id in cached_ids:
+				yield self.items[int(item_id)]
+			item_ids = list(set(item_ids) - set(cached_ids))
+
+		for raw_items in util.iterIdListApiCall('/v2/items?ids=', item_ids):
+			for raw_item in raw_items:
+				item = Item(raw_item)
+				if index:
+					self._indexItem(item)
+				yield item
+
+
 	def getAllIds(self):
 		'''
 			Returns a list of all numerical item IDs
@@ -101,6 +400,57 @@ class Items:
 		return util.getAllIds('/v2/items')
 
 
+	async def getAllIdsAsync(self):
+		'''
+			Awaitable version of getAllIds.
+		'''
+		return await util.asyncGetAllIds('/v2/items')
+
+
+	def saveSnapshot(self, path):
+		'''
+			Save every item in this object to a compact binary snapshot (see the itemsnapshot module)
+			that loadSnapshot can map back in almost instantly.
+
+				:param path: The file to write.
+		'''
+		itemsnapshot.writeSnapshot(path, [item._dir for item in self.items.values()])
+
+
+	def loadSnapshot(self, path):
+		'''
+			Back this object with a snapshot written by saveSnapshot, replacing whatever it held.
+			The snapshot is memory mapped, and items are only decoded when they're looked up.
+			Items indexed afterwards (e.g. by getItemsById) take precedence over the snapshot's.
+
+				:param path: The snapshot file to load.
+		'''
+		snapshot = itemsnapshot.ItemSnapshot(path)
+		self.items = itemsnapshot.SnapshotItemMap(snapshot, Item)
+		self.name_index = itemsnapshot.SnapshotNameMap(snapshot, self.items)
+		self.text_indexes = {}
+		# Built on the first attribute search, since it needs every item decoded.
+		self.attribute_index = None
+
+
+	def loadSnapshotOrGetAllItems(self, path):
+		'''
+			Load the snapshot at path if there is one; otherwise get all items and save them there
+			for next time.
+
+				:param path: The snapshot file to use.
+		'''
+		if os.path.exists(path):
+			try:
+				self.loadSnapshot(path)
+				return
+			except (ValueError, OSError, struct.error) as e:
+				util.logger.error("Ignoring unusable item snapshot: " + str(e))
+
+		self.getAllItems()
+		self.saveSnapshot(path)
+
+
 	def _indexItem(self, item_object):
 		'''
 			NOTE: INTERNAL FUNCTION.
@@ -111,15 +461,145 @@ class Items:
 		try:
 			id = item_object.id
 			name = item_object.name
-			self.items[id] = item_object
-			self.name_index[name] = item_object
-		except AttributeException as e:
-			pass
-			
+		except AttributeError as e:
+			return item_object
+
+		# Replacing an item (e.g. on refetch) replaces it under its name, and drops it from its old name.
+		old_item = self.items.get(id)
+		if old_item is not None and getattr(old_item, 'name', None) != name:
+			self._removeFromNameIndex(old_item.name, id)
+		self.items[id] = item_object
+		self.name_index[name] = [other for other in self.name_index.get(name, []) if other.id != id] + [item_object]
+
+		for field, text_index in self.text_indexes.items():
+			text_index.add(id, getattr(item_object, field, None))
+		if self.attribute_index is not None:
+			self.attribute_index.add(item_object)
 
 		return item_object
 
 		
+	def _unindexItem(self, item_id):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			Drop an item from this object and all its indexes, returning it.
+
+				:param item_id: the id of the item to drop.
+		'''
+		item_object = self.items[item_id]
+		del self.items[item_id]
+		self._removeFromNameIndex(getattr(item_object, 'name', None), item_id)
+
+		for text_index in self.text_indexes.values():
+			text_index.remove(item_id)
+		if self.attribute_index is not None:
+			self.attribute_index.remove(item_id)
+
+		return item_object
+
+
+	def _removeFromNameIndex(self, name, item_id):
+		'''
+			NOTE: INTERNAL FUNCTION.
+		'''
+		items_with_name = [other for other in self.name_index.get(name, []) if other.id != item_id]
+		if items_with_name:
+			self.name_index[name] = items_with_name
+		elif name in self.name_index:
+			del self.name_index[name]
+
+
+	def _getTextIndex(self, field):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			The text index for a field, building it from every item on first use.  None if the field isn't indexed.
+		'''
+		if field not in self.text_index_fields:
+			return None
+		text_index = self.text_indexes.get(field)
+		if text_index is None:
+			text_index = textindex.TextIndex()
+			if field == 'name' and isinstance(self.items, itemsnapshot.SnapshotItemMap):
+				# Names come straight out of the snapshot, without decoding every item.
+				for item_id, name in self.items.names():
+					text_index.add(item_id, name)
+			else:
+				for item_id, item in self.items.items():
+					text_index.add(item_id, getattr(item, field, None))
+			self.text_indexes[field] = text_index
+		return text_index
+
+
+	def _getAttributeIndex(self):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			The bitmap index of attribute_fields, building it from every item if need be.
+		'''
+		if self.attribute_index is None:
+			attribute_index = bitmapindex.BitmapIndex(self.attribute_fields)
+			for item in self.items.values():
+				attribute_index.add(item)
+			self.attribute_index = attribute_index
+		return self.attribute_index
+
+
+	def getItemIdsByAttributes(self, criteria, exclude=None):
+		'''
+			Get the ids of the items matching every criterion and no exclusion, ascending.  Answered from
+			bitmap indexes for attribute_fields; any other field is checked item by item among the matches.
+
+				:param criteria: {field:value or list of values}, a list meaning any of them, and a list field
+					(e.g. flags) matching if it holds any of them. (e.g. {'rarity':'Exotic', 'type':'Weapon', 'level':80})
+				:param exclude: {field:value or list of values} for items to leave out. (e.g. {'flags':'AccountBound'})
+		'''
+		exclude = exclude or {}
+		attribute_index = self._getAttributeIndex()
+		indexed_criteria = {field:values for field, values in criteria.items() if field in attribute_index.fields}
+		indexed_exclude = {field:values for field, values in exclude.items() if field in attribute_index.fields}
+		item_ids = attribute_index.ids(indexed_criteria, indexed_exclude)
+
+		other_criteria = {field:values for field, values in criteria.items() if field not in indexed_criteria}
+		other_exclude = {field:values for field, values in exclude.items() if field not in indexed_exclude}
+		if other_criteria or other_exclude:
+			item_ids = [item_id for item_id in item_ids if bitmapindex.matches(self.items[item_id], other_criteria, other_exclude)]
+		return item_ids
+
+
+	def searchItemsByAttributes(self, criteria, exclude=None):
+		'''
+			Get the items matching every criterion and no exclusion, in id order. (see getItemIdsByAttributes)
+
+				:param criteria: {field:value or list of values}
+				:param exclude: {field:value or list of values} for items to leave out.
+		'''
+		return [self.items[item_id] for item_id in self.getItemIdsByAttributes(criteria, exclude)]
+
+
+	def countItemsByAttributes(self, criteria, exclude=None):
+		'''
+			Count the items matching every criterion and no exclusion, without looking at any item objects
+			when only attribute_fields are used. (see getItemIdsByAttributes)
+
+				:param criteria: {field:value or list of values}
+				:param exclude: {field:value or list of values} for items to leave out.
+		'''
+		attribute_index = self._getAttributeIndex()
+		if all(field in attribute_index.fields for field in list(criteria) + list(exclude or {})):
+			return attribute_index.count(criteria, exclude)
+		return len(self.getItemIdsByAttributes(criteria, exclude))
+
+
+	def fuzzySearchItemsByName(self, name, limit=10, min_similarity=0.3):
+		'''
+			Get the items whose names are most like the given one, best first, tolerating typos.
+
+				:param name: The name (or part of one) to look for.
+				:param limit: The most items to return.
+				:param min_similarity: How alike names must be, from 0 to 1. (see textindex.TextIndex.fuzzySearch)
+		'''
+		return [self.items[item_id] for similarity, item_id in self._getTextIndex('name').fuzzySearch(name, limit, min_similarity)]
+
+
 	def searchItemsByName(self, *search_terms):
 		'''
 			Get all items that contain the case insensitive terms given as arguments.
@@ -136,6 +616,10 @@ class Items:
 
 				:param search_terms: The terms to search for. (e.g. searchItemByField('name', 'tiny', 'snowflake'))
 		'''
+		text_index = self._getTextIndex(field)
+		if text_index is not None and search_terms:
+			return [self.items[item_id] for item_id in sorted(text_index.search(*search_terms))]
+
 		found_items = []
 		for item in self.items.values():
 			if all(search_term.lower() in getattr(item, field).lower() for search_term in search_terms):
@@ -0,0 +1,460 @@
+'''
+	Compact, memory mapped snapshots of an item catalog, so processes can start with a full
+	catalog without re-downloading it.  Items are only decoded when they're looked up, and several
+	processes mapping the same file share its pages.
+
+	File layout (all little endian):
+		header
+		record table: one fixed size record per item, sorted by id
+		string table: offsets (count + 1 of them) followed by the utf-8 string data
+		id index: (id, record number) pairs sorted by id
+		name index: record numbers sorted by name
+
+	Strings are stored once no matter how many items use them; list/dict fields (flags, details, ...)
+	are stored as json strings, so identical flag lists are shared too.
+'''
+
+import collections.abc
+import json
+import mmap
+import os
+import struct
+
+
+MAGIC = b'GW2ITEMS'
+VERSION = 1
+
+# magic, version, record count, string count, then the offsets of the record table,
+# string offsets, string data, id index and name index.
+HEADER = struct.Struct('<8sIII5Q')
+
+# Numeric fields stored inline; a bit in the presence mask says whether each was there at all.
+NUMERIC_FIELDS = ('level', 'vendor_value', 'default_skin')
+# Fields stored as references into the string table.
+STRING_FIELDS = ('name', 'description', 'type', 'rarity', 'chat_link', 'icon')
+# Fields stored as references to json strings in the string table.
+JSON_FIELDS = ('flags', 'game_types', 'restrictions', 'details')
+
+# id, presence mask, numeric fields, string/json field refs, then a ref to json of any other fields.
+RECORD = struct.Struct('<IH' + 'q' * len(NUMERIC_FIELDS) + 'I' * (len(STRING_FIELDS) + len(JSON_FIELDS) + 1))
+ID_INDEX_ENTRY = struct.Struct('<II')
+NAME_INDEX_ENTRY = struct.Struct('<I')
+STRING_OFFSET = struct.Struct('<Q')
+# Where the name's string ref sits within a record.
+NAME_REF_OFFSET = struct.calcsize('<IH' + 'q' * len(NUMERIC_FIELDS))
+
+NO_STRING = 0xFFFFFFFF
+
+
+def writeSnapshot(path, raw_items):
+	'''
+		Write a snapshot of raw item dicts (as returned by the API) to a file.
+		The file is written to a temporary name first, then moved into place.
+
+			:param path: The file to write.
+			:param raw_items: Iterable of item dicts.
+	'''
+	strings = []
+	string_refs = {}
+
+	def stringRef(value):
+		if value is None:
+			return NO_STRING
+		if value not in string_refs:
+			string_refs[value] = len(strings)
+			strings.append(value)
+		return string_refs[value]
+
+	def jsonRef(value):
+		if value is None:
+			return NO_STRING
+		return stringRef(json.dumps(value, sort_keys=True, separators=(',', ':')))
+
+	raw_items = sorted(raw_items, key=lambda raw_item: raw_item['id'])
+
+	records = bytearray()
+	for raw_item in raw_items:
+		extra = dict(raw_item)
+		del extra['id']
+
+		presence = 0
+		numbers = []
+		for bit, field in enumerate(NUMERIC_FIELDS):
+			value = extra.get(field)
+			if isinstance(value, int) and not isinstance(value, bool):
+				presence |= 1 << bit
+				numbers.append(value)
+				del extra[field]
+			else:
+				numbers.append(0)
+
+		refs = []
+		for field in STRING_FIELDS:
+			value = extra.get(field)
+			if isinstance(value, str):
+				refs.append(stringRef(value))
+				del extra[field]
+			else:
+				refs.append(NO_STRING)
+
+		for field in JSON_FIELDS:
+			refs.append(jsonRef(extra.pop(field, None)))
+
+		# Anything we don't know the schema of just rides along as json.
+		refs.append(jsonRef(extra or None))
+
+		records += RECORD.pack(raw_item['id'], presence, *(numbers + refs))
+
+	encoded_strings = [string.encode() for string in strings]
+	string_offsets = bytearray()
+	offset = 0
+	for encoded_string in encoded_strings:
+		string_offsets += STRING_OFFSET.pack(offset)
+		offset += len(encoded_string)
+	string_offsets += STRING_OFFSET.pack(offset)
+	string_data = b''.join(encoded_strings)
+
+	id_index = b''.join(ID_INDEX_ENTRY.pack(raw_item['id'], record_number) for record_number, raw_item in enumerate(raw_items))
+
+	def nameKey(record_number):
+		name = raw_items[record_number].get('name')
+		return (name.encode() if isinstance(name, str) else b'', raw_items[record_number]['id'])
+
+	name_order = sorted(range(len(raw_items)), key=nameKey)
+	name_index = b''.join(NAME_INDEX_ENTRY.pack(record_number) for record_number in name_order)
+
+	records_offset = HEADER.size
+	string_offsets_offset = records_offset + len(records)
+	string_data_offset = string_offsets_offset + len(string_offsets)
+	id_index_offset = string_data_offset + len(string_data)
+	name_index_offset = id_index_offset + len(id_index)
+
+	header = HEADER.pack(MAGIC, VERSION, len(raw_items), len(strings), \
+			records_offset, string_offsets_offset, string_data_offset, id_index_offset, name_index_offset)
+
+	with open(path + ".tmp", 'wb') as f:
+		for section in (header, records, string_offsets, string_data, id_index, name_index):
+			f.write(section)
+	os.replace(path + ".tmp", path)
+
+
+class ItemSnapshot:
+	'''
+		A read only, memory mapped item snapshot.  Looks items up by id or name via binary search
+		over the indexes, and decodes only the records that are asked for.
+	'''
+	def __init__(self, path):
+		'''
+			Open a snapshot written by writeSnapshot.
+
+				:param path: The snapshot file.
+		'''
+		self.path = path
+
+		with open(path, 'rb') as f:
+			self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if len(self._map) < HEADER.size:
+			self._map.close()
+			raise ValueError("Truncated item snapshot: " + str(path))
+
+		magic, version, self.record_count, self.string_count, \
+			self._records_offset, self._string_offsets_offset, self._string_data_offset, \
+			self._id_index_offset, self._name_index_offset = HEADER.unpack_from(self._map, 0)
+
+		if magic != MAGIC or version != VERSION:
+			self._map.close()
+			raise ValueError("Not an item snapshot (or an incompatible version): " + str(path))
+
+		if not self._sectionsFit():
+			self._map.close()
+			raise ValueError("Truncated or corrupt item snapshot: " + str(path))
+
+
+	def _sectionsFit(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Whether every section is where the header says, the size its counts say, and the file holds them all.
+		'''
+		if self._records_offset != HEADER.size \
+				or self._string_offsets_offset != self._records_offset + self.record_count * RECORD.size \
+				or self._string_data_offset != self._string_offsets_offset + (self.string_count + 1) * STRING_OFFSET.size \
+				or self._string_data_offset > len(self._map):
+			return False
+
+		string_data_size, = STRING_OFFSET.unpack_from(self._map, self._string_data_offset - STRING_OFFSET.size)
+		return self._id_index_offset == self._string_data_offset + string_data_size \
+			and self._name_index_offset == self._id_index_offset + self.record_count * ID_INDEX_ENTRY.size \
+			and len(self._map) == self._name_index_offset + self.record_count * NAME_INDEX_ENTRY.size
+
+
+	def __len__(self):
+		return self.record_count
+
+
+	def close(self):
+		'''
+			Unmap the snapshot.  Items already decoded stay usable.
+		'''
+		self._map.close()
+
+
+	def _string(self, ref):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Decode one entry of the string table.
+		'''
+		start, = STRING_OFFSET.unpack_from(self._map, self._string_offsets_offset + ref * STRING_OFFSET.size)
+		end, = STRING_OFFSET.unpack_from(self._map, self._string_offsets_offset + (ref + 1) * STRING_OFFSET.size)
+		return self._map[self._string_data_offset + start : self._string_data_offset + end].decode()
+
+
+	def _nameBytes(self, record_number):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The raw name of a record, for comparisons during binary search.
+		'''
+		ref, = struct.unpack_from('<I', self._map, self._records_offset + record_number * RECORD.size + NAME_REF_OFFSET)
+		if ref == NO_STRING:
+			return b''
+		start, end = struct.unpack_from('<QQ', self._map, self._string_offsets_offset + ref * STRING_OFFSET.size)
+		return self._map[self._string_data_offset + start : self._string_data_offset + end]
+
+
+	def _recordId(self, record_number):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		item_id, = struct.unpack_from('<I', self._map, self._records_offset + record_number * RECORD.size)
+		return item_id
+
+
+	def decodeRecord(self, record_number):
+		'''
+			Rebuild the raw item dict for a record.
+
+				:param record_number: The record to decode.
+		'''
+		values = RECORD.unpack_from(self._map, self._records_offset + record_number * RECORD.size)
+		item_id, presence = values[0], values[1]
+		numbers = values[2 : 2 + len(NUMERIC_FIELDS)]
+		refs = values[2 + len(NUMERIC_FIELDS):]
+
+		raw_item = {"id":item_id}
+		for bit, field in enumerate(NUMERIC_FIELDS):
+			if presence & (1 << bit):
+				raw_item[field] = numbers[bit]
+
+		for field, ref in zip(STRING_FIELDS, refs):
+			if ref != NO_STRING:
+				raw_item[field] = self._string(ref)
+
+		for field, ref in zip(JSON_FIELDS, refs[len(STRING_FIELDS):]):
+			if ref != NO_STRING:
+				raw_item[field] = json.loads(self._string(ref))
+
+		if refs[-1] != NO_STRING:
+			raw_item.update(json.loads(self._string(refs[-1])))
+
+		return raw_item
+
+
+	def findRecord(self, item_id):
+		'''
+			Binary search the id index for an item.  Returns its record number, or None.
+
+				:param item_id: The item id to look for.
+		'''
+		low, high = 0, self.record_count
+		while low < high:
+			middle = (low + high) // 2
+			middle_id, record_number = ID_INDEX_ENTRY.unpack_from(self._map, self._id_index_offset + middle * ID_INDEX_ENTRY.size)
+			if middle_id < item_id:
+				low = middle + 1
+			elif middle_id > item_id:
+				high = middle
+			else:
+				return record_number
+
+		return None
+
+
+	def findRecordsByName(self, name):
+		'''
+			Binary search the name index.  Returns the record numbers of every item with exactly that name.
+
+				:param name: The name to look for.
+		'''
+		target = name.encode()
+
+		def nameAt(position):
+			record_number, = NAME_INDEX_ENTRY.unpack_from(self._map, self._name_index_offset + position * NAME_INDEX_ENTRY.size)
+			return record_number, self._nameBytes(record_number)
+
+		low, high = 0, self.record_count
+		while low < high:
+			middle = (low + high) // 2
+			if nameAt(middle)[1] < target:
+				low = middle + 1
+			else:
+				high = middle
+
+		record_numbers = []
+		while low < self.record_count:
+			record_number, record_name = nameAt(low)
+			if record_name != target:
+				break
+			record_numbers.append(record_number)
+			low += 1
+
+		return record_numbers
+
+
+	def ids(self):
+		'''
+			Returns every item id in the snapshot, in order.
+		'''
+		return [self._recordId(record_number) for record_number in range(self.record_count)]
+
+
+class SnapshotItemMap(collections.abc.MutableMapping):
+	'''
+		The {id:Item} dict used by Items when it's backed by a snapshot.  Items are decoded from the
+		snapshot the first time they're looked up, then kept.  Anything indexed afterwards (e.g. fresh
+		fetches) overrides the snapshot's copy.
+	'''
+	def __init__(self, snapshot, item_class):
+		'''
+			:param snapshot: The ItemSnapshot to read from.
+			:param item_class: Called with a raw item dict to build each item object.
+		'''
+		self.snapshot = snapshot
+		self._item_class = item_class
+		self._loaded = {}
+		self._removed = set()
+
+
+	def __getitem__(self, item_id):
+		if item_id in self._loaded:
+			return self._loaded[item_id]
+
+		if item_id in self._removed or not isinstance(item_id, int):
+			raise KeyError(item_id)
+
+		record_number = self.snapshot.findRecord(item_id)
+		if record_number is None:
+			raise KeyError(item_id)
+
+		item = self._item_class(self.snapshot.decodeRecord(record_number))
+		self._loaded[item_id] = item
+		return item
+
+
+	def __contains__(self, item_id):
+		if item_id in self._loaded:
+			return True
+		if item_id in self._removed or not isinstance(item_id, int):
+			return False
+		return self.snapshot.findRecord(item_id) is not None
+
+
+	def __setitem__(self, item_id, item):
+		self._removed.discard(item_id)
+		self._loaded[item_id] = item
+
+
+	def __delitem__(self, item_id):
+		if item_id not in self:
+			raise KeyError(item_id)
+		self._loaded.pop(item_id, None)
+		self._removed.add(item_id)
+
+
+	def names(self):
+		'''
+			Yields (id, name) for every item, reading names of items not yet decoded straight from the snapshot.
+		'''
+		for record_number in range(self.snapshot.record_count):
+			item_id = self.snapshot._recordId(record_number)
+			if item_id in self._removed:
+				continue
+			if item_id in self._loaded:
+				yield item_id, getattr(self._loaded[item_id], 'name', None)
+			else:
+				yield item_id, bytes(self.snapshot._nameBytes(record_number)).decode() or None
+
+		for item_id, item in list(self._loaded.items()):
+			if item_id not in self._removed and self.snapshot.findRecord(item_id) is None:
+				yield item_id, getattr(item, 'name', None)
+
+
+	def __iter__(self):
+		for item_id in self.snapshot.ids():
+			if item_id not in self._removed:
+				yield item_id
+
+		for item_id in list(self._loaded):
+			if item_id not in self._removed and self.snapshot.findRecord(item_id) is None:
+				yield item_id
+
+
+	def __len__(self):
+		return sum(1 for item_id in self)
+
+
+class SnapshotNameMap(collections.abc.MutableMapping):
+	'''
+		The {name:list of Items} dict used by Items when it's backed by a snapshot, answered from the
+		snapshot's name index until something newer is indexed under a name.
+	'''
+	def __init__(self, snapshot, item_map):
+		'''
+			:param snapshot: The ItemSnapshot to read from.
+			:param item_map: The SnapshotItemMap the items themselves come from.
+		'''
+		self.snapshot = snapshot
+		self._item_map = item_map
+		self._names = {}
+
+
+	def __getitem__(self, name):
+		if name in self._names:
+			# An empty list hides a name that was deleted.
+			if not self._names[name]:
+				raise KeyError(name)
+			return self._names[name]
+
+		if isinstance(name, str):
+			items_with_name = []
+			for record_number in self.snapshot.findRecordsByName(name):
+				item_id = self.snapshot._recordId(record_number)
+				# Skip items since removed, or replaced by one with another name.
+				if item_id in self._item_map and getattr(self._item_map[item_id], 'name', None) == name:
+					items_with_name.append(self._item_map[item_id])
+			if items_with_name:
+				return items_with_name
+
+		raise KeyError(name)
+
+
+	def __setitem__(self, name, item):
+		self._names[name] = item
+
+
+	def __delitem__(self, name):
+		self[name]
+		self._names[name] = []
+
+
+	def __iter__(self):
+		seen = set(self._names)
+		yield from (name for name, items_with_name in self._names.items() if items_with_name)
+		for item_id in self._item_map:
+			name = getattr(self._item_map[item_id], 'name', None)
+			if name is not None and name not in seen:
+				seen.add(name)
+				yield name
+
+
+	def __len__(self):
+		return sum(1 for name in self)
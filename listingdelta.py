@@ -0,0 +1,283 @@
+'''
+	Order book deltas between successive listing snapshots.  Rather than re-scanning every listing
+	each poll, diff the old and new books into the price levels that were added, removed or resized,
+	so downstream consumers only do work proportional to what changed.
+
+	Either side of a diff can be an ItemListings object or a raw listing dict; whole markets can be
+	mappings of id to either (e.g. Listings.listings), or two market.MarketSnapshot objects.
+	Unchanged items are skipped by comparing fingerprints before any levels are looked at.
+'''
+
+import collections
+
+
+SIDES = ('buys', 'sells')
+
+
+class LevelChange(collections.namedtuple('LevelChange', 'item_id side unit_price old_quantity new_quantity old_listings new_listings')):
+	'''
+		One price level that changed on one side of an item's book.  A quantity of 0 means the level
+		wasn't there, so a level that appeared has old_quantity 0 and one that went has new_quantity 0.
+	'''
+	__slots__ = ()
+
+	@property
+	def kind(self):
+		'''
+			'added', 'removed' or 'resized'.
+		'''
+		if not self.old_quantity:
+			return 'added'
+		if not self.new_quantity:
+			return 'removed'
+		return 'resized'
+
+	@property
+	def quantity_delta(self):
+		return self.new_quantity - self.old_quantity
+
+
+class MarketDelta:
+	'''
+		The result of diffing two markets.
+	'''
+	def __init__(self):
+		self.changes = [] # LevelChange records, grouped by item.
+		self.new_ids = [] # Items only in the new market.
+		self.removed_ids = [] # Items only in the old market.
+		self.changed_ids = [] # Items in both whose books differ.
+		self.unchanged_count = 0 # Items skipped by fingerprint.
+
+
+	def byItem(self):
+		'''
+			Returns the changes as a dict of item id:list of LevelChange.
+		'''
+		changes_by_item = collections.defaultdict(list)
+		for change in self.changes:
+			changes_by_item[change.item_id].append(change)
+		return changes_by_item
+
+
+	def __len__(self):
+		return len(self.changes)
+
+
+	def __str__(self):
+		return str({"changes":len(self.changes), "new":len(self.new_ids), "removed":len(self.removed_ids), \
+			"changed":len(self.changed_ids), "unchanged":self.unchanged_count})
+
+
+def _rawListing(listing):
+	'''
+		NOTE: INTERNAL FUNCTION
+		The raw listing dict for an ItemListings object or a raw listing dict.
+	'''
+	if isinstance(listing, dict):
+		return listing
+	return listing._dir
+
+
+def _levels(raw_offers):
+	'''
+		NOTE: INTERNAL FUNCTION
+		(unit_price, quantity, listings) for each level, in ascending price order.  The API already
+		lists each side in price order (buys descending), which sorted() handles in linear time.
+	'''
+	return sorted((raw_offer["unit_price"], raw_offer["quantity"], raw_offer["listings"]) for raw_offer in raw_offers)
+
+
+def fingerprint(listing):
+	'''
+		A hash of an item's whole book; if two fingerprints differ, so do the books.
+		ItemListings objects work theirs out once and keep it.
+
+			:param listing: An ItemListings object or raw listing dict.
+	'''
+	if not isinstance(listing, dict):
+		return listing.fingerprint
+	return hash(tuple(tuple((raw_offer["unit_price"], raw_offer["quantity"], raw_offer["listings"]) for raw_offer in listing[side]) \
+		for side in SIDES))
+
+
+def _mergeLevels(item_id, side, old_levels, new_levels, changes):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Walk two price sorted level lists together once, appending a LevelChange for every level
+		that isn't the same in both.
+	'''
+	old_position = new_position = 0
+	old_count, new_count = len(old_levels), len(new_levels)
+
+	while old_position < old_count and new_position < new_count:
+		old_price, old_quantity, old_listings = old_levels[old_position]
+		new_price, new_quantity, new_listings = new_levels[new_position]
+
+		if old_price == new_price:
+			if old_quantity != new_quantity or old_listings != new_listings:
+				changes.append(LevelChange(item_id, side, old_price, old_quantity, new_quantity, old_listings, new_listings))
+			old_position += 1
+			new_position += 1
+		elif old_price < new_price:
+			changes.append(LevelChange(item_id, side, old_price, old_quantity, 0, old_listings, 0))
+			old_position += 1
+		else:
+			changes.append(LevelChange(item_id, side, new_price, 0, new_quantity, 0, new_listings))
+			new_position += 1
+
+	for old_price, old_quantity, old_listings in old_levels[old_position:]:
+		changes.append(LevelChange(item_id, side, old_price, old_quantity, 0, old_listings, 0))
+	for new_price, new_quantity, new_listings in new_levels[new_position:]:
+		changes.append(LevelChange(item_id, side, new_price, 0, new_quantity, 0, new_listings))
+
+
+def diffListings(old_listing, new_listing, changes=None):
+	'''
+		Diff two snapshots of one item's book.  Returns a list of LevelChange, buys then sells,
+		each in ascending price order.
+
+			:param old_listing: The earlier ItemListings or raw listing dict; None for an empty book.
+			:param new_listing: The later ItemListings or raw listing dict; None for an empty book.
+			:param changes: A list to append the changes to, instead of a new one.
+	'''
+	if changes is None:
+		changes = []
+
+	old_raw = _rawListing(old_listing) if old_listing is not None else None
+	new_raw = _rawListing(new_listing) if new_listing is not None else None
+	item_id = (new_raw or old_raw)["id"]
+
+	for side in SIDES:
+		old_levels = _levels(old_raw[side]) if old_raw is not None else []
+		new_levels = _levels(new_raw[side]) if new_raw is not None else []
+		_mergeLevels(item_id, side, old_levels, new_levels, changes)
+
+	return changes
+
+
+def diffMarkets(old_market, new_market):
+	'''
+		Diff two whole markets.  Returns a MarketDelta; an item only in one market is diffed against
+		an empty book, so all of its levels show up as added or removed.
+
+			:param old_market: The earlier market: a mapping of id:ItemListings/raw listing, or a MarketSnapshot.
+			:param new_market: The later market, of the same kind.
+	'''
+	if hasattr(old_market, "getFingerprints"):
+		return _diffSnapshots(old_market, new_market)
+
+	delta = MarketDelta()
+	for item_id, new_listing in new_market.items():
+		old_listing = old_market.get(item_id)
+		if old_listing is None:
+			delta.new_ids.append(item_id)
+		elif old_listing is new_listing or fingerprint(old_listing) == fingerprint(new_listing):
+			delta.unchanged_count += 1
+			continue
+		else:
+			delta.changed_ids.append(item_id)
+		diffListings(old_listing, new_listing, delta.changes)
+
+	for item_id, old_listing in old_market.items():
+		if item_id not in new_market:
+			delta.removed_ids.append(item_id)
+			diffListings(old_listing, None, delta.changes)
+
+	return delta
+
+
+def _snapshotLevels(snapshot, row, side):
+	'''
+		NOTE: INTERNAL FUNCTION
+		A snapshot row's levels on one side, as _levels would give them.
+	'''
+	if side == 'buys':
+		start, end = snapshot.buy_offsets[row], snapshot.buy_offsets[row + 1]
+		columns = (snapshot.buy_price, snapshot.buy_quantity, snapshot.buy_listings)
+	else:
+		start, end = snapshot.sell_offsets[row], snapshot.sell_offsets[row + 1]
+		columns = (snapshot.sell_price, snapshot.sell_quantity, snapshot.sell_listings)
+	return list(zip(*(column[start:end].tolist() for column in columns)))
+
+
+def _diffSnapshots(old_snapshot, new_snapshot):
+	'''
+		NOTE: INTERNAL FUNCTION
+		diffMarkets for two MarketSnapshots.  Both are sorted by id, so the rows are matched up with one
+		merge, and fingerprints of every row are compared at once before merging the changed rows' levels.
+	'''
+	delta = MarketDelta()
+	old_fingerprints = old_snapshot.getFingerprints().tolist()
+	new_fingerprints = new_snapshot.getFingerprints().tolist()
+	old_ids, new_ids = old_snapshot.ids.tolist(), new_snapshot.ids.tolist()
+
+	def diffRows(item_id, old_row, new_row):
+		for side in SIDES:
+			old_levels = _snapshotLevels(old_snapshot, old_row, side) if old_row is not None else []
+			new_levels = _snapshotLevels(new_snapshot, new_row, side) if new_row is not None else []
+			_mergeLevels(item_id, side, old_levels, new_levels, delta.changes)
+
+	old_row = new_row = 0
+	while old_row < len(old_ids) or new_row < len(new_ids):
+		old_id = old_ids[old_row] if old_row < len(old_ids) else None
+		new_id = new_ids[new_row] if new_row < len(new_ids) else None
+
+		if old_id == new_id:
+			if old_fingerprints[old_row] == new_fingerprints[new_row]:
+				delta.unchanged_count += 1
+			else:
+				delta.changed_ids.append(new_id)
+				diffRows(new_id, old_row, new_row)
+			old_row += 1
+			new_row += 1
+		elif new_id is None or (old_id is not None and old_id < new_id):
+			delta.removed_ids.append(old_id)
+			diffRows(old_id, old_row, None)
+			old_row += 1
+		else:
+			delta.new_ids.append(new_id)
+			diffRows(new_id, None, new_row)
+			new_row += 1
+
+	return delta
+
+
+class DeltaTracker:
+	'''
+		Keeps the last book seen for each item, and turns each new batch of listings into the changes
+		since then.  Only the levels of items whose fingerprints moved are ever merged.
+	'''
+	def __init__(self):
+		self.fingerprints = {} # id:fingerprint of the last book seen
+		self.listings = {} # id:the last book seen (ItemListings or raw dict)
+
+
+	def update(self, listings):
+		'''
+			Record new listings for (some) items, returning the changes since each was last seen
+			as a list of LevelChange.  Items seen for the first time come back as all added levels.
+
+				:param listings: Iterable of ItemListings objects or raw listing dicts.
+		'''
+		changes = []
+		for listing in listings:
+			item_id = _rawListing(listing)["id"]
+			new_fingerprint = fingerprint(listing)
+			if self.fingerprints.get(item_id) == new_fingerprint:
+				continue
+
+			diffListings(self.listings.get(item_id), listing, changes)
+			self.fingerprints[item_id] = new_fingerprint
+			self.listings[item_id] = listing
+
+		return changes
+
+
+	def forget(self, item_id):
+		'''
+			Stop tracking an item.
+
+				:param item_id: The item to forget.
+		'''
+		self.fingerprints.pop(item_id, None)
+		self.listings.pop(item_id, None)
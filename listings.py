@@ -1,6 +1,13 @@
+import bisect
 import collections
+import functools
 defaultdict = collections.defaultdict
+import itertools
 import json
+import listingdelta
+import math
+import opportunities
+import sortedlist
 import util
 import threading
 import util
@@ -19,13 +26,89 @@ class Offer:
 		return str(self._dir)
 
 
+class BookSide:
+	'''
+		One side (buys or sells) of an item's order book, as prefix sums over its price levels in
+		ascending price order.  Quantity weighted quantiles and depth walks are then a binary search.
+	'''
+	def __init__(self, raw_offers=[], best_is_highest=False):
+		'''
+			:param raw_offers: The raw offer dicts on this side.
+			:param best_is_highest: True for buys, where the highest price is best; breaks ties in mode.
+		'''
+		levels = sorted((raw_offer["unit_price"], raw_offer["quantity"]) for raw_offer in raw_offers)
+		self.prices = [price for price, quantity in levels]
+		self.cumulative_quantity = list(itertools.accumulate(quantity for price, quantity in levels))
+		self.cumulative_value = list(itertools.accumulate(price * quantity for price, quantity in levels))
+
+		self.volume = self.cumulative_quantity[-1] if levels else 0
+		self.value = self.cumulative_value[-1] if levels else 0
+
+		#The mode is the price with the most units listed at it; ties go to the best price.
+		self.mode = None
+		if levels:
+			best_quantity = max(quantity for price, quantity in levels)
+			modes = [price for price, quantity in levels if quantity == best_quantity]
+			self.mode = modes[-1] if best_is_highest else modes[0]
+
+
+	def quantile(self, fraction):
+		'''
+			The price of the unit at a given fraction of the way up this side, counting every unit
+			(not every level) once.  None if the side is empty.
+
+				:param fraction: 0 for the lowest priced unit, 1 for the highest, .5 for the median.
+		'''
+		if not self.volume:
+			return None
+		rank = min(max(1, math.ceil(fraction * self.volume)), self.volume)
+		return self.prices[bisect.bisect_left(self.cumulative_quantity, rank)]
+
+
+	def valueOfLowest(self, quantity):
+		'''
+			The total price of the cheapest quantity units on this side, or None if there aren't that many.
+
+				:param quantity: Number of units.
+		'''
+		if quantity <= 0:
+			return 0
+		if quantity > self.volume:
+			return None
+		#The level the quantity'th unit is at; every level before it is taken whole.
+		level = bisect.bisect_left(self.cumulative_quantity, quantity)
+		if level == 0:
+			return quantity * self.prices[0]
+		return self.cumulative_value[level - 1] + (quantity - self.cumulative_quantity[level - 1]) * self.prices[level]
+
+
+	def valueOfHighest(self, quantity):
+		'''
+			The total price of the most expensive quantity units on this side, or None if there aren't that many.
+
+				:param quantity: Number of units.
+		'''
+		if quantity > self.volume:
+			return None
+		return self.value - self.valueOfLowest(self.volume - max(quantity, 0))
+
+
 class ItemListings:
 	'''
 		Contains all offer listings for a given item, as well as some data on them.
 		(mean_buy, max_buy, buy_volume, and the same for sell (except min->max))
 	'''
-	def __init__(self, listing_dir = {}):
+	def __init__(self, listing_dir = {}, lazy=False):
+		'''
+			:param listing_dir: The raw listing, as returned by the API.
+			:param lazy: If true, only keep the raw listing for now; Offer objects and each statistic
+				are made the first time they're read, then kept.
+		'''
 		self._dir = listing_dir
+		if lazy:
+			self.id = listing_dir["id"]
+			return
+
 		util._setAttrsFromDir(self, listing_dir)
 		
 		self.buy_volume = 0
@@ -89,12 +172,20 @@ class ItemListings:
 		if self.buy_volume > 0:
 			self.mean_buy /= self.buy_volume
 
-		#TODO: Calculate the medians.  remember that each listing has multiple quantity.
+		#Calculate the medians and modes, weighted by the quantity at each price.
+		self.buy_depth = BookSide(self._dir["buys"], best_is_highest=True)
+		self.sell_depth = BookSide(self._dir["sells"])
+
+		if self.buy_volume > 0:
+			self.median_buy = self.buy_depth.quantile(.5)
+			self.mode_buy = self.buy_depth.mode
+
+		if self.sell_volume > 0:
+			self.median_sell = self.sell_depth.quantile(.5)
+			self.mode_sell = self.sell_depth.mode
 
 		#Calculate the margin.
-		delta = self.min_sell - self.max_buy
-		fee = (self.min_sell - 1) * .15
-		self.margin = (delta - fee) / (self.max_buy + 1)
+		self.margin = self._margin()
 
 		#Calculate volume margin
 		self.volume_margin = float("inf")
@@ -102,17 +193,275 @@ class ItemListings:
 			self.volume_margin =  self.buy_volume / self.sell_volume 
 
 
+	@staticmethod
+	def _mean(raw_offers):
+		'''
+			NOTE: INTERNAL FUNCTION.
+		'''
+		volume = sum(raw_offer["quantity"] for raw_offer in raw_offers)
+		if not volume:
+			return 0
+		return sum(raw_offer["unit_price"] * raw_offer["quantity"] for raw_offer in raw_offers) / volume
+
+
+	def _margin(self):
+		'''
+			NOTE: INTERNAL FUNCTION.
+		'''
+		delta = self.min_sell - self.max_buy
+		fee = (self.min_sell - 1) * .15
+		return (delta - fee) / (self.max_buy + 1)
+
+
+	# How a lazy listing works out each attribute, from the raw listing, the first time it's read.
+	# These match what __init__ computes for a non lazy listing.
+	_lazy_attributes = {
+		"buys": lambda self: [Offer(raw_buy) for raw_buy in self._dir["buys"]],
+		"sells": lambda self: [Offer(raw_sell) for raw_sell in self._dir["sells"]],
+		"buy_volume": lambda self: sum(raw_buy["quantity"] for raw_buy in self._dir["buys"]),
+		"sell_volume": lambda self: sum(raw_sell["quantity"] for raw_sell in self._dir["sells"]),
+		"max_buy": lambda self: max((raw_buy["unit_price"] for raw_buy in self._dir["buys"]), default=0),
+		"min_sell": lambda self: min((raw_sell["unit_price"] for raw_sell in self._dir["sells"]), default=99999999),
+		"mean_buy": lambda self: ItemListings._mean(self._dir["buys"]),
+		"mean_sell": lambda self: ItemListings._mean(self._dir["sells"]),
+		"buy_depth": lambda self: BookSide(self._dir["buys"], best_is_highest=True),
+		"sell_depth": lambda self: BookSide(self._dir["sells"]),
+		"median_buy": lambda self: self.buy_depth.quantile(.5) if self.buy_depth.volume else 0,
+		"median_sell": lambda self: self.sell_depth.quantile(.5) if self.sell_depth.volume else 0,
+		"mode_buy": lambda self: self.buy_depth.mode if self.buy_depth.volume else 0,
+		"mode_sell": lambda self: self.sell_depth.mode if self.sell_depth.volume else 0,
+		"margin": lambda self: self._margin(),
+		"volume_margin": lambda self: self.buy_volume / self.sell_volume if self.sell_volume else float("inf"),
+		"fingerprint": lambda self: listingdelta.fingerprint(self._dir),
+	}
+
+
+	def __getattr__(self, name):
+		'''
+			Only called for attributes that haven't been set, i.e. those of a lazy listing that haven't been read yet.
+		'''
+		compute = ItemListings._lazy_attributes.get(name)
+		if compute is not None and "_dir" in self.__dict__:
+			value = compute(self)
+			setattr(self, name, value)
+			return value
+
+		# Any other fields of the raw listing.
+		listing_dir = self.__dict__.get("_dir")
+		if isinstance(listing_dir, dict) and name in listing_dir:
+			return listing_dir[name]
+		raise AttributeError(name)
+
+
+	# Attributes left out when pickled, as they're rebuilt from _dir (see _lazy_attributes) if read again.
+	_unpickled_attributes = ("buys", "sells", "buy_depth", "sell_depth")
+
+	def __getstate__(self):
+		return {name:value for name, value in self.__dict__.items() if name not in ItemListings._unpickled_attributes}
+
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+
+
+	def getBuyQuantile(self, fraction):
+		'''
+			Quantity weighted quantile of the buy order prices, or None if there are none.
+
+				:param fraction: 0 for the lowest priced unit, 1 for the highest, .5 for the median.
+		'''
+		return self.buy_depth.quantile(fraction)
+
+
+	def getSellQuantile(self, fraction):
+		'''
+			Quantity weighted quantile of the sell listing prices, or None if there are none.
+
+				:param fraction: 0 for the lowest priced unit, 1 for the highest, .5 for the median.
+		'''
+		return self.sell_depth.quantile(fraction)
+
+
+	def getBuyCost(self, quantity):
+		'''
+			What buying quantity units outright would cost, taking the cheapest sell listings first.
+			None if there aren't that many for sale.
+
+				:param quantity: Number of units to buy.
+		'''
+		return self.sell_depth.valueOfLowest(quantity)
+
+
+	def getSellProceeds(self, quantity):
+		'''
+			What selling quantity units outright would bring in (before trading post fees), filling the
+			highest buy orders first.  None if there aren't orders for that many.
+
+				:param quantity: Number of units to sell.
+		'''
+		return self.buy_depth.valueOfHighest(quantity)
+
+
 	def __str__(self):
 		return str({"buy_volume":self.buy_volume, "sell_volume":self.sell_volume, "max_buy":self.max_buy, "mean_buy":self.mean_buy, "min_sell":self.min_sell, "mean_sell":self.mean_sell})
 
 
+class ItemPrices:
+	'''
+		Top of book only for an item, from the prices API: the best buy and sell prices and the total
+		quantity on each side, under the same names as on ItemListings. (max_buy, min_sell, buy_volume,
+		sell_volume, margin, volume_margin)
+	'''
+	def __init__(self, prices_dir = {}, lazy=False):
+		'''
+			:param prices_dir: The raw prices record, as returned by the API.
+			:param lazy: Ignored; accepted so ItemPrices can stand in for ItemListings.
+		'''
+		self._dir = prices_dir
+		self.id = prices_dir["id"]
+		self.whitelisted = prices_dir.get("whitelisted", False)
+
+		buys = prices_dir.get("buys", {})
+		sells = prices_dir.get("sells", {})
+		self.buy_volume = buys.get("quantity", 0)
+		self.sell_volume = sells.get("quantity", 0)
+		self.max_buy = buys.get("unit_price", 0) if self.buy_volume else 0
+		self.min_sell = sells.get("unit_price", 99999999) if self.sell_volume else 99999999
+
+		self.margin = ItemListings._margin(self)
+		self.volume_margin = float("inf")
+		if self.sell_volume:
+			self.volume_margin = self.buy_volume / self.sell_volume
+
+
+	def __str__(self):
+		return str({"buy_volume":self.buy_volume, "sell_volume":self.sell_volume, "max_buy":self.max_buy, "min_sell":self.min_sell})
+
+
+def parseListings(body, listing_class=ItemListings, lazy=False):
+	'''
+		Listing objects for a raw listings (or prices) response body.  Run on util's parse processes for
+		large fetches (see util.setParseProcesses), so it has to stay a module level function.
+
+			:param body: The response body, as bytes.
+			:param listing_class: ItemListings or ItemPrices.
+			:param lazy: Whether to make lazy listings. (see ItemListings.__init__)
+	'''
+	return [listing_class(raw_listing, lazy=lazy) for raw_listing in json.loads(body)]
+
+
+class SortedIndex:
+	'''
+		A secondary index on one numeric listing field: (value, id) pairs kept sorted, so the ids with
+		the field in a range are found by binary search.  Entries live in a sortedlist.SortedList, so a
+		refreshed listing moves its entry in O(log n) rather than shifting the whole index.
+	'''
+	def __init__(self, field):
+		'''
+			:param field: The listing attribute to index. (e.g. 'min_sell')
+		'''
+		self.field = field
+		self.entries = sortedlist.SortedList() # (value, id), ascending
+		self.values = {} # id:value
+
+
+	def update(self, listing):
+		'''
+			Index a listing, replacing any earlier entry for its id.
+
+				:param listing: The listing object.
+		'''
+		self.remove(listing.id)
+		value = getattr(listing, self.field)
+		self.entries.add((value, listing.id))
+		self.values[listing.id] = value
+
+
+	def remove(self, listing_id):
+		'''
+			Drop a listing's entry, if it has one.
+
+				:param listing_id: The listing id.
+		'''
+		value = self.values.pop(listing_id, None)
+		if value is None:
+			return
+		self.entries.remove((value, listing_id))
+
+
+	def _bounds(self, low, high):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			Positions in entries of the first entry >= low and the first entry > high.
+		'''
+		start = 0 if low is None else self.entries.bisectLeft((low, -1))
+		end = len(self.entries) if high is None else self.entries.bisectRight((high, float("inf")))
+		return start, max(start, end)
+
+
+	def count(self, low=None, high=None):
+		'''
+			How many listings have low <= value <= high.
+
+				:param low: The lowest value; unbounded if None.
+				:param high: The highest value; unbounded if None.
+		'''
+		start, end = self._bounds(low, high)
+		return end - start
+
+
+	def range(self, low=None, high=None):
+		'''
+			The ids of listings with low <= value <= high, in ascending value order.
+
+				:param low: The lowest value; unbounded if None.
+				:param high: The highest value; unbounded if None.
+		'''
+		start, end = self._bounds(low, high)
+		return [listing_id for value, listing_id in self.entries.islice(start, end)]
+
+
+	def contains(self, listing_id, low=None, high=None):
+		'''
+			Whether a listing's indexed value is in a range.
+		'''
+		value = self.values.get(listing_id)
+		return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+
 #TODO: MAKE CACHED VS UNCACHED VERSIONS.
-class Listings:
+class BaseListings:
 	'''
-		Primary listings object, use this to query the listings API.
+		What Listings and Prices share: fetching, caching, subscribe, iteration and searching over one of the
+		commerce APIs.  Accept a BaseListings where either will do; Listings adds the queries that need
+		order book depth.
 	'''
-	def __init__(self, listings=[]):
-		self.listings = {}
+	_resource = '/v2/commerce/listings'
+	_listing_class = ItemListings
+
+	def __init__(self, listings=[], max_age=None, max_size=None, lazy=False, indexed_fields=()):
+		'''
+			Initialize the listings object, optionally with some listings already indexed.
+
+				:param listings: Listing objects to start with.
+				:param max_age: Seconds a listing is served from cache (use_cache=True) before being refetched.
+					None means cached listings never expire.
+				:param max_size: The most listings to keep; least recently used ones are dropped past this.
+					None means no limit.
+				:param lazy: If true, fetched listings are lazy ItemListings. (see ItemListings.__init__)
+				:param indexed_fields: Numeric fields to keep sorted indexes on for searchListingsByRange.
+					(e.g. ('min_sell', 'max_buy', 'margin', 'buy_volume', 'sell_volume'))
+		'''
+		self.listings = collections.OrderedDict() # Least recently used first.
+		self.max_age = max_age
+		self.max_size = max_size
+		self.lazy = lazy
+
+		self.cache_stats = {"hits":0, "misses":0, "expired":0, "evictions":0}
+		self._fetched_at = {} # id:time the listing was fetched
+		self._cache_lock = threading.RLock()
+		self._subscribers = []
+		self.field_indexes = {field:SortedIndex(field) for field in indexed_fields}
 	
 		for listing in listings:
 			self._indexListing(listing)
@@ -122,7 +471,14 @@ class Listings:
 		'''
 			Populate this object with all existant listings.
 		'''
-		return self.getListingsById(self.getAllIds(), use_cache)
+		return util.runSync(self.getAllListingsAsync(use_cache))
+
+
+	async def getAllListingsAsync(self, use_cache=False):
+		'''
+			Awaitable version of getAllListings.
+		'''
+		return await self.getListingsByIdAsync(await self.getAllIdsAsync(), use_cache)
 
 
 	def getListingById(self, listing_id, use_cache=False):
@@ -134,34 +490,154 @@ class Listings:
 		return self.getListingsById([listing_id], use_cache)[0]
 
 
+	async def getListingByIdAsync(self, listing_id, use_cache=False):
+		'''
+			Awaitable version of getListingById.
+		'''
+		return (await self.getListingsByIdAsync([listing_id], use_cache))[0]
+
+
 	def getListingsById(self, listing_ids, use_cache=False):
 		'''
 			Populate this object with the listings for a list of IDs
 
 				:param listing_ids: The list of IDs to query for.
 		'''
+		return util.runSync(self.getListingsByIdAsync(listing_ids, use_cache))
+
+
+	async def getListingsByIdAsync(self, listing_ids, use_cache=False):
+		'''
+			Awaitable version of getListingsById.  Many of these can share one event loop;
+			the requests they make are bounded by util.setFetchConcurrency, and are shared
+			with any other callers after the same ids at the same time. (see util.SingleFlight)
+
+				:param listing_ids: The list of IDs to query for.
+		'''
 		# This section handles getting any cached entries, and pruning the query id list if so
 		cached_results = []
 		if use_cache:
-			cached_ids = [listing_id for listing_id in listing_ids if int(listing_id) in self.listings]
-			cached_results = [self.listings[int(listing_id)] for listing_id in cached_ids]
-			listing_ids = list(set(listing_ids) - set(cached_ids))
+			cached_results, listing_ids = self._getCachedListings(listing_ids)
 
 		# This section gets any ids in the id list from the API.
-		if listing_ids:
-			raw_listings = util.idListApiCall('/v2/commerce/listings?ids=', listing_ids)
+		# (Kept aside as well as indexed, as indexing may evict some again if max_size is small.)
+		fetched_listings = {}
+		if listing_ids and util.parse_processes and len(listing_ids) >= util.parse_min_ids:
+			# Big fetches are parsed, and their statistics worked out, on the parse processes.
+			parser = functools.partial(parseListings, listing_class=self._listing_class, lazy=self.lazy)
+			for listing in await util.asyncParsedIdListApiCall(self._resource + '?ids=', listing_ids, parser):
+				fetched_listings[listing.id] = listing
+				self._indexListing(listing)
+		elif listing_ids:
+			raw_listings = await util.asyncCoalescedIdListApiCall(self._resource + '?ids=', listing_ids)
 
 			for raw_listing in raw_listings:
-				self._indexListing(ItemListings(raw_listing))
+				listing = self._listing_class(raw_listing, lazy=self.lazy)
+				fetched_listings[listing.id] = listing
+				self._indexListing(listing)
 
-		return cached_results + [self.listings[int(listing_id)] for listing_id in listing_ids if int(listing_id) in self.listings]
+		return cached_results + [fetched_listings[int(listing_id)] for listing_id in listing_ids if int(listing_id) in fetched_listings]
 
 		
+	def iterAllListings(self, use_cache=False, index=False):
+		'''
+			Generator version of getAllListings; see iterListingsById.
+		'''
+		return self.iterListingsById(self.getAllIds(), use_cache, index)
+
+
+	def iterListingsById(self, listing_ids, use_cache=False, index=False):
+		'''
+			Generator version of getListingsById.  Yields listing objects batch by batch as each response
+			arrives, holding only a few batches in memory at once.  Results are not in id order.
+
+				:param listing_ids: The list of IDs to query for.
+				:param use_cache: If true, yield still fresh indexed listings first rather than refetching them.
+				:param index: If true, also index the listings into this object (which then holds all of them.)
+		'''
+		if use_cache:
+			cached_results, listing_ids = self._getCachedListings(listing_ids)
+			yield from cached_results
+
+		for raw_listings in util.iterIdListApiCall(self._resource + '?ids=', listing_ids):
+			for raw_listing in raw_listings:
+				listing = self._listing_class(raw_listing, lazy=self.lazy)
+				if index:
+					self._indexListing(listing)
+				yield listing
+
+
 	def getAllIds(self):
 		'''
 			Returns a list of all numerical listing IDs
 		'''
-		return util.getAllIds('/v2/commerce/listings')
+		return util.getAllIds(self._resource)
+
+
+	async def getAllIdsAsync(self):
+		'''
+			Awaitable version of getAllIds.
+		'''
+		return await util.asyncGetAllIds(self._resource)
+
+
+	def getCacheStats(self):
+		'''
+			Returns how cached lookups have gone: hits, misses (never fetched or evicted),
+			expired (older than max_age) and evictions, plus the current size.
+		'''
+		with self._cache_lock:
+			stats = dict(self.cache_stats)
+			stats["size"] = len(self.listings)
+			return stats
+
+
+	def subscribe(self, callback):
+		'''
+			Call a function with every listing this object indexes from now on (i.e. each one freshly
+			fetched, not those served from cache.)
+
+				:param callback: Callable taking the listing object.
+		'''
+		self._subscribers.append(callback)
+
+
+	def unsubscribe(self, callback):
+		'''
+			Stop calling a function given to subscribe.
+
+				:param callback: The callable to remove.
+		'''
+		self._subscribers.remove(callback)
+
+
+	def _getCachedListings(self, listing_ids):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			Split a list of ids into the listings we can serve from cache, and the ids that
+			have to be (re)fetched because they're missing or older than max_age.
+
+				:param listing_ids: The list of IDs being queried for.
+		'''
+		now = time.time()
+		cached_results = []
+		uncached_ids = []
+
+		with self._cache_lock:
+			for listing_id in listing_ids:
+				listing_id = int(listing_id)
+				if listing_id not in self.listings:
+					self.cache_stats["misses"] += 1
+					uncached_ids.append(listing_id)
+				elif self.max_age is not None and now - self._fetched_at[listing_id] >= self.max_age:
+					self.cache_stats["expired"] += 1
+					uncached_ids.append(listing_id)
+				else:
+					self.cache_stats["hits"] += 1
+					self.listings.move_to_end(listing_id)
+					cached_results.append(self.listings[listing_id])
+
+		return cached_results, list(set(uncached_ids))
 
 
 	def _indexListing(self, listing_object):
@@ -171,17 +647,164 @@ class Listings:
 
 				:param listing_object: the object to index.
 		'''
-		self.listings[listing_object.id] = listing_object
+		with self._cache_lock:
+			self.listings[listing_object.id] = listing_object
+			self.listings.move_to_end(listing_object.id)
+			self._fetched_at[listing_object.id] = time.time()
+			for field_index in self.field_indexes.values():
+				field_index.update(listing_object)
+
+			if self.max_size is not None:
+				while len(self.listings) > self.max_size:
+					evicted_id, evicted = self.listings.popitem(last=False)
+					del self._fetched_at[evicted_id]
+					for field_index in self.field_indexes.values():
+						field_index.remove(evicted_id)
+					self.cache_stats["evictions"] += 1
+
+		for callback in self._subscribers:
+			try:
+				callback(listing_object)
+			except Exception as e:
+				util.logger.exception(e)
+
+	def searchListingsByLambda(self, listing_filter):
+		'''
+			Query all listings by a certain filter, a callable that takes the listing as an argument,
+			returns true if it should accept the listing, false if not.
+
+				:param listing_filter: callable taking one argument of the listing object to be examined, returns boolean.
+		'''
+		found_listings = []
+		for listing in self.listings.values():
+			if listing_filter(listing):
+				found_listings.append(listing)
+
+		return found_listings
+
+
+	def addIndex(self, field):
+		'''
+			Start keeping a sorted index on a numeric field (covering the listings already indexed.)
+
+				:param field: The listing attribute to index. (e.g. 'min_sell')
+		'''
+		with self._cache_lock:
+			if field in self.field_indexes:
+				return
+			field_index = SortedIndex(field)
+			for listing in self.listings.values():
+				field_index.update(listing)
+			self.field_indexes[field] = field_index
+
+
+	def searchListingsByRange(self, **ranges):
+		'''
+			Get the indexed listings with every given field in its range (inclusive.)  The range with the
+			fewest matches is read from its sorted index and the others are checked against theirs, so
+			this costs a binary search per field plus the size of the smallest range, not a full scan.
+			Fields without an index are checked on each candidate.
+			e.g. searchListingsByRange(min_sell=(100, 500), sell_volume=(1000, None))
+
+				:param ranges: field=(low, high); either bound may be None for unbounded.
+		'''
+		with self._cache_lock:
+			indexed = {field:bounds for field, bounds in ranges.items() if field in self.field_indexes}
+			unindexed = {field:bounds for field, bounds in ranges.items() if field not in self.field_indexes}
+
+			if indexed:
+				driving_field = min(indexed, key=lambda field: self.field_indexes[field].count(*indexed[field]))
+				candidate_ids = self.field_indexes[driving_field].range(*indexed.pop(driving_field))
+				candidate_ids = [listing_id for listing_id in candidate_ids \
+					if all(self.field_indexes[field].contains(listing_id, *bounds) for field, bounds in indexed.items())]
+				candidates = [self.listings[listing_id] for listing_id in candidate_ids]
+			else:
+				candidates = list(self.listings.values())
+
+		def inRange(listing, low, high, field):
+			value = getattr(listing, field)
+			return (low is None or value >= low) and (high is None or value <= high)
+
+		return [listing for listing in candidates \
+			if all(inRange(listing, low, high, field) for field, (low, high) in unindexed.items())]
+
+
+	def searchTopListings(self, k=100, score='margin', listing_filter=None):
+		'''
+			The k best indexed listings by score, best first, without sorting all of them.
+			(see opportunities; an OpportunityScanner keeps this up to date as listings are fetched.)
+
+				:param k: How many to return.
+				:param score: An attribute name (e.g. 'margin', 'volume_margin') or a callable taking a listing.
+				:param listing_filter: Callable deciding which listings are considered; by default, those
+					with both buy and sell orders. (see opportunities.ListingFilter)
+		'''
+		with self._cache_lock:
+			listing_objects = list(self.listings.values())
+		return opportunities.scan(listing_objects, k, score, listing_filter)
+
+
+
+class Listings(BaseListings):
+	'''
+		Primary listings object, use this to query the listings API.  Listings carry whole order books
+		(ItemListings), so the depth queries live here.
+	'''
+	def getBuyCostsBatch(self, listing_ids, quantities):
+		'''
+			getBuyCost for many indexed listings at once.  Returns a list in the same order as listing_ids,
+			with None for listings that aren't indexed or can't fill the quantity.
+
+				:param listing_ids: The list of IDs to price.
+				:param quantities: A quantity for each ID, or one quantity for all of them.
+		'''
+		return self._batchDepthQuery(listing_ids, quantities, ItemListings.getBuyCost)
+
+
+	def getSellProceedsBatch(self, listing_ids, quantities):
+		'''
+			getSellProceeds for many indexed listings at once.  Returns a list in the same order as listing_ids,
+			with None for listings that aren't indexed or can't fill the quantity.
+
+				:param listing_ids: The list of IDs to price.
+				:param quantities: A quantity for each ID, or one quantity for all of them.
+		'''
+		return self._batchDepthQuery(listing_ids, quantities, ItemListings.getSellProceeds)
+
+
+	def _batchDepthQuery(self, listing_ids, quantities, query):
+		'''
+			NOTE: INTERNAL FUNCTION.
+			Run an ItemListings depth query over (id, quantity) pairs.
+		'''
+		if isinstance(quantities, int):
+			quantities = itertools.repeat(quantities)
+
+		results = []
+		with self._cache_lock:
+			for listing_id, quantity in zip(listing_ids, quantities):
+				listing = self.listings.get(int(listing_id))
+				results.append(None if listing is None else query(listing, quantity))
+		return results
+
 
 
 	#FIXME: fix the util funtion then use it under this.
 	def getApproximateItemVolatility(self, item_ids, delay=10):
 		'''
 			NOTE: this is a concept; only works on certain items with high enough volatility.
-			To be rewritten and deprecated.
+			To be rewritten and deprecated.  rollingstats.RollingStatistics keeps rolling volume flow
+			and volatility for every fetched item without blocking.
 
 			Query multiple times to observe how volume changes and return
-			a metric for volatility derived from this. 
+			a metric for volatility derived from this: {id:{net_buy, net_sell, abs_buy, abs_sell}}, where for
+			each side net is the total volume lost from one poll to the next (added volume counting against
+			it), and abs the total of each poll's loss or gain regardless of sign, both per poll.
+
+			NOTE: before the order book delta engine (see listingdelta), each poll was compared against the
+			first one rather than the poll before it, so the same polls gave different numbers: a book that
+			drops from 10 to 7 units and back, poll after poll, used to give net and abs of 1.5, and now
+			gives net 0 (it ends where it started) and abs 3 (3 units move every poll.)
 
 				:param item_ids: List of item ids to query. (also accepts single id)
 				:param delay: delay between each query.
@@ -196,19 +819,23 @@ class Listings:
 		volatility_map = defaultdict(inner_defaultdict) #id:{net_buy, net_sell, abs_buy, abs_sell}
 		iterations = 30
 
-		listings = {listing.id:listing for listing in self.getListingsById(item_ids)}
+		# Only the levels that changed between polls are looked at. (see listingdelta)
+		tracker = listingdelta.DeltaTracker()
+		first_listings = self.getListingsById(item_ids)
+		tracker.update(first_listings)
+		for listing in first_listings:
+			volatility_map[listing.id].update({"net_buy":0, "net_sell":0, "abs_buy":0, "abs_sell":0})
+
 		for iteration in range(0, iterations):
 			time.sleep(delay)
-			new_listings = {listing.id:listing for listing in self.getListingsById(item_ids)}
-			for listing_id, listing in listings.items():
-				new_listing = new_listings[listing_id]
-				buy_delta = listing.buy_volume - new_listing.buy_volume
-				sell_delta = listing.sell_volume - new_listing.sell_volume
+			volume_deltas = defaultdict(int) #(id, side):volume lost since the last poll
+			for change in tracker.update(self.getListingsById(item_ids)):
+				volume_deltas[(change.item_id, change.side)] -= change.quantity_delta
 
-				volatility_map[listing_id]["net_buy"] += buy_delta
-				volatility_map[listing_id]["net_sell"] += sell_delta
-				volatility_map[listing_id]["abs_buy"] += abs(buy_delta)
-				volatility_map[listing_id]["abs_sell"] += abs(sell_delta)
+			for (listing_id, side), volume_delta in volume_deltas.items():
+				side = "buy" if side == "buys" else "sell"
+				volatility_map[listing_id]["net_" + side] += volume_delta
+				volatility_map[listing_id]["abs_" + side] += abs(volume_delta)
 
 		for data in volatility_map.values():
 			for name, metric in data.items():
@@ -217,17 +844,13 @@ class Listings:
 
 		return volatility_map
 
-	def searchListingsByLambda(self, listing_filter):
-		'''
-			Query all listings by a certain filter, a callable that takes the listing as an argument,
-			returns true if it should accept the listing, false if not.
 
-				:param listing_filter: callable taking one argument of the listing object to be examined, returns boolean.
-		'''
-		found_listings = []
-		for listing in self.listings.values():
-			if listing_filter(listing):
-				found_listings.append(listing)
-
-		return found_listings
-				
+class Prices(BaseListings):
+	'''
+		Listings backed by the prices API, for when nothing needs depth: it returns ItemPrices (top of
+		book only) rather than whole order books, for a small fraction of the transfer and parsing.
+		Caching, subscribe, searching... work as on Listings; the depth queries (getBuyCostsBatch,
+		getSellProceedsBatch, getApproximateItemVolatility) are only on Listings.
+	'''
+	_resource = '/v2/commerce/prices'
+	_listing_class = ItemPrices
@@ -0,0 +1,395 @@
+'''
+	Append only, memory mapped time series of listing samples (top of book and volume per item),
+	for keeping market history without text logs.  Range reads ("item X between t1 and t2",
+	"every item as of time t") binary search their way to the rows they need rather than scanning.
+
+	A store is a directory of fixed size segment files, each holding up to capacity samples:
+		header: magic, version, flags, capacity, count
+		columns: capacity entries each of time, item_id, max_buy, min_sell, buy_volume, sell_volume
+
+	Samples go in in time order, so each segment's time column is sorted.  An append writes its rows
+	past the end, flushes them, and only then bumps count in the header; if the process dies part way,
+	the store reopens with the rows up to the last completed append.  When a segment fills it is
+	sealed and a new one started, and a per item index of the sealed segment (row numbers sorted by
+	item, then time) is written next to it.  The segment being appended to keeps that index in memory.
+'''
+
+import array
+import bisect
+import collections
+import mmap
+import os
+import struct
+import time
+
+
+MAGIC = b'GW2LSTOR'
+INDEX_MAGIC = b'GW2LSIDX'
+VERSION = 1
+
+# magic, version, flags, capacity, count
+HEADER = struct.Struct('<8sIIQQ')
+COUNT_OFFSET = 24
+SEALED = 1
+
+# (name, struct/array type code), in the order the columns are laid out.
+COLUMNS = (('time', 'd'), ('item_id', 'I'), ('max_buy', 'q'), ('min_sell', 'q'), ('buy_volume', 'q'), ('sell_volume', 'q'))
+ROW_SIZE = sum(struct.calcsize(code) for name, code in COLUMNS)
+
+# magic, entry count; then the item id column and the row column.
+INDEX_HEADER = struct.Struct('<8sQ')
+
+
+Sample = collections.namedtuple('Sample', [name for name, code in COLUMNS])
+
+
+class Segment:
+	'''
+		One segment file.  Use ListingStore rather than this directly.
+	'''
+	def __init__(self, path, capacity=None):
+		'''
+			Open a segment, creating it if capacity is given and it doesn't exist.
+
+				:param path: The segment file.
+				:param capacity: Number of samples a new segment holds.
+		'''
+		self.path = path
+		if not os.path.exists(path):
+			if capacity is None:
+				raise FileNotFoundError(path)
+			# An even capacity keeps every column 8 byte aligned.
+			capacity += capacity % 2
+			with open(path, 'wb') as f:
+				f.write(HEADER.pack(MAGIC, VERSION, 0, capacity, 0))
+				f.truncate(HEADER.size + capacity * ROW_SIZE)
+
+		self._file = open(path, 'r+b')
+		self._map = mmap.mmap(self._file.fileno(), 0)
+
+		magic, version, self.flags, self.capacity, self.count = HEADER.unpack_from(self._map, 0)
+		if magic != MAGIC:
+			raise ValueError(path + " is not a listing store segment.")
+		if version != VERSION:
+			raise ValueError(path + " is segment version " + str(version) + ", expected " + str(VERSION) + ".")
+
+		self.columns = {}
+		offset = HEADER.size
+		for name, code in COLUMNS:
+			size = self.capacity * struct.calcsize(code)
+			self.columns[name] = memoryview(self._map)[offset:offset + size].cast(code)
+			offset += size
+
+		# Sealed segments map in their index file when first needed; the one being appended to keeps a dict.
+		self._index = None
+		self._index_map = self._index_item_ids = self._index_rows = None
+		if not self.sealed:
+			self._index = self._buildIndex()
+
+
+	@property
+	def sealed(self):
+		return bool(self.flags & SEALED)
+
+
+	@property
+	def first_time(self):
+		return self.columns['time'][0] if self.count else None
+
+
+	@property
+	def last_time(self):
+		return self.columns['time'][self.count - 1] if self.count else None
+
+
+	def _buildIndex(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			item_id:array of row numbers (in time order) for the rows written so far.
+		'''
+		index = collections.defaultdict(lambda: array.array('I'))
+		item_ids = self.columns['item_id']
+		for row in range(self.count):
+			index[item_ids[row]].append(row)
+		return index
+
+
+	def append(self, samples):
+		'''
+			Write samples after the last row, then commit them by updating the count.  Returns how many
+			fit; the rest belong in the next segment.
+
+				:param samples: List of Sample tuples, in time order.
+		'''
+		samples = samples[:self.capacity - self.count]
+		if not samples:
+			return 0
+
+		start, end = self.count, self.count + len(samples)
+		for position, (name, code) in enumerate(COLUMNS):
+			self.columns[name][start:end] = array.array(code, [sample[position] for sample in samples])
+		self._map.flush()
+
+		# The rows are only part of the segment once the count covers them.
+		struct.pack_into('<Q', self._map, COUNT_OFFSET, end)
+		self._map.flush()
+		self.count = end
+
+		for row, sample in enumerate(samples, start):
+			self._index[sample.item_id].append(row)
+		return len(samples)
+
+
+	def seal(self):
+		'''
+			Mark the segment full, and write its per item index so it needn't be rebuilt on open.
+		'''
+		entries = sorted((item_id, row) for item_id, rows in self._index.items() for row in rows)
+		temporary_path = self._indexPath() + '.tmp'
+		with open(temporary_path, 'wb') as f:
+			f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(entries)))
+			f.write(array.array('I', [item_id for item_id, row in entries]).tobytes())
+			f.write(array.array('I', [row for item_id, row in entries]).tobytes())
+		os.replace(temporary_path, self._indexPath())
+
+		self.flags |= SEALED
+		struct.pack_into('<I', self._map, 12, self.flags)
+		self._map.flush()
+		self._index = None
+
+
+	def _indexPath(self):
+		return os.path.splitext(self.path)[0] + '.index'
+
+
+	def _loadIndex(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Map in a sealed segment's index file (rebuilding the in memory index if it went missing.)
+		'''
+		try:
+			with open(self._indexPath(), 'rb') as f:
+				index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (FileNotFoundError, ValueError):
+			self._index = self._buildIndex()
+			return
+
+		magic, entry_count = INDEX_HEADER.unpack_from(index_map, 0)
+		if magic != INDEX_MAGIC or entry_count != self.count:
+			index_map.close()
+			self._index = self._buildIndex()
+			return
+
+		self._index_map = index_map
+		start = INDEX_HEADER.size
+		self._index_item_ids = memoryview(index_map)[start:start + 4 * entry_count].cast('I')
+		self._index_rows = memoryview(index_map)[start + 4 * entry_count:start + 8 * entry_count].cast('I')
+
+
+	def rowsOf(self, item_id):
+		'''
+			The rows (a sequence of row numbers, in time order) holding samples of an item.
+
+				:param item_id: The item id.
+		'''
+		if self._index is None and self._index_rows is None:
+			self._loadIndex()
+		if self._index is not None:
+			return self._index.get(item_id, ())
+
+		low = bisect.bisect_left(self._index_item_ids, item_id)
+		high = bisect.bisect_right(self._index_item_ids, item_id, low)
+		return self._index_rows[low:high]
+
+
+	def itemIds(self):
+		'''
+			Every item id with samples in this segment.
+		'''
+		if self._index is None and self._index_rows is None:
+			self._loadIndex()
+		if self._index is not None:
+			return set(self._index)
+
+		item_ids = set()
+		position = 0
+		while position < len(self._index_item_ids):
+			item_id = self._index_item_ids[position]
+			item_ids.add(item_id)
+			position = bisect.bisect_right(self._index_item_ids, item_id, position)
+		return item_ids
+
+
+	def sample(self, row):
+		'''
+			The Sample at a row.
+
+				:param row: The row number.
+		'''
+		return Sample(*(self.columns[name][row] for name, code in COLUMNS))
+
+
+	def itemRange(self, item_id, start_time, end_time):
+		'''
+			An item's rows with start_time <= time <= end_time.
+
+				:param item_id: The item id.
+				:param start_time: The earliest time.
+				:param end_time: The latest time.
+		'''
+		rows = self.rowsOf(item_id)
+		times = self.columns['time']
+		low = bisect.bisect_left(rows, start_time, key=times.__getitem__)
+		high = bisect.bisect_right(rows, end_time, low, key=times.__getitem__)
+		return rows[low:high]
+
+
+	def close(self):
+		for column in self.columns.values():
+			column.release()
+		self.columns = {}
+		self._map.close()
+		self._file.close()
+		if self._index_rows is not None:
+			self._index_item_ids.release()
+			self._index_rows.release()
+			self._index_map.close()
+			self._index_map = self._index_item_ids = self._index_rows = None
+
+
+class ListingStore:
+	'''
+		A directory of segments holding listing samples over time.
+	'''
+	def __init__(self, directory, segment_capacity=1 << 18):
+		'''
+			Open a store, creating it if need be.
+
+				:param directory: The directory holding the segments.
+				:param segment_capacity: Samples per segment, for segments created from now on.
+		'''
+		self.directory = directory
+		self.segment_capacity = segment_capacity
+		os.makedirs(directory, exist_ok=True)
+
+		self.segments = [Segment(os.path.join(directory, file_name)) \
+			for file_name in sorted(os.listdir(directory)) if file_name.startswith('segment-') and file_name.endswith('.dat')]
+		if not self.segments or self.segments[-1].sealed:
+			self._startSegment()
+
+
+	def _startSegment(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		path = os.path.join(self.directory, 'segment-%08d.dat' % len(self.segments))
+		self.segments.append(Segment(path, self.segment_capacity))
+
+
+	@property
+	def last_time(self):
+		for segment in reversed(self.segments):
+			if segment.count:
+				return segment.last_time
+		return None
+
+
+	def append(self, listing_objects, timestamp=None):
+		'''
+			Record a sample of each listing, all at one time.  Times must not go backwards.
+
+				:param listing_objects: Iterable of ItemListings (or anything with id, max_buy, min_sell,
+					buy_volume and sell_volume.)
+				:param timestamp: The time of the samples; now if None.
+		'''
+		last_time = self.last_time
+		if timestamp is None:
+			# Don't let the clock stepping back put samples out of order.
+			timestamp = time.time() if last_time is None else max(time.time(), last_time)
+		elif last_time is not None and timestamp < last_time:
+			raise ValueError("Samples must be appended in time order (" + str(timestamp) + " < " + str(last_time) + ")")
+
+		samples = [Sample(timestamp, listing.id, listing.max_buy, listing.min_sell, listing.buy_volume, listing.sell_volume) \
+			for listing in listing_objects]
+
+		while samples:
+			written = self.segments[-1].append(samples)
+			samples = samples[written:]
+			if self.segments[-1].count == self.segments[-1].capacity:
+				self.segments[-1].seal()
+				self._startSegment()
+
+
+	def _segmentsBetween(self, start_time, end_time):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		for segment in self.segments:
+			if segment.count and segment.last_time >= start_time and segment.first_time <= end_time:
+				yield segment
+
+
+	def readItem(self, item_id, start_time=None, end_time=None):
+		'''
+			An item's samples between two times (inclusive), oldest first.
+
+				:param item_id: The item id.
+				:param start_time: The earliest time; from the start if None.
+				:param end_time: The latest time; to the end if None.
+		'''
+		start_time = float('-inf') if start_time is None else start_time
+		end_time = float('inf') if end_time is None else end_time
+
+		samples = []
+		for segment in self._segmentsBetween(start_time, end_time):
+			samples.extend(segment.sample(row) for row in segment.itemRange(item_id, start_time, end_time))
+		return samples
+
+
+	def readAt(self, timestamp, item_ids=None):
+		'''
+			The latest sample at or before a time for each item, as a dict of item id:Sample.
+
+				:param timestamp: The time.
+				:param item_ids: The items to look up; every item in the store if None.
+		'''
+		remaining = None if item_ids is None else set(item_ids)
+		found = {}
+		for segment in reversed(list(self._segmentsBetween(float('-inf'), timestamp))):
+			candidates = segment.itemIds() if remaining is None else remaining
+			for item_id in candidates:
+				if item_id in found:
+					continue
+				rows = segment.itemRange(item_id, float('-inf'), timestamp)
+				if len(rows):
+					found[item_id] = segment.sample(rows[-1])
+
+			if remaining is not None:
+				remaining -= set(found)
+				if not remaining:
+					break
+		return found
+
+
+	def itemIds(self):
+		'''
+			Every item id with samples in the store.
+		'''
+		item_ids = set()
+		for segment in self.segments:
+			item_ids |= segment.itemIds()
+		return item_ids
+
+
+	def close(self):
+		for segment in self.segments:
+			segment.close()
+		self.segments = []
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exception_info):
+		self.close()
@@ -0,0 +1,456 @@
+'''
+	Columnar, whole market order book snapshots.  Rather than an ItemListings object (with an Offer
+	per price level) for every item, a MarketSnapshot keeps flat price/quantity/listing count arrays
+	for each side of the book, plus per item offsets into them, and computes every item's statistics
+	in a few vectorized passes.
+
+	Requires numpy.
+'''
+
+import listings
+import util
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+LISTINGS_RESOURCE = '/v2/commerce/listings?ids='
+
+
+class MarketSnapshot:
+	'''
+		Every item's order book in flat arrays, sorted by item id.  For item row i, its buys are
+		buy_price[buy_offsets[i]:buy_offsets[i + 1]] (and the same for buy_quantity, buy_listings),
+		and likewise for sells, in ascending price order within each row.  Statistics are arrays with
+		one entry per row, named as on ItemListings.
+	'''
+	def __init__(self, raw_listings):
+		'''
+			Build a snapshot from raw listing dicts (as returned by /v2/commerce/listings.)
+
+				:param raw_listings: Iterable of raw listing dicts.
+		'''
+		if numpy is None:
+			raise ImportError("MarketSnapshot requires numpy.")
+
+		ids = []
+		buy_counts = []
+		sell_counts = []
+		buy_columns = ([], [], []) # unit_price, quantity, listings
+		sell_columns = ([], [], [])
+		for raw_listing in raw_listings:
+			ids.append(raw_listing["id"])
+			buys = raw_listing["buys"]
+			sells = raw_listing["sells"]
+			buy_counts.append(len(buys))
+			sell_counts.append(len(sells))
+			for column, field in zip(buy_columns, ("unit_price", "quantity", "listings")):
+				column += [buy[field] for buy in buys]
+			for column, field in zip(sell_columns, ("unit_price", "quantity", "listings")):
+				column += [sell[field] for sell in sells]
+
+		ids = numpy.array(ids, dtype=numpy.int64)
+		buy_counts = numpy.array(buy_counts, dtype=numpy.int64)
+		sell_counts = numpy.array(sell_counts, dtype=numpy.int64)
+
+		# Put the rows in id order (carrying their levels with them), so ids can be binary searched.
+		order = numpy.argsort(ids, kind='stable')
+		self.ids = ids[order]
+		self.buy_offsets, buy_rows = self._reorder(buy_counts, order)
+		self.sell_offsets, sell_rows = self._reorder(sell_counts, order)
+
+		# Within each row, put the levels in ascending price order, so prefix sums over them walk the book.
+		buy_rows = buy_rows[self._ascendingWithinRows(numpy.array(buy_columns[0], dtype=numpy.int64)[buy_rows], self.buy_offsets)]
+		sell_rows = sell_rows[self._ascendingWithinRows(numpy.array(sell_columns[0], dtype=numpy.int64)[sell_rows], self.sell_offsets)]
+
+		self.buy_price, self.buy_quantity, self.buy_listings = [numpy.array(column, dtype=numpy.int64)[buy_rows] for column in buy_columns]
+		self.sell_price, self.sell_quantity, self.sell_listings = [numpy.array(column, dtype=numpy.int64)[sell_rows] for column in sell_columns]
+
+		self._fingerprints = None
+		self._computeStatistics()
+
+
+	@classmethod
+	def fromListings(cls, listing_objects):
+		'''
+			Build a snapshot from ItemListings objects that are already around.
+
+				:param listing_objects: Iterable of ItemListings.
+		'''
+		return cls(listing._dir for listing in listing_objects)
+
+
+	@classmethod
+	def fetch(cls, listing_ids=None):
+		'''
+			Fetch listings straight into a snapshot, without building an ItemListings object for each.
+
+				:param listing_ids: The listing ids to fetch; all of them if None.
+		'''
+		if listing_ids is None:
+			listing_ids = util.getAllIds('/v2/commerce/listings')
+
+		def rawListings():
+			for raw_listings in util.iterIdListApiCall(LISTINGS_RESOURCE, listing_ids):
+				yield from raw_listings
+
+		return cls(rawListings())
+
+
+	@staticmethod
+	def _reorder(counts, order):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Given per row level counts and a new row order, return the offsets of the rows in their new order
+			and the indexes (into the old level arrays) of every level, in the new order.
+		'''
+		old_offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+		numpy.cumsum(counts, out=old_offsets[1:])
+
+		new_counts = counts[order]
+		new_offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+		numpy.cumsum(new_counts, out=new_offsets[1:])
+
+		# For every level in the new order: where its row starts in the old arrays, plus its position within the row.
+		row_starts = numpy.repeat(old_offsets[:-1][order], new_counts)
+		within_row = numpy.arange(new_offsets[-1], dtype=numpy.int64) - numpy.repeat(new_offsets[:-1], new_counts)
+
+		return new_offsets, row_starts + within_row
+
+
+	@staticmethod
+	def _ascendingWithinRows(prices, offsets):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The order that sorts each row's levels by price, leaving the rows themselves where they are.
+		'''
+		level_rows = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+		return numpy.lexsort((prices, level_rows))
+
+
+	@staticmethod
+	def _segmentSums(values, offsets):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Sum values over each row's segment.  (Empty segments sum to 0, unlike numpy.add.reduceat.)
+		'''
+		sums = numpy.zeros(len(values) + 1, dtype=values.dtype)
+		numpy.cumsum(values, out=sums[1:])
+		return sums[offsets[1:]] - sums[offsets[:-1]]
+
+
+	@staticmethod
+	def _segmentReduce(ufunc, values, offsets, empty_value):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Reduce values over each row's segment with ufunc (e.g. numpy.maximum), giving empty_value for empty segments.
+		'''
+		result = numpy.full(len(offsets) - 1, empty_value, dtype=numpy.int64)
+		non_empty = offsets[1:] > offsets[:-1]
+		if non_empty.any():
+			# Empty segments have no width, so reducing from each non empty segment's start runs to the next one's.
+			result[non_empty] = ufunc.reduceat(values, offsets[:-1][non_empty])
+		return result
+
+
+	def _computeStatistics(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Compute every row's statistics at once, matching ItemListings' definitions.
+		'''
+		self.buy_volume = self._segmentSums(self.buy_quantity, self.buy_offsets)
+		self.sell_volume = self._segmentSums(self.sell_quantity, self.sell_offsets)
+
+		self.max_buy = self._segmentReduce(numpy.maximum, self.buy_price, self.buy_offsets, 0)
+		self.min_sell = self._segmentReduce(numpy.minimum, self.sell_price, self.sell_offsets, 99999999)
+
+		buy_value = self._segmentSums(self.buy_price * self.buy_quantity, self.buy_offsets)
+		sell_value = self._segmentSums(self.sell_price * self.sell_quantity, self.sell_offsets)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			self.mean_buy = numpy.where(self.buy_volume > 0, buy_value / self.buy_volume, 0.0)
+			self.mean_sell = numpy.where(self.sell_volume > 0, sell_value / self.sell_volume, 0.0)
+			self.volume_margin = numpy.where(self.sell_volume > 0, self.buy_volume / self.sell_volume, numpy.inf)
+
+		# Prefix sums over each whole side (with a leading 0), for depth walks and quantiles.
+		self._buy_cumulative_quantity = self._prefixSums(self.buy_quantity)
+		self._buy_cumulative_value = self._prefixSums(self.buy_price * self.buy_quantity)
+		self._sell_cumulative_quantity = self._prefixSums(self.sell_quantity)
+		self._sell_cumulative_value = self._prefixSums(self.sell_price * self.sell_quantity)
+
+		self.median_buy = self.getBuyQuantiles(.5)
+		self.median_sell = self.getSellQuantiles(.5)
+		self.mode_buy = self._modes(self.buy_price, self.buy_quantity, self.buy_offsets, best_is_highest=True)
+		self.mode_sell = self._modes(self.sell_price, self.sell_quantity, self.sell_offsets, best_is_highest=False)
+
+		delta = self.min_sell - self.max_buy
+		fee = (self.min_sell - 1) * .15
+		self.margin = (delta - fee) / (self.max_buy + 1)
+
+
+	@staticmethod
+	def _prefixSums(values):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		sums = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+		numpy.cumsum(values, out=sums[1:])
+		return sums
+
+
+	def _modes(self, price, quantity, offsets, best_is_highest):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Each row's price with the most units at it (ties to the best price), or 0 for empty rows.
+		'''
+		level_rows = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+		most = self._segmentReduce(numpy.maximum, quantity, offsets, 0)
+		is_mode = quantity == most[level_rows]
+		if best_is_highest:
+			return self._segmentReduce(numpy.maximum, numpy.where(is_mode, price, -1), offsets, 0)
+		return self._segmentReduce(numpy.minimum, numpy.where(is_mode, price, numpy.iinfo(numpy.int64).max), offsets, 0)
+
+
+	def _rowsOf(self, item_ids):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Rows for an array of item ids; raises KeyError if any aren't in the snapshot.
+		'''
+		item_ids = numpy.asarray(item_ids, dtype=numpy.int64)
+		rows = numpy.searchsorted(self.ids, item_ids)
+		found = rows < len(self.ids)
+		found[found] = self.ids[rows[found]] == item_ids[found]
+		if not found.all():
+			raise KeyError(item_ids[~found].tolist())
+		return rows
+
+
+	@staticmethod
+	def _valueOfLowest(price, cumulative_quantity, cumulative_value, offsets, rows, quantities):
+		'''
+			NOTE: INTERNAL FUNCTION
+			For each (row, quantity) pair, the total price of the row's cheapest quantity units on one side,
+			NaN where the row has fewer.  Levels are in ascending price order within each row and the
+			cumulative sums run across all rows, so one searchsorted finds where every fill ends.
+		'''
+		quantities = numpy.broadcast_to(numpy.asarray(quantities, dtype=numpy.int64), rows.shape)
+		starts = offsets[rows]
+		volumes = cumulative_quantity[offsets[rows + 1]] - cumulative_quantity[starts]
+		targets = cumulative_quantity[starts] + quantities
+
+		# The level holding the last unit needed. (cumulative_quantity[1:] is the sum up to and including each level.)
+		levels = numpy.searchsorted(cumulative_quantity[1:], targets, side='left')
+
+		values = numpy.zeros(rows.shape, dtype=numpy.float64)
+		filling = (quantities > 0) & (quantities <= volumes)
+		level = levels[filling]
+		values[filling] = cumulative_value[level] - cumulative_value[starts[filling]] \
+			+ (targets[filling] - cumulative_quantity[level]) * price[level]
+		values[quantities > volumes] = numpy.nan
+		return values
+
+
+	def getBuyCostsBatch(self, item_ids, quantities):
+		'''
+			What buying each quantity of each item outright would cost, cheapest sell listings first.
+			Returns a float array, NaN where there aren't enough for sale.
+
+				:param item_ids: Item ids to price.
+				:param quantities: A quantity for each id, or one quantity for all of them.
+		'''
+		rows = self._rowsOf(item_ids)
+		return self._valueOfLowest(self.sell_price, self._sell_cumulative_quantity, self._sell_cumulative_value, \
+			self.sell_offsets, rows, quantities)
+
+
+	def getSellProceedsBatch(self, item_ids, quantities):
+		'''
+			What selling each quantity of each item outright would bring in (before trading post fees),
+			highest buy orders first.  Returns a float array, NaN where there aren't orders for that many.
+
+				:param item_ids: Item ids to price.
+				:param quantities: A quantity for each id, or one quantity for all of them.
+		'''
+		rows = self._rowsOf(item_ids)
+		quantities = numpy.broadcast_to(numpy.asarray(quantities, dtype=numpy.int64), rows.shape)
+		volumes = self.buy_volume[rows]
+		buy_values = self._buy_cumulative_value[self.buy_offsets[rows + 1]] - self._buy_cumulative_value[self.buy_offsets[rows]]
+
+		# Selling the top quantity units leaves the bottom (volume - quantity) alone.
+		untouched = self._valueOfLowest(self.buy_price, self._buy_cumulative_quantity, self._buy_cumulative_value, \
+			self.buy_offsets, rows, numpy.maximum(volumes - quantities, 0))
+		values = buy_values - untouched
+		values[quantities > volumes] = numpy.nan
+		return values
+
+
+	def _quantiles(self, price, cumulative_quantity, offsets, volumes, fraction):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		ranks = numpy.clip(numpy.ceil(numpy.asarray(fraction) * volumes), 1, numpy.maximum(volumes, 1)).astype(numpy.int64)
+		levels = numpy.searchsorted(cumulative_quantity[1:], cumulative_quantity[offsets[:-1]] + ranks, side='left')
+		if not len(price):
+			return numpy.zeros(len(volumes), dtype=numpy.int64)
+		return numpy.where(volumes > 0, price[numpy.minimum(levels, len(price) - 1)], 0)
+
+
+	def getBuyQuantiles(self, fraction):
+		'''
+			Every row's quantity weighted quantile of buy order prices (0 for rows without buys.)
+
+				:param fraction: 0 for the lowest priced unit, 1 for the highest, .5 for the median.
+					May also be an array with one fraction per row.
+		'''
+		return self._quantiles(self.buy_price, self._buy_cumulative_quantity, self.buy_offsets, self.buy_volume, fraction)
+
+
+	def getSellQuantiles(self, fraction):
+		'''
+			Every row's quantity weighted quantile of sell listing prices (0 for rows without sells.)
+
+				:param fraction: 0 for the lowest priced unit, 1 for the highest, .5 for the median.
+					May also be an array with one fraction per row.
+		'''
+		return self._quantiles(self.sell_price, self._sell_cumulative_quantity, self.sell_offsets, self.sell_volume, fraction)
+
+
+	def getFingerprints(self):
+		'''
+			A hash of every row's whole book (if two rows' fingerprints differ, so do their books), worked
+			out once.  Only comparable with other MarketSnapshots' fingerprints.  (see listingdelta)
+		'''
+		if self._fingerprints is None:
+			self._fingerprints = self._sideFingerprints(self.buy_price, self.buy_quantity, self.buy_listings, self.buy_offsets) \
+				* numpy.int64(1000003) + self._sideFingerprints(self.sell_price, self.sell_quantity, self.sell_listings, self.sell_offsets)
+		return self._fingerprints
+
+
+	def _sideFingerprints(self, price, quantity, listing_count, offsets):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Sum a mix of each level's values over each row (wrapping on overflow); prices are unique within
+			a row, so the order levels are summed in doesn't matter.
+		'''
+		with numpy.errstate(over='ignore'):
+			mixed = (price * numpy.int64(0x9E3779B97F4A7C15 - (1 << 64))) ^ (quantity * numpy.int64(0x632BE59BD9B4E019)) \
+				^ (listing_count * numpy.int64(0x2545F4914F6CDD1D))
+			mixed ^= mixed >> 29
+			mixed *= numpy.int64(0x2545F4914F6CDD1D)
+			sums = numpy.zeros(len(mixed) + 1, dtype=numpy.int64)
+			numpy.cumsum(mixed, out=sums[1:])
+			return (sums[offsets[1:]] - sums[offsets[:-1]]) * numpy.int64(31) + numpy.diff(offsets)
+
+
+	def __len__(self):
+		return len(self.ids)
+
+
+	def __contains__(self, item_id):
+		return self.rowOf(item_id) is not None
+
+
+	def rowOf(self, item_id):
+		'''
+			The row an item id is in, or None.
+
+				:param item_id: The item id to look up.
+		'''
+		row = int(numpy.searchsorted(self.ids, int(item_id)))
+		if row < len(self.ids) and self.ids[row] == int(item_id):
+			return row
+		return None
+
+
+	def getListing(self, item_id):
+		'''
+			A lightweight ItemListings view of one item's row.  Raises KeyError if it isn't in the snapshot.
+
+				:param item_id: The item id to look up.
+		'''
+		row = self.rowOf(item_id)
+		if row is None:
+			raise KeyError(item_id)
+		return ItemListingsView(self, row)
+
+
+	def __iter__(self):
+		'''
+			Iterate views of every item, in id order.
+		'''
+		for row in range(len(self.ids)):
+			yield ItemListingsView(self, row)
+
+
+	def select(self, mask):
+		'''
+			The item ids of the rows where a boolean array (e.g. built from the statistic arrays) is true.
+			e.g. snapshot.select((snapshot.margin > 0.1) & (snapshot.sell_volume > 1000))
+
+				:param mask: Boolean array with one entry per row.
+		'''
+		return self.ids[mask]
+
+
+class ItemListingsView(listings.ItemListings):
+	'''
+		An ItemListings that is just a window onto one row of a MarketSnapshot.  Statistics are read
+		straight out of the snapshot's arrays; Offer objects are only made if buys/sells are asked for.
+	'''
+	def __init__(self, snapshot, row):
+		'''
+			:param snapshot: The MarketSnapshot the row belongs to.
+			:param row: The row number.
+		'''
+		self._snapshot = snapshot
+		self._row = row
+
+
+	def _offers(self, offsets, price, quantity, listing_count, highest_first=False):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		start, end = offsets[self._row], offsets[self._row + 1]
+		levels = range(end - 1, start - 1, -1) if highest_first else range(start, end)
+		return [listings.Offer({"unit_price":int(price[level]), "quantity":int(quantity[level]), "listings":int(listing_count[level])}) \
+			for level in levels]
+
+
+	@property
+	def buys(self):
+		snapshot = self._snapshot
+		# Best first, as the API lists them.
+		return self._offers(snapshot.buy_offsets, snapshot.buy_price, snapshot.buy_quantity, snapshot.buy_listings, highest_first=True)
+
+
+	@property
+	def sells(self):
+		snapshot = self._snapshot
+		return self._offers(snapshot.sell_offsets, snapshot.sell_price, snapshot.sell_quantity, snapshot.sell_listings)
+
+
+	@property
+	def _dir(self):
+		return {"id":self.id, \
+			"buys":[offer._dir for offer in self.buys], \
+			"sells":[offer._dir for offer in self.sells]}
+
+
+	buy_depth = property(lambda self: listings.BookSide(self._dir["buys"], best_is_highest=True))
+	sell_depth = property(lambda self: listings.BookSide(self._dir["sells"]))
+
+	id = property(lambda self: int(self._snapshot.ids[self._row]))
+	buy_volume = property(lambda self: int(self._snapshot.buy_volume[self._row]))
+	sell_volume = property(lambda self: int(self._snapshot.sell_volume[self._row]))
+	max_buy = property(lambda self: int(self._snapshot.max_buy[self._row]))
+	min_sell = property(lambda self: int(self._snapshot.min_sell[self._row]))
+	mean_buy = property(lambda self: float(self._snapshot.mean_buy[self._row]))
+	mean_sell = property(lambda self: float(self._snapshot.mean_sell[self._row]))
+	margin = property(lambda self: float(self._snapshot.margin[self._row]))
+	volume_margin = property(lambda self: float(self._snapshot.volume_margin[self._row]))
+	fingerprint = property(lambda self: int(self._snapshot.getFingerprints()[self._row]))
+	median_buy = property(lambda self: int(self._snapshot.median_buy[self._row]))
+	median_sell = property(lambda self: int(self._snapshot.median_sell[self._row]))
+	mode_buy = property(lambda self: int(self._snapshot.mode_buy[self._row]))
+	mode_sell = property(lambda self: int(self._snapshot.mode_sell[self._row]))
@@ -0,0 +1,206 @@
+'''
+	Top K scanning of listings by margin, volume margin or any other score, for finding flips
+	without filtering and sorting every listing each time.
+
+	scan does a one off pass with a bounded heap.  An OpportunityScanner attached to a Listings
+	object keeps every qualifying item's score in a sorted list (see sortedlist) as listings are
+	fetched, so the current best K is just a slice, and a refreshed listing only moves its own entry.
+'''
+
+import heapq
+import math
+import sortedlist
+import threading
+
+
+def _scoreFunction(score):
+	'''
+		NOTE: INTERNAL FUNCTION
+		A callable score from an attribute name or a callable.
+	'''
+	if callable(score):
+		return score
+	return lambda listing: getattr(listing, score)
+
+
+class ListingFilter:
+	'''
+		The cheap checks a listing has to pass before it's scored.
+	'''
+	def __init__(self, min_buy_volume=1, min_sell_volume=1, min_price=0, max_price=None):
+		'''
+			:param min_buy_volume: Skip items with fewer units wanted than this.
+			:param min_sell_volume: Skip items with fewer units for sale than this.
+			:param min_price: Skip items whose best buy order is below this.
+			:param max_price: Skip items whose best buy order is above this; None for no limit.
+		'''
+		self.min_buy_volume = min_buy_volume
+		self.min_sell_volume = min_sell_volume
+		self.min_price = min_price
+		self.max_price = max_price
+
+
+	def __call__(self, listing):
+		return listing.buy_volume >= self.min_buy_volume \
+			and listing.sell_volume >= self.min_sell_volume \
+			and listing.max_buy >= self.min_price \
+			and (self.max_price is None or listing.max_buy <= self.max_price)
+
+
+def scan(listing_objects, k=100, score='margin', listing_filter=None):
+	'''
+		The k best listings by score, best first, in one pass holding at most k of them at once.
+
+			:param listing_objects: Iterable of ItemListings (or ItemPrices.)
+			:param k: How many to return.
+			:param score: An attribute name (e.g. 'margin', 'volume_margin') or a callable taking a listing.
+			:param listing_filter: Callable deciding which listings are considered; a default ListingFilter if None.
+	'''
+	score = _scoreFunction(score)
+	if listing_filter is None:
+		listing_filter = ListingFilter()
+
+	heap = [] # (score, id, listing), the worst of the best k on top.
+	for listing in listing_objects:
+		if not listing_filter(listing):
+			continue
+		listing_score = score(listing)
+		if listing_score is None or math.isnan(listing_score):
+			continue
+
+		entry = (listing_score, -listing.id, listing)
+		if len(heap) < k:
+			heapq.heappush(heap, entry)
+		elif entry[:2] > heap[0][:2]:
+			heapq.heapreplace(heap, entry)
+
+	return [listing for listing_score, negative_id, listing in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+
+
+class OpportunityScanner:
+	'''
+		Keeps listings ranked by score as they arrive, so the best K can be read at any time.
+		e.g.
+			scanner = opportunities.OpportunityScanner(score='margin', listing_filter=opportunities.ListingFilter(min_sell_volume=100))
+			scanner.attach(listing_api)
+			listing_api.getAllListings()
+			scanner.top(100)
+	'''
+	def __init__(self, score='margin', listing_filter=None):
+		'''
+			:param score: An attribute name (e.g. 'margin', 'volume_margin') or a callable taking a listing.
+			:param listing_filter: Callable deciding which listings are ranked; a default ListingFilter if None.
+		'''
+		self.score = _scoreFunction(score)
+		self.listing_filter = listing_filter if listing_filter is not None else ListingFilter()
+
+		self._ranking = sortedlist.SortedList() # (-score, id) ascending, i.e. best first.
+		self._scores = {} # id:score, for every ranked item
+		self._listings = {} # id:listing, for every ranked item
+		self._lock = threading.Lock()
+
+
+	def attach(self, listing_api):
+		'''
+			Rank every listing the given Listings object fetches from now on.
+
+				:param listing_api: A listings.Listings (or Prices) object.
+		'''
+		listing_api.subscribe(self.update)
+
+
+	def detach(self, listing_api):
+		'''
+			Stop ranking listings from a Listings object.
+
+				:param listing_api: A listings.Listings object given to attach.
+		'''
+		listing_api.unsubscribe(self.update)
+
+
+	def update(self, listing):
+		'''
+			Rank a new or refreshed listing, replacing whatever was ranked for its item.
+
+				:param listing: An ItemListings (or ItemPrices.)
+		'''
+		listing_score = None
+		if self.listing_filter(listing):
+			listing_score = self.score(listing)
+			if listing_score is not None and math.isnan(listing_score):
+				listing_score = None
+
+		with self._lock:
+			self._remove(listing.id)
+			if listing_score is None:
+				return
+			self._ranking.add((-listing_score, listing.id))
+			self._scores[listing.id] = listing_score
+			self._listings[listing.id] = listing
+
+
+	def updateMany(self, listing_objects):
+		'''
+			update for each of a batch of listings.
+
+				:param listing_objects: Iterable of listings.
+		'''
+		for listing in listing_objects:
+			self.update(listing)
+
+
+	def remove(self, item_id):
+		'''
+			Drop an item from the ranking.
+
+				:param item_id: The item id.
+		'''
+		with self._lock:
+			self._remove(item_id)
+
+
+	def _remove(self, item_id):
+		'''
+			NOTE: INTERNAL FUNCTION.  Call with the lock held.
+		'''
+		old_score = self._scores.pop(item_id, None)
+		if old_score is None:
+			return
+		del self._listings[item_id]
+		self._ranking.remove((-old_score, item_id))
+
+
+	def top(self, k=100):
+		'''
+			The k best ranked listings, best first.
+
+				:param k: How many to return.
+		'''
+		with self._lock:
+			return [self._listings[item_id] for negative_score, item_id in self._ranking.islice(0, k)]
+
+
+	def getScore(self, item_id):
+		'''
+			An item's current score, or None if it isn't ranked.
+
+				:param item_id: The item id.
+		'''
+		return self._scores.get(item_id)
+
+
+	def getRank(self, item_id):
+		'''
+			An item's position in the ranking (0 is best), or None if it isn't ranked.
+
+				:param item_id: The item id.
+		'''
+		with self._lock:
+			listing_score = self._scores.get(item_id)
+			if listing_score is None:
+				return None
+			return self._ranking.bisectLeft((-listing_score, item_id))
+
+
+	def __len__(self):
+		return len(self._ranking)
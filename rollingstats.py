@@ -0,0 +1,229 @@
+'''
+	Streaming per item market statistics, updated from each fresh listing as it's fetched, so
+	volatility and volume flow can be read at any time instead of sampled for minutes.
+
+	Every statistic is an exponentially weighted moving average (or variance) over a time window:
+	a sample dt seconds after the last counts for 1 - exp(-dt / window) of the new value.  That
+	copes with irregular polling, and each update is O(1) on a small fixed size array per item.
+	e.g.
+		stats = rollingstats.RollingStatistics(windows=(300, 3600))
+		stats.attach(listing_api)
+		...
+		stats.getVolatility(item_id)
+'''
+
+import array
+import math
+import threading
+import time
+
+
+# Layout of an item's state array: the last sample, then STATISTICS for each window.
+LAST_TIME, LAST_MAX_BUY, LAST_MIN_SELL, LAST_PRICE, LAST_BUY_VOLUME, LAST_SELL_VOLUME, SAMPLES = range(7)
+HEADER_SIZE = 7
+
+# The statistics kept for each window.  Flows are units per second; buy flow is the change in
+# buy order volume (negative when orders are filled or pulled), and the same for sell.
+STATISTICS = ('price', 'price_variance', 'return_variance', 'spread', 'spread_variance', \
+	'net_buy_flow', 'abs_buy_flow', 'net_sell_flow', 'abs_sell_flow')
+PRICE, PRICE_VARIANCE, RETURN_VARIANCE, SPREAD, SPREAD_VARIANCE, NET_BUY_FLOW, ABS_BUY_FLOW, NET_SELL_FLOW, ABS_SELL_FLOW \
+	= range(len(STATISTICS))
+
+NO_SELL = 99999999 # ItemListings.min_sell when there are no sell listings.
+
+
+def _ewmUpdate(state, mean_at, variance_at, value, alpha):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Incremental exponentially weighted mean and variance.
+	'''
+	difference = value - state[mean_at]
+	increment = alpha * difference
+	state[mean_at] += increment
+	state[variance_at] = (1 - alpha) * (state[variance_at] + difference * increment)
+
+
+class RollingStatistics:
+	'''
+		Per item rolling statistics over one or more time windows.  Feed it listings with update
+		(or attach it to a Listings object to have every freshly fetched listing fed in.)
+	'''
+	def __init__(self, windows=(300, 3600)):
+		'''
+			:param windows: The windows (in seconds) to keep statistics over; the first is the default for queries.
+		'''
+		self.windows = tuple(windows)
+		self.states = {} # id:array of state (see HEADER_SIZE, STATISTICS)
+		self._lock = threading.Lock()
+
+
+	def attach(self, listing_api):
+		'''
+			Update from every listing the given Listings object fetches from now on.
+
+				:param listing_api: A listings.Listings object.
+		'''
+		listing_api.subscribe(self.update)
+
+
+	def detach(self, listing_api):
+		'''
+			Stop updating from a Listings object.
+
+				:param listing_api: A listings.Listings object given to attach.
+		'''
+		listing_api.unsubscribe(self.update)
+
+
+	@staticmethod
+	def _price(max_buy, min_sell):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The mid price, or whichever side exists.  None with no orders at all.
+		'''
+		has_buy, has_sell = max_buy > 0, min_sell < NO_SELL
+		if has_buy and has_sell:
+			return (max_buy + min_sell) / 2
+		if has_buy:
+			return float(max_buy)
+		if has_sell:
+			return float(min_sell)
+		return None
+
+
+	def update(self, listing, timestamp=None):
+		'''
+			Fold a new sample of an item into its statistics.
+
+				:param listing: An ItemListings (or anything with id, max_buy, min_sell, buy_volume, sell_volume.)
+				:param timestamp: When the sample was taken; now if None.
+		'''
+		if timestamp is None:
+			timestamp = time.time()
+		max_buy, min_sell = listing.max_buy, listing.min_sell
+		buy_volume, sell_volume = listing.buy_volume, listing.sell_volume
+		price = self._price(max_buy, min_sell)
+		spread = min_sell - max_buy if max_buy > 0 and min_sell < NO_SELL else None
+
+		with self._lock:
+			state = self.states.get(listing.id)
+			if state is None:
+				state = array.array('d', [0.0]) * (HEADER_SIZE + len(STATISTICS) * len(self.windows))
+				for offset in range(HEADER_SIZE, len(state), len(STATISTICS)):
+					state[offset + PRICE] = price or 0.0
+					state[offset + SPREAD] = spread or 0.0
+				self._setLast(state, timestamp, max_buy, min_sell, price, buy_volume, sell_volume)
+				state[SAMPLES] = 1
+				self.states[listing.id] = state
+				return
+
+			elapsed = timestamp - state[LAST_TIME]
+			if elapsed <= 0:
+				return
+
+			buy_flow = (buy_volume - state[LAST_BUY_VOLUME]) / elapsed
+			sell_flow = (sell_volume - state[LAST_SELL_VOLUME]) / elapsed
+			log_return = None
+			if price is not None and state[LAST_PRICE] > 0:
+				log_return = math.log(price / state[LAST_PRICE])
+
+			for window_number, window in enumerate(self.windows):
+				offset = HEADER_SIZE + window_number * len(STATISTICS)
+				alpha = 1 - math.exp(-elapsed / window)
+
+				if price is not None:
+					_ewmUpdate(state, offset + PRICE, offset + PRICE_VARIANCE, price, alpha)
+				if log_return is not None:
+					# Returns are taken to average 0, so only their variance is kept.
+					state[offset + RETURN_VARIANCE] += alpha * (log_return * log_return - state[offset + RETURN_VARIANCE])
+				if spread is not None:
+					_ewmUpdate(state, offset + SPREAD, offset + SPREAD_VARIANCE, spread, alpha)
+
+				state[offset + NET_BUY_FLOW] += alpha * (buy_flow - state[offset + NET_BUY_FLOW])
+				state[offset + ABS_BUY_FLOW] += alpha * (abs(buy_flow) - state[offset + ABS_BUY_FLOW])
+				state[offset + NET_SELL_FLOW] += alpha * (sell_flow - state[offset + NET_SELL_FLOW])
+				state[offset + ABS_SELL_FLOW] += alpha * (abs(sell_flow) - state[offset + ABS_SELL_FLOW])
+
+			self._setLast(state, timestamp, max_buy, min_sell, price if price is not None else state[LAST_PRICE], \
+				buy_volume, sell_volume)
+			state[SAMPLES] += 1
+
+
+	@staticmethod
+	def _setLast(state, timestamp, max_buy, min_sell, price, buy_volume, sell_volume):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		state[LAST_TIME] = timestamp
+		state[LAST_MAX_BUY] = max_buy
+		state[LAST_MIN_SELL] = min_sell
+		state[LAST_PRICE] = price or 0.0
+		state[LAST_BUY_VOLUME] = buy_volume
+		state[LAST_SELL_VOLUME] = sell_volume
+
+
+	def _offset(self, window):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		if window is None:
+			return HEADER_SIZE
+		return HEADER_SIZE + self.windows.index(window) * len(STATISTICS)
+
+
+	def getStatistics(self, item_id, window=None):
+		'''
+			An item's current statistics over a window as a dict, or None if it's never been seen.
+			Besides STATISTICS, includes price_stddev, spread_stddev, volatility (see getVolatility),
+			samples and last_time.
+
+				:param item_id: The item id.
+				:param window: One of the windows given to __init__; the first if None.
+		'''
+		offset = self._offset(window)
+		with self._lock:
+			state = self.states.get(item_id)
+			if state is None:
+				return None
+			statistics = {name:state[offset + position] for position, name in enumerate(STATISTICS)}
+			statistics["samples"] = int(state[SAMPLES])
+			statistics["last_time"] = state[LAST_TIME]
+
+		statistics["price_stddev"] = math.sqrt(statistics["price_variance"])
+		statistics["spread_stddev"] = math.sqrt(statistics["spread_variance"])
+		statistics["volatility"] = math.sqrt(statistics["return_variance"])
+		return statistics
+
+
+	def getVolatility(self, item_id, window=None):
+		'''
+			The standard deviation of an item's price changes between samples (as log returns, so
+			.01 is about 1%), or None if it's never been seen.
+
+				:param item_id: The item id.
+				:param window: One of the windows given to __init__; the first if None.
+		'''
+		offset = self._offset(window)
+		with self._lock:
+			state = self.states.get(item_id)
+			if state is None:
+				return None
+			return math.sqrt(state[offset + RETURN_VARIANCE])
+
+
+	def forget(self, item_id):
+		'''
+			Drop an item's statistics.
+
+				:param item_id: The item id.
+		'''
+		with self._lock:
+			self.states.pop(item_id, None)
+
+
+	def __contains__(self, item_id):
+		return item_id in self.states
+
+
+	def __len__(self):
+		return len(self.states)
@@ -0,0 +1,264 @@
+'''
+	A sorted list that stays cheap to insert into and remove from as it grows: values are kept in
+	blocks of a few hundred, each sorted, with the largest value of each block in a list of its own.
+	An insert or remove binary searches for its block and shifts only that block; a tree of block
+	lengths turns block positions into list positions (and back) in O(log n), for ranks and slices.
+	e.g.
+		values = sortedlist.SortedList()
+		values.add((120, 19721))
+		values.remove((120, 19721))
+		values[values.bisectLeft((100, -1)):values.bisectRight((200, float("inf")))]
+'''
+
+import bisect
+
+
+class SortedList:
+	'''
+		Values in ascending order, with O(log n) add, remove, bisect and positional lookup.
+	'''
+	def __init__(self, values=(), load=500):
+		'''
+			:param values: Values to start with, in any order.
+			:param load: The target block length; blocks are split at twice this and merged below half.
+		'''
+		self.load = load
+		self._len = 0
+		self._blocks = [] # sorted lists, each following on from the last
+		self._maxes = [] # the last (largest) value of each block
+		self._tree = None # Fenwick tree of block lengths, rebuilt when blocks split or merge
+
+		values = sorted(values)
+		for start in range(0, len(values), load):
+			self._blocks.append(values[start : start + load])
+			self._maxes.append(self._blocks[-1][-1])
+		self._len = len(values)
+
+
+	def add(self, value):
+		'''
+			Insert a value in order.
+
+				:param value: The value; must be comparable with those already held.
+		'''
+		if not self._blocks:
+			self._blocks.append([value])
+			self._maxes.append(value)
+			self._len = 1
+			self._tree = None
+			return
+
+		block_number = bisect.bisect_right(self._maxes, value)
+		if block_number == len(self._blocks):
+			block_number -= 1
+			self._blocks[block_number].append(value)
+			self._maxes[block_number] = value
+		else:
+			bisect.insort(self._blocks[block_number], value)
+		self._len += 1
+
+		if len(self._blocks[block_number]) > 2 * self.load:
+			self._split(block_number)
+		elif self._tree is not None:
+			self._treeAdd(block_number, 1)
+
+
+	def remove(self, value):
+		'''
+			Remove one occurrence of a value, raising ValueError if there isn't one.
+
+				:param value: The value.
+		'''
+		block_number = bisect.bisect_left(self._maxes, value)
+		if block_number < len(self._blocks):
+			block = self._blocks[block_number]
+			position = bisect.bisect_left(block, value)
+			if position < len(block) and block[position] == value:
+				del block[position]
+				self._len -= 1
+				if block:
+					self._maxes[block_number] = block[-1]
+				if len(block) < self.load // 2:
+					self._merge(block_number)
+				elif self._tree is not None:
+					self._treeAdd(block_number, -1)
+				return
+
+		raise ValueError(str(value) + " not in SortedList")
+
+
+	def discard(self, value):
+		'''
+			Remove one occurrence of a value, if there is one.
+
+				:param value: The value.
+		'''
+		try:
+			self.remove(value)
+		except ValueError:
+			pass
+
+
+	def _split(self, block_number):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Split an overgrown block in two.
+		'''
+		block = self._blocks[block_number]
+		self._blocks.insert(block_number + 1, block[self.load:])
+		del block[self.load:]
+		self._maxes.insert(block_number, block[-1])
+		self._tree = None
+
+
+	def _merge(self, block_number):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Fold an undersized (or empty) block into its neighbour, splitting the result again if it's too long.
+		'''
+		block = self._blocks[block_number]
+		if not block:
+			del self._blocks[block_number]
+			del self._maxes[block_number]
+		elif len(self._blocks) > 1:
+			neighbour = block_number - 1 if block_number > 0 else block_number + 1
+			first = min(block_number, neighbour)
+			self._blocks[first] += self._blocks[first + 1]
+			del self._blocks[first + 1]
+			del self._maxes[first]
+			if len(self._blocks[first]) > 2 * self.load:
+				self._split(first)
+		self._tree = None
+
+
+	def _buildTree(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The Fenwick tree of block lengths, building it if blocks have split or merged since the last one.
+		'''
+		if self._tree is None:
+			tree = [len(block) for block in self._blocks]
+			for index in range(len(tree)):
+				parent = index | (index + 1)
+				if parent < len(tree):
+					tree[parent] += tree[index]
+			self._tree = tree
+		return self._tree
+
+
+	def _treeAdd(self, block_number, delta):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Change a block's length in the tree.
+		'''
+		tree = self._tree
+		while block_number < len(tree):
+			tree[block_number] += delta
+			block_number |= block_number + 1
+
+
+	def _blockStart(self, block_number):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The list position of a block's first value.
+		'''
+		tree = self._buildTree()
+		position = 0
+		while block_number > 0:
+			position += tree[block_number - 1]
+			block_number &= block_number - 1
+		return position
+
+
+	def _locate(self, position):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The block, and position within it, of a list position. (0 <= position < len)
+		'''
+		tree = self._buildTree()
+		block_number = 0
+		step = 1 << (len(tree).bit_length() - 1)
+		while step:
+			if block_number + step <= len(tree) and tree[block_number + step - 1] <= position:
+				block_number += step
+				position -= tree[block_number - 1]
+			step >>= 1
+		return block_number, position
+
+
+	def bisectLeft(self, value):
+		'''
+			The position of the first value >= value.
+
+				:param value: The value to search for.
+		'''
+		block_number = bisect.bisect_left(self._maxes, value)
+		if block_number == len(self._blocks):
+			return self._len
+		return self._blockStart(block_number) + bisect.bisect_left(self._blocks[block_number], value)
+
+
+	def bisectRight(self, value):
+		'''
+			The position of the first value > value.
+
+				:param value: The value to search for.
+		'''
+		block_number = bisect.bisect_right(self._maxes, value)
+		if block_number == len(self._blocks):
+			return self._len
+		return self._blockStart(block_number) + bisect.bisect_right(self._blocks[block_number], value)
+
+
+	def islice(self, start=0, stop=None):
+		'''
+			Iterate over the values from position start up to (not including) stop.
+
+				:param start: The first position.
+				:param stop: The position to stop at; the end if None.
+		'''
+		stop = self._len if stop is None else min(stop, self._len)
+		if start >= stop:
+			return
+		block_number, position = self._locate(start)
+		remaining = stop - start
+		while remaining > 0:
+			block = self._blocks[block_number]
+			values = block[position : position + remaining]
+			yield from values
+			remaining -= len(values)
+			block_number += 1
+			position = 0
+
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, stride = index.indices(self._len)
+			if stride != 1:
+				return [self[position] for position in range(start, stop, stride)]
+			return list(self.islice(start, stop))
+
+		if index < 0:
+			index += self._len
+		if not 0 <= index < self._len:
+			raise IndexError("SortedList index out of range")
+		block_number, position = self._locate(index)
+		return self._blocks[block_number][position]
+
+
+	def __contains__(self, value):
+		block_number = bisect.bisect_left(self._maxes, value)
+		if block_number == len(self._blocks):
+			return False
+		block = self._blocks[block_number]
+		position = bisect.bisect_left(block, value)
+		return position < len(block) and block[position] == value
+
+
+	def __iter__(self):
+		for block in self._blocks:
+			yield from block
+
+
+	def __len__(self):
+		return self._len
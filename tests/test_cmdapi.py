@@ -0,0 +1,70 @@
+'''
+	Query planning must never change what a query returns.  Run from the repository root:
+		python -m pytest tests
+'''
+
+import unittest
+
+import cmdapi
+
+
+class Record:
+	def __init__(self, **fields):
+		self.__dict__.update(fields)
+
+
+class TestWherePushDown(unittest.TestCase):
+	def assertSameResults(self, build):
+		'''
+			A query with a where clause declared to read only some tables returns what it does undeclared
+			(which is never moved ahead of a join.)
+		'''
+		declared = build(lambda query, where, tables: query.Where(where, tables=tables))
+		undeclared = build(lambda query, where, tables: query.Where(where))
+		self.assertEqual(declared.Evaluate(), undeclared.Evaluate())
+		self.assertEqual(declared.results, undeclared.results)
+		return declared.Evaluate()
+
+
+	def testSelfJoin(self):
+		# Joining a to itself replaces each row's a artifact, so a clause on a has to see the replacement.
+		tables = {'a':[Record(id=1, x=10, y=20, v=1), Record(id=2, x=20, y=30, v=0)]}
+		evaluated = self.assertSameResults(lambda where: where(cmdapi.Query(tables).From('a').Join('a', 'x', 'y'), \
+			lambda artifact_group: artifact_group['a'].v == 1, ('a',)).Select('id'))
+		self.assertEqual(evaluated, [])
+
+
+	def testDoubleJoin(self):
+		# The second join on b replaces the b artifact the first one added.
+		tables = {
+			'a':[Record(id=1)],
+			'b':[Record(id=1, key=9, ok=True), Record(id=5, key=1, ok=False)],
+		}
+		evaluated = self.assertSameResults(lambda where: where(cmdapi.Query(tables).From('a').Join('b', 'id').Join('b', 'key', 'id'), \
+			lambda artifact_group: 'b' in artifact_group and artifact_group['b'].ok, ('b',)).Select('id', 'ok'))
+		self.assertEqual(evaluated, [])
+
+
+	def testRepeatedJoinValues(self):
+		# Rows sharing a join value merge into the last of them before the clause is checked.
+		tables = {
+			'items':[Record(id=1, level=80, group=7), Record(id=2, level=0, group=7)],
+			'listings':[Record(group=7, margin=0.5)],
+		}
+		evaluated = self.assertSameResults(lambda where: where(cmdapi.Query(tables).From('items').Join('listings', 'group'), \
+			lambda artifact_group: artifact_group['items'].level == 80, ('items',)).Select('id', 'margin'))
+		self.assertEqual(evaluated, [])
+
+
+	def testDistinctTables(self):
+		tables = {
+			'items':[Record(id=item_id, level=80 if item_id % 2 else 0) for item_id in range(10)],
+			'listings':[Record(id=item_id, margin=item_id / 10) for item_id in range(0, 10, 3)],
+		}
+		evaluated = self.assertSameResults(lambda where: where(cmdapi.Query(tables).From('items').Join('listings', 'id'), \
+			lambda artifact_group: artifact_group['items'].level == 80, ('items',)).Select('id', 'margin'))
+		self.assertEqual(evaluated, [{'id':item_id, 'margin':item_id / 10 if item_id % 3 == 0 else None} for item_id in range(1, 10, 2)])
+
+
+if __name__ == '__main__':
+	unittest.main()
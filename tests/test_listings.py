@@ -0,0 +1,56 @@
+'''
+	Listings behaviour over scripted polls, with no API calls.  Run from the repository root:
+		python -m pytest tests
+'''
+
+import unittest
+
+import listings
+
+
+def rawListing(item_id, buys, sells):
+	'''
+		A raw listing record, with buys and sells as lists of (unit_price, quantity).
+	'''
+	return {
+		"id":item_id,
+		"buys":[{"listings":1, "unit_price":unit_price, "quantity":quantity} for unit_price, quantity in buys],
+		"sells":[{"listings":1, "unit_price":unit_price, "quantity":quantity} for unit_price, quantity in sells],
+	}
+
+
+class ScriptedListings(listings.Listings):
+	'''
+		Listings whose polls return a fixed sequence of books instead of calling the API.
+	'''
+	def __init__(self, polls):
+		super().__init__()
+		self.polls = iter(polls)
+
+
+	def getListingsById(self, listing_ids, use_cache=False):
+		return [listings.ItemListings(raw_listing) for raw_listing in next(self.polls)]
+
+
+class TestApproximateItemVolatility(unittest.TestCase):
+	def testVolumeChangesBetweenPolls(self):
+		# 31 polls: the sell side drops from 10 units to 7 and back every poll, while the buy side's single
+		# order moves up a coin each poll without changing size.
+		polls = [[rawListing(1, [(100 + poll, 5)], [(200, 7 if poll % 2 else 10)])] for poll in range(31)]
+
+		volatility = ScriptedListings(polls).getApproximateItemVolatility(1, delay=0)
+
+		self.assertEqual(dict(volatility[1]), {"net_buy":0, "net_sell":0, "abs_buy":0, "abs_sell":3})
+
+
+	def testSteadyDrain(self):
+		# Each poll, 2 more units are bought out of the sell side; it ends 60 units lower.
+		polls = [[rawListing(7, [(50, 1)], [(80, 100 - 2 * poll)])] for poll in range(31)]
+
+		volatility = ScriptedListings(polls).getApproximateItemVolatility([7], delay=0)
+
+		self.assertEqual(dict(volatility[7]), {"net_buy":0, "net_sell":2, "abs_buy":0, "abs_sell":2})
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,172 @@
+'''
+	Inverted indexes for searching item text (names, descriptions) without walking every item.
+
+	Each text is lowercased once and indexed both by its words and by its trigrams (every run of
+	three characters, with a space at either end.)  A substring search intersects the posting sets
+	of the search term's trigrams, smallest first, and only checks the few texts left; a fuzzy search
+	counts shared trigrams, so it still finds names with a typo or two.
+'''
+
+import collections
+import re
+
+
+WORD = re.compile(r"\w+")
+
+
+def _trigrams(text):
+	'''
+		NOTE: INTERNAL FUNCTION
+		The set of trigrams in an already lowercased text.
+	'''
+	return {text[position:position + 3] for position in range(len(text) - 2)}
+
+
+class TextIndex:
+	'''
+		Word and trigram index over one text field of a set of items.
+	'''
+	def __init__(self):
+		self.texts = {} # id:lowercased text
+		self.words = collections.defaultdict(set) # word:ids
+		self.trigrams = collections.defaultdict(set) # trigram:ids
+		self._trigram_counts = {} # id:number of distinct trigrams in its (padded) text
+
+
+	def add(self, item_id, text):
+		'''
+			Index an item's text, replacing what was indexed for it before.
+
+				:param item_id: The item id.
+				:param text: The text; None to just remove the item.
+		'''
+		self.remove(item_id)
+		if text is None:
+			return
+
+		text = text.lower()
+		self.texts[item_id] = text
+		for word in WORD.findall(text):
+			self.words[word].add(item_id)
+
+		text_trigrams = _trigrams(" " + text + " ")
+		for trigram in text_trigrams:
+			self.trigrams[trigram].add(item_id)
+		self._trigram_counts[item_id] = len(text_trigrams)
+
+
+	def remove(self, item_id):
+		'''
+			Drop an item from the index, if it's there.
+
+				:param item_id: The item id.
+		'''
+		text = self.texts.pop(item_id, None)
+		if text is None:
+			return
+
+		for word in WORD.findall(text):
+			self._discard(self.words, word, item_id)
+		for trigram in _trigrams(" " + text + " "):
+			self._discard(self.trigrams, trigram, item_id)
+		del self._trigram_counts[item_id]
+
+
+	@staticmethod
+	def _discard(postings, key, item_id):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		ids = postings.get(key)
+		if ids is not None:
+			ids.discard(item_id)
+			if not ids:
+				del postings[key]
+
+
+	def _candidates(self, term):
+		'''
+			NOTE: INTERNAL FUNCTION
+			A superset of the ids whose text contains term, or None if the index can't narrow it down.
+		'''
+		if len(term) >= 3:
+			postings = sorted((self.trigrams.get(trigram, ()) for trigram in _trigrams(term)), key=len)
+			if not postings[0]:
+				return set()
+			return set(postings[0]).intersection(*postings[1:])
+
+		if WORD.fullmatch(term):
+			# Too short for a trigram; any text containing it has a word containing it.
+			candidates = set()
+			for word, ids in self.words.items():
+				if term in word:
+					candidates |= ids
+			return candidates
+
+		return None
+
+
+	def search(self, *terms):
+		'''
+			The ids of items whose text contains every term (case insensitively.)
+
+				:param terms: The substrings to look for.
+		'''
+		terms = sorted((term.lower() for term in terms), key=len, reverse=True)
+		candidates = None
+		for term in terms:
+			term_candidates = self._candidates(term)
+			if term_candidates is not None:
+				candidates = term_candidates if candidates is None else candidates & term_candidates
+		if candidates is None:
+			candidates = self.texts.keys()
+
+		return {item_id for item_id in candidates if all(term in self.texts[item_id] for term in terms)}
+
+
+	def searchWords(self, *words):
+		'''
+			The ids of items whose text has every word as a whole word (case insensitively.)
+
+				:param words: The words to look for.
+		'''
+		postings = sorted((self.words.get(word.lower(), set()) for word in words), key=len)
+		if not postings:
+			return set(self.texts)
+		return set(postings[0]).intersection(*postings[1:])
+
+
+	def fuzzySearch(self, query, limit=10, min_similarity=0.3):
+		'''
+			The ids of the items whose text is most like the query, tolerating typos, as a list of
+			(similarity, id) best first.  Similarity is the Dice coefficient of the two texts' trigram
+			sets: 1 for the same text, 0 for nothing in common.
+
+				:param query: The text to look for.
+				:param limit: The most results to return.
+				:param min_similarity: Leave out anything less similar than this.
+		'''
+		query_trigrams = _trigrams(" " + query.lower() + " ")
+		if not query_trigrams:
+			return []
+
+		shared = collections.Counter()
+		for trigram in query_trigrams:
+			shared.update(self.trigrams.get(trigram, ()))
+
+		results = []
+		for item_id, count in shared.items():
+			similarity = 2 * count / (len(query_trigrams) + self._trigram_counts[item_id])
+			if similarity >= min_similarity:
+				results.append((similarity, item_id))
+
+		results.sort(key=lambda result: (-result[0], result[1]))
+		return results[:limit]
+
+
+	def __contains__(self, item_id):
+		return item_id in self.texts
+
+
+	def __len__(self):
+		return len(self.texts)
@@ -1,14 +1,26 @@
+import asyncio
+import atexit
+import concurrent.futures
 import http.client as httplib
+import collections
 import json
 from urllib.parse import urlparse
 import threading
+import select
+import socket
 import logging
 import sys
 import math
+import multiprocessing
 import time
 import datetime
+import email.utils
+import random
 import base64
 import codecs
+import hashlib
+import itertools
+import os
 import struct
 import time
 
@@ -23,44 +35,752 @@ logger.addHandler(handler)
 logger.info('Logging enabled.')
 
 
-def apiCall(resource):
+class ConnectionPool:
 	'''
-		Core API call to the api.guildwars2.com api. Simply makes an http
+		Thread safe pool of keep-alive http(s) connections, keyed by (protocol, host).
+		A connection is only ever handed to one caller at a time, and goes back into the pool
+		once its response has been read in full.
+	'''
+	# Errors that mean the socket under a connection has gone away, rather than the API misbehaving.
+	connection_errors = (httplib.RemoteDisconnected, httplib.BadStatusLine, httplib.CannotSendRequest, \
+			httplib.ResponseNotReady, ConnectionError, socket.timeout)
+
+	def __init__(self, max_idle_per_host=16, idle_timeout=60, timeout=30):
+		'''
+			Initialize a new pool.
+
+				:param max_idle_per_host: How many idle connections to keep around per (protocol, host).
+				:param idle_timeout: Seconds an idle connection may sit in the pool before it is thrown out.
+				:param timeout: Socket timeout (in seconds) for connections created by the pool.
+		'''
+		self.max_idle_per_host = max_idle_per_host
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+
+		self._idle = collections.defaultdict(list) # (protocol, host):[(connection, time released)]
+		self._lock = threading.Lock()
+
+
+	def getConnection(self, protocol, host):
+		'''
+			Get a connection to the given host, reusing an idle one if there is a live one available.
+
+				:param protocol: "https" or "http"
+				:param host: The host (e.g. api.guildwars2.com) to connect to.
+		'''
+		key = (protocol, host)
+		while True:
+			with self._lock:
+				if not self._idle[key]:
+					break
+				connection, released_at = self._idle[key].pop()
+
+			if time.time() - released_at < self.idle_timeout and not self._isDead(connection):
+				return connection
+
+			logger.debug("Dropping dead pooled connection to: " + str(protocol) + str(host))
+			connection.close()
+
+		if protocol == "https":
+			return httplib.HTTPSConnection(host, timeout=self.timeout)
+		return httplib.HTTPConnection(host, timeout=self.timeout)
+
+
+	def releaseConnection(self, protocol, host, connection):
+		'''
+			Hand a connection back to the pool once its response has been fully read.
+
+				:param protocol: The protocol the connection was requested with.
+				:param host: The host the connection was requested with.
+				:param connection: The connection to return.
+		'''
+		key = (protocol, host)
+		with self._lock:
+			if connection.sock is not None and len(self._idle[key]) < self.max_idle_per_host:
+				self._idle[key].append((connection, time.time()))
+				return
+
+		connection.close()
+
+
+	def discardConnection(self, connection):
+		'''
+			Throw away a connection that errored or that the server asked us to close.
+
+				:param connection: The connection to close.
+		'''
+		connection.close()
+
+
+	def closeAll(self):
+		'''
+			Close every idle connection held by the pool.
+		'''
+		with self._lock:
+			idle = self._idle
+			self._idle = collections.defaultdict(list)
+
+		for connections in idle.values():
+			for connection, released_at in connections:
+				connection.close()
+
+
+	def _isDead(self, connection):
+		'''
+			NOTE: INTERNAL FUNCTION
+			An idle keep-alive socket should have nothing to read; if it does, the server either
+			hung up on us (EOF) or sent something we never asked for.  Either way it's unusable.
+
+				:param connection: The idle connection to examine.
+		'''
+		if connection.sock is None:
+			return True
+
+		try:
+			readable, writable, errored = select.select([connection.sock], [], [], 0)
+		except (OSError, ValueError):
+			return True
+
+		return bool(readable)
+
+
+connection_pool = ConnectionPool()
+
+
+class ApiError(Exception):
+	'''
+		Raised when an API call fails outright (after any retries.)
+		status is the http status the API answered with, if it answered at all.
+	'''
+	def __init__(self, message, status=None):
+		super().__init__(message)
+		self.status = status
+
+
+class CircuitOpenError(ApiError):
+	'''
+		Raised instead of making a request while the circuit breaker is open.
+	'''
+	pass
+
+
+class RateLimiter:
+	'''
+		Process wide token bucket.  Every request made through apiCall takes a token first,
+		so all threads (watchers, queries, sweeps) share one request budget.
+	'''
+	def __init__(self, rate=10, burst=50):
+		'''
+			Initialize a new limiter.
+
+				:param rate: Tokens (requests) added per second.
+				:param burst: The most tokens that can be saved up.
+		'''
+		self.rate = rate
+		self.burst = burst
+
+		self._tokens = burst
+		self._last_refill = time.monotonic()
+		self._paused_until = 0
+		self._lock = threading.Lock()
+
+
+	def acquire(self):
+		'''
+			Block until a request may be made, then consume a token for it.
+		'''
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+				self._last_refill = now
+
+				if now < self._paused_until:
+					wait = self._paused_until - now
+				elif self._tokens >= 1:
+					self._tokens -= 1
+					return
+				else:
+					wait = (1 - self._tokens) / self.rate
+
+			time.sleep(wait)
+
+
+	def pauseFor(self, seconds):
+		'''
+			Stop handing out tokens to anyone for a while (e.g. the API sent a Retry-After.)
+
+				:param seconds: How long to pause for.
+		'''
+		with self._lock:
+			self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+	'''
+		Stops requests from being made at all once the API has failed enough times in a row,
+		so callers fail fast instead of queueing up behind retries.  After reset_timeout a single
+		trial request is let through; its success closes the circuit again.  If the trial hasn't
+		reported back within another reset_timeout, the next thread to ask takes the trial over.
+	'''
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, failure_threshold=10, reset_timeout=30):
+		'''
+			Initialize a new breaker.
+
+				:param failure_threshold: Consecutive failures before the circuit opens.
+				:param reset_timeout: Seconds to wait before letting a trial request through.
+		'''
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+
+		self.state = self.CLOSED
+		self._failures = 0
+		self._opened_at = 0
+		self._trial_thread = None
+		self._trial_started = 0
+		self._lock = threading.Lock()
+
+
+	def allowRequest(self):
+		'''
+			Returns true if a request may be made right now.
+		'''
+		with self._lock:
+			if self.state == self.CLOSED:
+				return True
+
+			now = time.monotonic()
+			if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+				logger.info("Circuit breaker half open, sending a trial request.")
+				self.state = self.HALF_OPEN
+				self._trial_thread = threading.get_ident()
+				self._trial_started = now
+				return True
+
+			# A trial that never reported back (e.g. its thread died on an unexpected error) is taken over.
+			if self.state == self.HALF_OPEN and now - self._trial_started >= self.reset_timeout:
+				logger.info("Circuit breaker trial request timed out, sending another.")
+				self._trial_thread = threading.get_ident()
+				self._trial_started = now
+				return True
+
+			# The trial request may need a few round trips of its own (redirects, reconnects.)
+			return self.state == self.HALF_OPEN and self._trial_thread == threading.get_ident()
+
+
+	def recordSuccess(self):
+		'''
+			Note that the API answered sensibly.
+		'''
+		with self._lock:
+			if self.state != self.CLOSED:
+				logger.info("Circuit breaker closed.")
+			self.state = self.CLOSED
+			self._failures = 0
+
+
+	def recordFailure(self):
+		'''
+			Note that a request failed in a way that might be the API's fault.
+		'''
+		with self._lock:
+			self._failures += 1
+			if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+				logger.error("Circuit breaker open after " + str(self._failures) + " consecutive failures.")
+				self.state = self.OPEN
+				self._opened_at = time.monotonic()
+
+
+rate_limiter = RateLimiter()
+circuit_breaker = CircuitBreaker()
+
+
+class CachedResponse:
+	'''
+		A single cached API response body, plus what's needed to tell if it's fresh
+		and to revalidate it if not.
+	'''
+	def __init__(self, body, expires=0, etag=None, last_modified=None):
+		'''
+			:param body: The raw response body.
+			:param expires: Time (epoch seconds) after which the response must be revalidated.
+			:param etag: The ETag validator sent with the response, if any.
+			:param last_modified: The Last-Modified validator sent with the response, if any.
+		'''
+		self.body = body
+		self.expires = expires
+		self.etag = etag
+		self.last_modified = last_modified
+
+
+	def isFresh(self):
+		'''
+			Returns true if the response may be served without asking the API.
+		'''
+		# No expiry means the API said not to store it (no-store), so it's never fresh.
+		return self.expires is not None and time.time() < self.expires
+
+
+	def refresh(self, headers):
+		'''
+			Update freshness (and validators, if sent) from the headers of a 304 or a new response.
+
+				:param headers: The http.client response (or anything with getheader).
+		'''
+		self.expires = _cacheExpiry(headers)
+		self.etag = headers.getheader('etag') or self.etag
+		self.last_modified = headers.getheader('last-modified') or self.last_modified
+
+
+def _cacheExpiry(headers):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Work out when a response stops being fresh from its Cache-Control (or Expires) headers.
+		Returns None if the response must not be stored at all.
+
+			:param headers: The http.client response (or anything with getheader).
+	'''
+	now = time.time()
+	cache_control = {}
+	for directive in (headers.getheader('cache-control') or "").split(','):
+		name, _, value = directive.strip().partition('=')
+		cache_control[name.lower()] = value.strip('"')
+
+	if "no-store" in cache_control:
+		return None
+	if "no-cache" in cache_control:
+		return now
+
+	try:
+		age = float(headers.getheader('age') or 0)
+	except ValueError:
+		age = 0
+
+	if "max-age" in cache_control:
+		try:
+			return now + float(cache_control["max-age"]) - age
+		except ValueError:
+			return now
+
+	expires = headers.getheader('expires')
+	if expires:
+		try:
+			return email.utils.parsedate_to_datetime(expires).timestamp()
+		except (TypeError, ValueError):
+			return now
+
+	return now
+
+
+class ResponseCache:
+	'''
+		Optional http cache underneath apiCall.  Holds response bodies in memory (most recently
+		used first), spilling to an optional disk directory.  Both tiers are bounded in bytes and
+		evict least recently used entries first.
+		Enable it with setResponseCache(ResponseCache(...)).
+	'''
+	def __init__(self, max_memory_bytes=64 * 1024 * 1024, cache_dir=None, max_disk_bytes=512 * 1024 * 1024):
+		'''
+			Initialize a new cache.
+
+				:param max_memory_bytes: The most response body bytes to hold in memory.
+				:param cache_dir: Directory for the disk tier; None to only cache in memory.
+				:param max_disk_bytes: The most bytes to keep in the disk tier.
+		'''
+		self.max_memory_bytes = max_memory_bytes
+		self.cache_dir = cache_dir
+		self.max_disk_bytes = max_disk_bytes
+
+		self.hits = 0 # Served fresh, no request made.
+		self.revalidations = 0 # Stale, but the API said 304.
+		self.misses = 0 # Not cached (or changed), full body fetched.
+
+		self._memory = collections.OrderedDict() # key:CachedResponse, oldest first.
+		self._memory_bytes = 0
+		self._disk = collections.OrderedDict() # file name:size, oldest first.
+		self._disk_bytes = 0
+		self._lock = threading.Lock()
+
+		if cache_dir:
+			os.makedirs(cache_dir, exist_ok=True)
+			for file_name in sorted(os.listdir(cache_dir), key=lambda name: os.path.getmtime(os.path.join(cache_dir, name))):
+				if file_name.endswith(".cache"):
+					size = os.path.getsize(os.path.join(cache_dir, file_name))
+					self._disk[file_name] = size
+					self._disk_bytes += size
+
+
+	def get(self, key):
+		'''
+			Returns the cached response for a key (fresh or not), or None.
+
+				:param key: The full url the response was fetched from.
+		'''
+		with self._lock:
+			entry = self._memory.get(key)
+			if entry:
+				self._memory.move_to_end(key)
+				return entry
+
+			entry = self._readDisk(key)
+			if entry:
+				self._storeMemory(key, entry)
+			return entry
+
+
+	def put(self, key, entry):
+		'''
+			Cache a response in both tiers.
+
+				:param key: The full url the response was fetched from.
+				:param entry: The CachedResponse to store.
+		'''
+		with self._lock:
+			self._storeMemory(key, entry)
+			self._writeDisk(key, entry)
+
+
+	def remove(self, key):
+		'''
+			Drop one entry from both tiers, if it's there.
+
+				:param key: The full url the response was fetched from.
+		'''
+		with self._lock:
+			old_entry = self._memory.pop(key, None)
+			if old_entry:
+				self._memory_bytes -= len(old_entry.body)
+
+			file_name = self._diskFileName(key)
+			if file_name in self._disk:
+				self._disk_bytes -= self._disk.pop(file_name)
+				self._removeDiskFile(file_name)
+
+
+	def clear(self):
+		'''
+			Drop everything from both tiers.
+		'''
+		with self._lock:
+			self._memory.clear()
+			self._memory_bytes = 0
+			for file_name in self._disk:
+				self._removeDiskFile(file_name)
+			self._disk.clear()
+			self._disk_bytes = 0
+
+
+	def record(self, outcome):
+		'''
+			Count a lookup outcome.
+
+				:param outcome: One of "hits", "revalidations" or "misses".
+		'''
+		with self._lock:
+			setattr(self, outcome, getattr(self, outcome) + 1)
+
+
+	def stats(self):
+		'''
+			Returns the hit/revalidation/miss counters and current tier sizes.
+		'''
+		with self._lock:
+			return {"hits":self.hits, "revalidations":self.revalidations, "misses":self.misses, \
+				"memory_entries":len(self._memory), "memory_bytes":self._memory_bytes, \
+				"disk_entries":len(self._disk), "disk_bytes":self._disk_bytes}
+
+
+	def _storeMemory(self, key, entry):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Put an entry in the memory tier, evicting the least recently used ones to make room.
+		'''
+		old_entry = self._memory.pop(key, None)
+		if old_entry:
+			self._memory_bytes -= len(old_entry.body)
+
+		if len(entry.body) > self.max_memory_bytes:
+			return
+
+		self._memory[key] = entry
+		self._memory_bytes += len(entry.body)
+
+		while self._memory_bytes > self.max_memory_bytes:
+			evicted_key, evicted = self._memory.popitem(last=False)
+			self._memory_bytes -= len(evicted.body)
+
+
+	def _diskFileName(self, key):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		return hashlib.sha1(key.encode()).hexdigest() + ".cache"
+
+
+	def _readDisk(self, key):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Load an entry from the disk tier, if it's there.  Files are a json header line followed by the body.
+		'''
+		if not self.cache_dir:
+			return None
+
+		file_name = self._diskFileName(key)
+		if file_name not in self._disk:
+			return None
+
+		try:
+			with open(os.path.join(self.cache_dir, file_name), 'rb') as f:
+				header = json.loads(f.readline().decode())
+				body = f.read()
+		except (OSError, ValueError) as e:
+			logger.error("Dropping unreadable cache file " + file_name + " : " + str(e))
+			self._disk_bytes -= self._disk.pop(file_name)
+			self._removeDiskFile(file_name)
+			return None
+
+		if header.get("key") != key:
+			return None
+
+		self._disk.move_to_end(file_name)
+		return CachedResponse(body, header["expires"], header["etag"], header["last_modified"])
+
+
+	def _writeDisk(self, key, entry):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Write an entry to the disk tier (atomically), evicting the least recently used files to make room.
+		'''
+		if not self.cache_dir:
+			return
+
+		file_name = self._diskFileName(key)
+		header = json.dumps({"key":key, "expires":entry.expires, "etag":entry.etag, "last_modified":entry.last_modified})
+		data = header.encode() + b'\n' + entry.body
+		if len(data) > self.max_disk_bytes:
+			return
+
+		path = os.path.join(self.cache_dir, file_name)
+		try:
+			with open(path + ".tmp", 'wb') as f:
+				f.write(data)
+			os.replace(path + ".tmp", path)
+		except OSError as e:
+			logger.error("Failed to write cache file " + file_name + " : " + str(e))
+			return
+
+		self._disk_bytes -= self._disk.pop(file_name, 0)
+		self._disk[file_name] = len(data)
+		self._disk_bytes += len(data)
+
+		while self._disk_bytes > self.max_disk_bytes:
+			evicted_name, evicted_size = self._disk.popitem(last=False)
+			self._disk_bytes -= evicted_size
+			self._removeDiskFile(evicted_name)
+
+
+	def _removeDiskFile(self, file_name):
+		'''
+			NOTE: INTERNAL FUNCTION
+		'''
+		try:
+			os.remove(os.path.join(self.cache_dir, file_name))
+		except OSError:
+			pass
+
+
+response_cache = None
+
+
+def setResponseCache(cache):
+	'''
+		Set (or with None, remove) the ResponseCache used underneath apiCall.
+
+			:param cache: The ResponseCache to use.
+	'''
+	global response_cache
+	response_cache = cache
+
+
+# Where apiCall sends requests.  Pointed elsewhere (e.g. at apistandin's local server) with setApiEndpoint.
+api_host = "api.guildwars2.com"
+api_protocol = "https"
+
+
+def setApiEndpoint(host="api.guildwars2.com", protocol="https"):
+	'''
+		Point apiCall at a different server (e.g. a local stand-in for testing.)  Called with no
+		arguments, points it back at the real API.
+
+			:param host: The host (and optionally :port) to send requests to.
+			:param protocol: "https" or "http"
+	'''
+	global api_host, api_protocol
+	api_host = host
+	api_protocol = protocol
+
+
+def _backoffDelay(retries, base_delay=0.5, max_delay=30):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Exponential backoff with full jitter, so threads retrying together spread back out.
+
+			:param retries: How many retries have been made so far.
+			:param base_delay: The delay ceiling for the first retry, in seconds.
+			:param max_delay: The largest delay ceiling, in seconds.
+	'''
+	return random.uniform(0, min(max_delay, base_delay * (2 ** retries)))
+
+
+def _checkRawBody(body):
+	'''
+		NOTE: INTERNAL FUNCTION
+		A cheap check that a response body left undecoded is a whole JSON array or object, so a truncated
+		one is retried like any other unparseable response rather than failing later in the parser.
+		Raises ValueError if not.
+
+			:param body: The response body, as bytes.
+	'''
+	body = body.strip()
+	if not body or (body[:1], body[-1:]) not in ((b'[', b']'), (b'{', b'}')):
+		raise ValueError("Incomplete JSON body (" + str(len(body)) + " bytes)")
+	return body
+
+
+def _parseRetryAfter(retry_after):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Turn a Retry-After header (either seconds or an http date) into seconds from now.
+		Returns None if there was no usable header.
+
+			:param retry_after: The header value.
+	'''
+	if not retry_after:
+		return None
+
+	try:
+		return max(0, float(retry_after))
+	except ValueError:
+		pass
+
+	try:
+		retry_at = email.utils.parsedate_to_datetime(retry_after)
+	except (TypeError, ValueError):
+		return None
+
+	return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# How long the last request made by apiCall on this thread spent on the wire (not waiting for rate_limiter.)
+_request_timing = threading.local()
+
+
+def apiCall(resource, raw=False):
+	'''
+		Core API call to the api.guildwars2.com api (or wherever setApiEndpoint says). Simply makes an http
 		request and returns the un-jsonified response.
+		Connections are kept alive and shared between calls (and threads) via connection_pool.
+		Every request waits its turn on rate_limiter, and none are made while circuit_breaker is open.
+		If a response_cache is set, fresh cached responses are served without a request, and stale
+		ones are revalidated.
 
 			:param resource: the path (e.g. /v2/items) to query for.
+			:param raw: If true, return the response body as bytes, leaving the json to be decoded elsewhere.
 	'''
-	found_resource = False #To deal with redirects
-	parsed_response = False #To deal with invalid responses.
-
 	retries = 0 # How many retries have we gone through thus far.
 	retry_threshold = 5 # For transient errors
-	retry_delay = 1 # Seconds
 
-	url = "api.guildwars2.com"
-	protocol = "https"
+	url = api_host
+	protocol = api_protocol
+
+	cache = response_cache
+	cache_key = protocol + "://" + url + resource
+	cached_response = None
+	if cache:
+		cached_response = cache.get(cache_key)
+		if cached_response and cached_response.isFresh():
+			if raw:
+				cache.record("hits")
+				return cached_response.body
+			try:
+				data = json.loads(cached_response.body.decode())
+				cache.record("hits")
+				return data
+			except ValueError:
+				cached_response = None
+
+	headers = {}
+	if cached_response:
+		if cached_response.etag:
+			headers['If-None-Match'] = cached_response.etag
+		if cached_response.last_modified:
+			headers['If-Modified-Since'] = cached_response.last_modified
+
+	while True:
+		if not circuit_breaker.allowRequest():
+			raise CircuitOpenError("API call skipped, circuit breaker is open: " + str(resource))
+
+		rate_limiter.acquire()
 
-	while not found_resource and not parsed_response:
 		logger.debug("Getting: " + str(protocol) + str(url) + str(resource))
 
-		if protocol == "https":
-			connection = httplib.HTTPSConnection(url)
-		else:
-			connection = httplib.HTTPConnection(url)
+		connection = connection_pool.getConnection(protocol, url)
+		reused_connection = connection.sock is not None
 
-		connection.request("GET", resource)
-
-		response = connection.getresponse()
-
-		if response.status >= 500 and retries < retry_threshold:
-			logger.error("Retrying due to potentially transient API failure: " + response.reason + " ; " + str(response.status))
-			retries += 1
-			time.sleep(retry_delay)
-			continue
+		try:
+			request_started = time.monotonic()
+			connection.request("GET", resource, headers=headers)
+			response = connection.getresponse()
+			response_body = response.read()
+			_request_timing.elapsed = time.monotonic() - request_started
+		except ConnectionPool.connection_errors as e:
+			connection_pool.discardConnection(connection)
+			# A kept-alive socket can die between calls without us knowing; that isn't the API's fault.
+			if reused_connection:
+				logger.debug("Pooled connection went away, reconnecting: " + str(e))
+				continue
+
+			circuit_breaker.recordFailure()
+			if retries < retry_threshold:
+				logger.error("Retrying due to connection failure: " + str(e))
+				time.sleep(_backoffDelay(retries))
+				retries += 1
+				continue
+			raise ApiError("API call failed: " + str(e))
+		except Exception:
+			# Anything else (e.g. DNS failures) still has to count, or a half open breaker never hears back.
+			connection_pool.discardConnection(connection)
+			circuit_breaker.recordFailure()
+			raise
+
+		if response.will_close:
+			connection_pool.discardConnection(connection)
+		else:
+			connection_pool.releaseConnection(protocol, url, connection)
+
+		if response.status == 429 or response.status >= 500:
+			circuit_breaker.recordFailure()
+			if retries < retry_threshold:
+				logger.error("Retrying due to potentially transient API failure: " + response.reason + " ; " + str(response.status))
+				delay = _parseRetryAfter(response.getheader('retry-after'))
+				if delay is None:
+					delay = _backoffDelay(retries)
+				if response.status == 429:
+					# Being throttled applies to everyone in the process, not just this call.
+					rate_limiter.pauseFor(delay)
+				time.sleep(delay)
+				retries += 1
+				continue
+			logger.error("API call failed: " + response.reason + " ; " + str(response.status))
+			raise ApiError("API call failed: " + response.reason + " ; " + str(response.status), response.status)
 		elif response.status >= 400:
-			connection.close()
+			circuit_breaker.recordSuccess()
 			logger.error("API call failed: " + response.reason + " ; " + str(response.status))
-			raise Exception("API call failed: " + response.reason + " ; " + str(response.status))
+			raise ApiError("API call failed: " + response.reason + " ; " + str(response.status), response.status)
 		elif response.status == 302:
 			parsed_url = urlparse(response.getheader('location'))
 			url = parsed_url.netloc
@@ -68,64 +788,392 @@ def apiCall(resource):
 			protocol = parsed_url.scheme
 			logger.debug("Redirecting to: " + str(protocol) + str(url) + str(resource))
 			continue
+		elif response.status == 304 and cached_response:
+			logger.debug("Cached response still valid.")
+			circuit_breaker.recordSuccess()
+			cached_response.refresh(response)
+			if cached_response.expires is None:
+				# The API no longer wants this stored.
+				cache.remove(cache_key)
+			else:
+				cache.put(cache_key, cached_response)
+			cache.record("revalidations")
+			if raw:
+				return cached_response.body
+			return json.loads(cached_response.body.decode())
 		elif 200 <= response.status < 300 :
 			logger.debug("Got response.")
-			found_resource = True
 		else:
 			logger.error("Unspecified response: " + str(response.status))
 
 
-		response_body = response.read()
 		try:
-			data = json.loads(response_body.decode())
-			parsed_response = True
+			data = _checkRawBody(response_body) if raw else json.loads(response_body.decode())
 		except Exception as e: #Known to be value error; but that came out of nowhere, so being a bit generous here.
 			logger.error("Json parsing failure for " + str(resource) + " : " + str(e))
-			parsed_response = False
+			circuit_breaker.recordFailure()
+			if retries < retry_threshold:
+				time.sleep(_backoffDelay(retries))
+				retries += 1
+				continue
+			raise ApiError("API call failed: unparseable response for " + str(resource), response.status)
 
+		circuit_breaker.recordSuccess()
+		if cache and 200 <= response.status < 300:
+			cache.record("misses")
+			expires = _cacheExpiry(response)
+			if expires is not None:
+				cache.put(cache_key, CachedResponse(response_body, expires, response.getheader('etag'), response.getheader('last-modified')))
+		return data
 
-	connection.close()
 
-	return data
 
+BATCH_SIZE = 200 #Can get pushed higher, but it gets iffy.  Now just where BatchSizer starts out.
 
 
-def _idListApiCall(resource, id_list):
+class BatchSizer:
+	'''
+		Learns, per resource, the number of ids per request that gets the most ids per second
+		out of the API.  Every id batch request reports back how long it took and whether it failed;
+		the sizer keeps a moving average of latency and error rate for each batch size it has tried,
+		and hill climbs towards the best one.  Requests the API rejects as too large teach it the
+		server's limit (narrowed down by bisection), and what it has learned is saved to state_file.
+		What's learned is kept per endpoint (see setApiEndpoint) as well as per resource, since another
+		server's limits say nothing about the real API's.
+	'''
+	default_state_file = os.path.join(os.path.expanduser("~"), ".gw2cerebro_batch_sizes.json")
+
+	def __init__(self, initial_size=BATCH_SIZE, min_size=10, max_size=1000, step=25, state_file=default_state_file):
+		'''
+			Initialize a new sizer, picking up what a previous run learned if state_file exists.
+
+				:param initial_size: The batch size to start from for resources we know nothing about.
+				:param min_size: Never go below this many ids per request.
+				:param max_size: Never try more than this many ids per request.
+				:param step: How far to move the batch size when exploring.
+				:param state_file: Where learned sizes are saved. None to not persist them.
+		'''
+		self.initial_size = initial_size
+		self.min_size = min_size
+		self.max_size = max_size
+		self.step = step
+		self.state_file = state_file
+
+		self.samples_per_adjustment = 8 # Samples at the current size between adjustments.
+		self.min_samples = 4 # Samples before a size's stats are trusted.
+		self.smoothing = 0.2 # Weight of each new sample in the moving averages.
+		self.save_interval = 60 # Seconds between saves.
+
+		self._resources = {} # endpoint and resource (e.g. https://api.guildwars2.com/v2/items?ids=):state dict, see _getState.
+		self._last_save = 0
+		self._lock = threading.Lock()
+
+		self.load()
+
+
+	def _getState(self, resource, endpoint=None):
+		'''
+			NOTE: INTERNAL FUNCTION
+			The learned state for a resource on the current endpoint, created on first use.
+
+				:param resource: the path (e.g. /v2/items?ids=) being queried.
+				:param endpoint: The endpoint's state key prefix (e.g. https://api.guildwars2.com); the current one if None.
+		'''
+		if endpoint is None:
+			endpoint = api_protocol + "://" + api_host
+		key = endpoint + resource
+		if key not in self._resources:
+			self._resources[key] = {
+				"batch_size":self.initial_size,
+				"max_accepted":0, # Largest size the server has taken.
+				"limit":self.max_size, # Largest size the server might take.
+				"since_adjustment":0,
+				"probing":False, # Whether a request above max_accepted is out.
+				"sizes":{}, # size:{latency, error_rate, samples}
+			}
+		return self._resources[key]
+
+
+	def getBatchSize(self, resource, remaining=None):
+		'''
+			The number of ids the next request to resource should carry.  If what would be left over
+			after it is less than a full batch, the remainder is spread over the last two batches
+			rather than sent alone.
+
+				:param resource: the path (e.g. /v2/items?ids=) being queried.
+				:param remaining: How many ids are left to send, if known.
+		'''
+		with self._lock:
+			state = self._getState(resource)
+			batch_size = state["batch_size"]
+			if remaining is not None:
+				if batch_size < remaining < 2 * batch_size:
+					batch_size = (remaining + 1) // 2
+				batch_size = min(batch_size, remaining)
+
+			# Only one request at a time gets to find out if a size larger than any accepted so far is too large.
+			if batch_size > state["max_accepted"] > 0:
+				if state["probing"]:
+					return state["max_accepted"]
+				state["probing"] = True
+
+			return batch_size
+
+
+	def recordBatch(self, resource, size, elapsed, failed=False):
+		'''
+			Report how a batch request went.
+
+				:param resource: the path (e.g. /v2/items?ids=) that was queried.
+				:param size: How many ids the request carried.
+				:param elapsed: How long it took, in seconds.
+				:param failed: True if it failed (for reasons other than being too large.)
+		'''
+		with self._lock:
+			state = self._getState(resource)
+			if size > state["max_accepted"]:
+				state["probing"] = False
+
+			if not failed and size > state["max_accepted"]:
+				state["max_accepted"] = size
+				state["limit"] = max(state["limit"], size)
+
+			# Odd sized batches (tails of lists, halves of rejected batches) only teach us the limit.
+			if size == state["batch_size"]:
+				stats = state["sizes"].setdefault(str(size), {"latency":elapsed, "error_rate":0.0, "samples":0})
+				stats["samples"] += 1
+				stats["latency"] += self.smoothing * (elapsed - stats["latency"])
+				stats["error_rate"] += self.smoothing * ((1.0 if failed else 0.0) - stats["error_rate"])
+
+				state["since_adjustment"] += 1
+				if state["since_adjustment"] >= self.samples_per_adjustment:
+					self._adjust(resource, state)
+
+		self._maybeSave()
+
+
+	def recordRejected(self, resource, size):
+		'''
+			Report that the API refused a batch for being too large.
+
+				:param resource: the path (e.g. /v2/items?ids=) that was queried.
+				:param size: How many ids the rejected request carried.
+		'''
+		with self._lock:
+			state = self._getState(resource)
+			state["probing"] = False
+			state["limit"] = max(min(state["limit"], size - 1), state["max_accepted"], self.min_size)
+			state["sizes"].pop(str(size), None)
+
+			if state["batch_size"] > state["limit"]:
+				logger.debug("Batch size " + str(state["batch_size"]) + " too large for " + resource + ", limit is now " + str(state["limit"]))
+				state["batch_size"] = max(state["max_accepted"], min(state["limit"], self.initial_size), self.min_size)
+				state["since_adjustment"] = 0
+
+		self._maybeSave()
+
+
+	def _throughput(self, stats):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Expected ids per second at a batch size, given its stats.
+		'''
+		return (1 - stats["error_rate"]) / max(stats["latency"], 1e-6)
+
+
+	def _adjust(self, resource, state):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Move the batch size towards whichever neighbouring size looks best, trying out sizes
+			we don't have enough samples for yet once we're the best we know of.  Sizes above the
+			largest the server has accepted are bisected towards the known limit, rather than stepped into.
+		'''
+		state["since_adjustment"] = 0
+		current = state["batch_size"]
+
+		larger = min(current + self.step, state["limit"])
+		if larger > state["max_accepted"]:
+			larger = (state["max_accepted"] + state["limit"] + 1) // 2
+		smaller = max(current - self.step, self.min_size)
+
+		def throughput(size):
+			stats = state["sizes"].get(str(size))
+			if not stats or stats["samples"] < self.min_samples:
+				return None
+			return self._throughput(stats) * size
+
+		# Move to a better neighbour if we know of one; if we're the best we know of, check an unexplored one.
+		best_size, best_throughput = current, throughput(current)
+		unexplored = []
+		for size in sorted({smaller, larger} - {current}, reverse=True):
+			size_throughput = throughput(size)
+			if size_throughput is None:
+				unexplored.append(size)
+			elif best_throughput is None or size_throughput > best_throughput:
+				best_size, best_throughput = size, size_throughput
+
+		if best_size == current and unexplored:
+			best_size = unexplored[0]
+
+		if best_size != current:
+			logger.debug("Batch size for " + resource + " moving from " + str(current) + " to " + str(best_size))
+		state["batch_size"] = best_size
+
+
+	def probeLimit(self, resource, ids):
+		'''
+			Find the largest batch the API will accept for resource by binary search, making real
+			requests.  The result is remembered as the limit for that resource.
+
+				:param resource: the path (e.g. /v2/items?ids=) to probe.
+				:param ids: Valid ids to fill the probe requests with. (at least max_size of them, ideally)
+		'''
+		low, high = self.min_size, min(self.max_size, len(ids))
+		while low < high:
+			size = (low + high + 1) // 2
+			logger.debug("Trying batch size: " + str(size))
+			try:
+				apiCall(resource + ','.join(str(each_id) for each_id in ids[:size]))
+				low = size
+			except ApiError as e:
+				if e.status != 400:
+					raise
+				high = size - 1
+
+		with self._lock:
+			state = self._getState(resource)
+			state["max_accepted"] = low
+			state["limit"] = low
+			state["batch_size"] = low
+			state["since_adjustment"] = 0
+
+		self.save()
+		return low
+
+
+	def load(self):
+		'''
+			Load learned state from state_file, if there is one.
+		'''
+		if not self.state_file or not os.path.exists(self.state_file):
+			return
+
+		try:
+			with open(self.state_file) as f:
+				resources = json.load(f)
+		except (OSError, ValueError) as e:
+			logger.error("Ignoring unreadable batch size state " + str(self.state_file) + " : " + str(e))
+			return
+
+		with self._lock:
+			for key, state in resources.items():
+				if "://" not in key:
+					# Saved before state was kept per endpoint; it may have come from a stand-in, so relearn it.
+					continue
+				new_state = self._getState(key, endpoint="")
+				new_state.update(state)
+				new_state["probing"] = False
+				new_state["batch_size"] = max(self.min_size, min(new_state["batch_size"], new_state["limit"], self.max_size))
+
+
+	def save(self):
+		'''
+			Save learned state to state_file.
+		'''
+		if not self.state_file:
+			return
+
+		with self._lock:
+			data = json.dumps(self._resources)
+			self._last_save = time.monotonic()
+
+		try:
+			with open(self.state_file + ".tmp", 'w') as f:
+				f.write(data)
+			os.replace(self.state_file + ".tmp", self.state_file)
+		except OSError as e:
+			logger.error("Failed to save batch size state " + str(self.state_file) + " : " + str(e))
+
+
+	def _maybeSave(self):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Save, if it's been a while.
+		'''
+		if self.state_file and time.monotonic() - self._last_save >= self.save_interval:
+			self.save()
+
+
+batch_sizer = BatchSizer()
+# Only the process the user started saves; parse workers (see setParseProcesses) import util too.
+if multiprocessing.current_process().name == 'MainProcess':
+	atexit.register(batch_sizer.save)
+
+
+def _idListApiCall(resource, id_list, raw=False):
 	'''
 		NOTE: INTERNAL FUNCTION
 		Makes a call to the API appending a list of stringified values comma seperated.
+		Reports how it went to batch_sizer; a batch the API rejects as too large is split in two and retried.
 
 			:param resource: the path (e.g. /v2/items?ids=) to query for.
 			:param id_list: The list of ids to query for. 
+			:param raw: If true, return a list of the undecoded response bodies (more than one if the batch was split.)
 	'''
 	# Convert the listing IDs to a query string and request it
 	api_response = []
-	id_list_string = ""
 	if len(id_list) > 0:
-		for each_id in id_list:
-			id_list_string += str(each_id) + ','
+		api_string = resource + ','.join(str(each_id) for each_id in id_list)
 
-		id_list_string = id_list_string[:-1]
-
-		api_string = resource + id_list_string
-		api_response = apiCall(api_string)
+		sizer = batch_sizer
+		started = time.monotonic()
+		_request_timing.elapsed = None
+		try:
+			api_response = apiCall(api_string, raw)
+			if raw:
+				api_response = [api_response]
+		except ApiError as e:
+			if e.status == 400 and len(id_list) > 1:
+				sizer.recordRejected(resource, len(id_list))
+				half = len(id_list) // 2
+				return _idListApiCall(resource, id_list[:half], raw) + _idListApiCall(resource, id_list[half:], raw)
+
+			sizer.recordBatch(resource, len(id_list), time.monotonic() - started, failed=True)
+			raise
+		except Exception:
+			sizer.recordBatch(resource, len(id_list), time.monotonic() - started, failed=True)
+			raise
+
+		# Time spent queued behind the rate limiter says nothing about the batch size, so leave it out.
+		elapsed = _request_timing.elapsed
+		if elapsed is None:
+			elapsed = time.monotonic() - started
+		sizer.recordBatch(resource, len(id_list), elapsed)
 
 	return api_response
 
 
+def _nextBatch(resource, parsed_id_list, position):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Cut the next batch of ids starting at position, sized by batch_sizer.
 
-def idListApiCall_out(resource, id_list, out_list = []):
+			:param resource: the path (e.g. /v2/items?ids=) being queried.
+			:param parsed_id_list: The full list of ids.
+			:param position: Where the next batch starts.
 	'''
-		Given an int/stringified int (or list of the above), returns a dir
-		of the listings corrosponding to those IDs
-		
-			:param resource: the path (e.g. /v2/items?ids=) to query for.
-			:param id_list: An int/stringified int (or list) of the item listings desired.
-			:param out_list: Simply pass a [] in, it will be populated with the results.
+	batch_size = batch_sizer.getBatchSize(resource, len(parsed_id_list) - position)
+	return parsed_id_list[position : position + batch_size]
+
+
+def _parseIdList(id_list):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Does nastiness to allow many sorts of valid id_list types.
+		e.g. int, stringified int, list of ints and list of stringified ints.
+
+			:param id_list: An int/stringified int (or list) of ids.
 	'''
-	BATCH_SIZE = 200 #Can get pushed higher, but it gets iffy.
-	# Does nastiness to allow many sorts of valid id_list types.
-	# e.g. int, stringified int, list of ints and list of stringified ints.
 	each_id = None
 	parsed_id_list = []
 	try:
@@ -138,19 +1186,292 @@ def idListApiCall_out(resource, id_list, out_list = []):
 			int(each_id)
 			parsed_id_list.append(each_id)
 
+	return parsed_id_list
 
-	while len(parsed_id_list) != 0:
-		id_list_batch = parsed_id_list[:BATCH_SIZE]
+
+def idListApiCall_out(resource, id_list, out_list = None):
+	'''
+		Given an int/stringified int (or list of the above), returns a dir
+		of the listings corrosponding to those IDs
+		
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the item listings desired.
+			:param out_list: Optionally pass a [] in, it will be populated with the results.
+	'''
+	if out_list is None:
+		out_list = []
+
+	parsed_id_list = _parseIdList(id_list)
+
+	position = 0
+	while position < len(parsed_id_list):
+		id_list_batch = _nextBatch(resource, parsed_id_list, position)
 
 		out_list += _idListApiCall(resource, id_list_batch)
 
-		parsed_id_list = parsed_id_list[BATCH_SIZE:]
+		position += len(id_list_batch)
+
+	return out_list
+
+
+#Global limit on how many requests may be in flight at once, shared by every event loop and thread.
+fetch_concurrency = 10
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+
+def setFetchConcurrency(max_concurrent_requests):
+	'''
+		Set the global limit on how many API requests may be in flight at once.
+		Applies to every caller of the async fetch engine (and thus the synchronous wrappers over it).
+
+			:param max_concurrent_requests: The maximum number of concurrent requests.
+	'''
+	global fetch_concurrency, _fetch_executor
+
+	with _fetch_executor_lock:
+		fetch_concurrency = max(1, int(max_concurrent_requests))
+		old_executor = _fetch_executor
+		_fetch_executor = None
+
+	if old_executor:
+		old_executor.shutdown(wait=False)
+
+
+def _getFetchExecutor():
+	'''
+		NOTE: INTERNAL FUNCTION
+		The worker pool the blocking requests made by the async fetch engine run on.
+		Its size is the global concurrency limit.
+	'''
+	global _fetch_executor
+
+	with _fetch_executor_lock:
+		if _fetch_executor is None:
+			_fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=fetch_concurrency, thread_name_prefix="cerebro-fetch")
+		return _fetch_executor
+
+
+async def asyncApiCall(resource):
+	'''
+		Awaitable version of apiCall.  The request itself runs on the shared fetch workers,
+		so any number of coroutines can await this without exceeding the global concurrency limit.
+
+			:param resource: the path (e.g. /v2/items) to query for.
+	'''
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(_getFetchExecutor(), apiCall, resource)
+
+
+async def _asyncIdListApiCall(resource, id_list):
+	'''
+		NOTE: INTERNAL FUNCTION
+		Awaitable version of _idListApiCall, for a single batch of ids.
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: The list of ids to query for.
+	'''
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(_getFetchExecutor(), _idListApiCall, resource, id_list)
+
+
+async def asyncIdListApiCall(resource, id_list):
+	'''
+		Awaitable version of idListApiCall.  Fetches batches of ids (sized by batch_sizer) from a shared
+		work queue, concurrently, subject to the global concurrency limit (see setFetchConcurrency.)
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the item listings desired.
+	'''
+	parsed_id_list = _parseIdList(id_list)
+
+	responses = [] # (position, response)
+	position = 0
+
+	async def fetchBatches():
+		nonlocal position
+		while position < len(parsed_id_list):
+			batch_position = position
+			batch = _nextBatch(resource, parsed_id_list, position)
+			position += len(batch)
+			responses.append((batch_position, await _asyncIdListApiCall(resource, batch)))
+
+	await asyncio.gather(*[fetchBatches() for i in range(fetch_concurrency)])
+
+	out_list = []
+	for batch_position, response in sorted(responses, key=lambda response: response[0]):
+		out_list += response
+
+	return out_list
+
+
+#Worker processes that batch responses of large fetches are decoded and parsed on (see setParseProcesses.)
+parse_processes = 0
+#Fetches of fewer ids than this are parsed in process; shipping them to a worker isn't worth it.
+parse_min_ids = 1000
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+
+def setParseProcesses(process_count=None):
+	'''
+		Decode and parse the responses of large fetches (e.g. getAllItems, getAllListings) on a pool of
+		worker processes, instead of under the GIL on the fetching threads, so full builds scale with cores.
+		Workers are spawned, so (as with any spawned multiprocessing) a script using this has to keep its
+		top level code under if __name__ == '__main__':
+
+			:param process_count: The number of worker processes; None for one per core, 0 to parse in process again.
+	'''
+	global parse_processes, _parse_executor
+
+	if process_count is None:
+		process_count = os.cpu_count() or 1
+
+	with _parse_executor_lock:
+		parse_processes = max(0, int(process_count))
+		old_executor = _parse_executor
+		_parse_executor = None
+
+	if old_executor:
+		old_executor.shutdown(wait=False)
+
+
+def _initParseWorker():
+	'''
+		NOTE: INTERNAL FUNCTION
+		Runs in each parse worker process as it starts: workers never fetch, so they must never write
+		the batch size state file over what the main process has learned.
+	'''
+	batch_sizer.state_file = None
+	atexit.unregister(batch_sizer.save)
+
+
+def _getParseExecutor():
+	'''
+		NOTE: INTERNAL FUNCTION
+		The worker process pool responses are parsed on, or None if parsing happens in process.
+	'''
+	global _parse_executor
+
+	with _parse_executor_lock:
+		if _parse_executor is None and parse_processes:
+			# Spawned rather than forked: forking a process with fetch threads running (and their locks held) can deadlock.
+			_parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes, \
+				mp_context=multiprocessing.get_context('spawn'), initializer=_initParseWorker)
+		return _parse_executor
+
+
+async def asyncParsedIdListApiCall(resource, id_list, parser):
+	'''
+		Like asyncIdListApiCall, but each batch's response body is handed undecoded to parser on the parse
+		worker processes (see setParseProcesses), and what parser returns is collected instead.  Fetching
+		carries on while earlier batches are parsed.  Results come back in batch order.
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the ids desired.
+			:param parser: A picklable (i.e. module level) callable taking a response body as bytes and
+				returning a list, e.g. of parsed objects.
+	'''
+	parsed_id_list = _parseIdList(id_list)
+	loop = asyncio.get_running_loop()
+	parse_executor = _getParseExecutor()
+
+	parsing = [] # (position, batch, [future of parser's result for each body])
+	position = 0
+
+	async def fetchBatches():
+		nonlocal position
+		while position < len(parsed_id_list):
+			batch_position = position
+			batch = _nextBatch(resource, parsed_id_list, position)
+			position += len(batch)
+			bodies = await loop.run_in_executor(_getFetchExecutor(), _idListApiCall, resource, batch, True)
+			if parse_executor is None:
+				parsing.append((batch_position, batch, [loop.run_in_executor(_getFetchExecutor(), parser, body) for body in bodies]))
+			else:
+				parsing.append((batch_position, batch, [loop.run_in_executor(parse_executor, parser, body) for body in bodies]))
+
+	await asyncio.gather(*[fetchBatches() for i in range(fetch_concurrency)])
+
+	out_list = []
+	for batch_position, batch, futures in sorted(parsing, key=lambda batch: batch[0]):
+		try:
+			batch_results = []
+			for future in futures:
+				batch_results += await future
+		except ValueError as e:
+			# Well formed enough to pass _checkRawBody, but not valid JSON.  Fetch the batch again decoded,
+			# which retries bad bodies in apiCall (and won't trust a bad cached one), and parse it here.
+			logger.error("Unparseable response for " + str(resource) + ", fetching the batch again: " + str(e))
+			responses = await loop.run_in_executor(_getFetchExecutor(), _idListApiCall, resource, batch)
+			try:
+				batch_results = parser(json.dumps(responses).encode())
+			except ValueError as e:
+				raise ApiError("API call failed: unparseable response for " + str(resource) + " : " + str(e))
+		out_list += batch_results
 
 	return out_list
 
 
+def runSync(coroutine):
+	'''
+		Run a coroutine to completion from synchronous code and return its result.
+		Safe to call from a thread that already has a running event loop; the coroutine
+		then gets its own loop on a helper thread.
+
+			:param coroutine: The coroutine to run.
+	'''
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		return asyncio.run(coroutine)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=1) as helper:
+		return helper.submit(asyncio.run, coroutine).result()
+
+
+def iterIdListApiCall(resource, id_list, window=None):
+	'''
+		Generator version of idListApiCall.  Yields the response for each batch of ids as soon as
+		it arrives (not necessarily in order), with at most window batches fetched or in flight
+		at a time, so memory use doesn't grow with the length of id_list.
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the item listings desired.
+			:param window: How many batches to have outstanding at once; defaults to the fetch concurrency.
+	'''
+	parsed_id_list = _parseIdList(id_list)
+	executor = _getFetchExecutor()
+
+	def batchGenerator():
+		position = 0
+		while position < len(parsed_id_list):
+			batch = _nextBatch(resource, parsed_id_list, position)
+			position += len(batch)
+			yield batch
+
+	batches = batchGenerator()
+
+	pending = set()
+	for batch in itertools.islice(batches, window or fetch_concurrency):
+		pending.add(executor.submit(_idListApiCall, resource, batch))
+
+	try:
+		while pending:
+			done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				batch = next(batches, None)
+				if batch:
+					pending.add(executor.submit(_idListApiCall, resource, batch))
+
+				yield future.result()
+	finally:
+		# If the consumer stops early, don't keep fetching for nobody.
+		for future in pending:
+			future.cancel()
+
+
 #Builds an index of ALL listings.  Be ready for a bit of a wait.
-#TODO: Maybe try multiprocessing it? the overhead of starting the other interpreters probably isn't worth it.
 def idListApiCall(resource, id_list, threaded=True, cache_timeout=0):
 	'''
 		Given an int/stringified int (or list of the above), returns a dir
@@ -158,30 +1479,165 @@ def idListApiCall(resource, id_list, threaded=True, cache_timeout=0):
 
 			:param resource: the path (e.g. /v2/items?ids=) to query for.
 			:param id_list: An int/stringified int (or list) of the item listings desired.
+			:param threaded: If true, fetch batches concurrently via the async fetch engine, else one at a time.
 	'''
-	out_list = []
-
 	if threaded:
-		#Yes I know it can actually start THREADPOOL_SIZE+1 threads, hush.
-		THREADPOOL_SIZE=10
-		threadpool = []
-		ids_per_thread = math.ceil(len(id_list) / THREADPOOL_SIZE)
-		for i in range(0, len(id_list), ids_per_thread):
-			thread = threading.Thread( target=idListApiCall_out, kwargs={"resource":resource, "id_list":id_list[i : math.ceil( i + len(id_list) / THREADPOOL_SIZE )], "out_list":out_list} )
-			thread.start()
-			threadpool.append(thread)
-		
+		return runSync(asyncIdListApiCall(resource, id_list))
 
-		for thread in threadpool:
-			thread.join()
-	
-	else:
-		out_list = idListApiCall_out(resource, id_list)
+	return idListApiCall_out(resource, id_list)
 
-	return out_list
 
 
 
+class SingleFlight:
+	'''
+		Coalesces concurrent id list requests.  Ids already being fetched are joined rather than
+		requested again, and ids asked for by different callers within the same short window are
+		merged into one shared set of batched requests.  Every caller gets its results when the
+		fetch carrying its ids completes.  If a merged fetch fails, each caller's ids are retried on
+		their own, so one caller's bad ids don't fail everyone else's request.
+	'''
+	def __init__(self, window=0.005):
+		'''
+			Initialize a new coalescer.
+
+				:param window: Seconds to wait for other callers' ids before sending a new fetch.
+		'''
+		self.window = window
+
+		self._in_flight = {} # (resource, id):future of {id:response}
+		self._pending = {} # resource:[(future, [ids]) for each caller] for the fetch that hasn't been sent yet.
+		self._lock = threading.Lock()
+
+
+	def fetch(self, resource, id_list):
+		'''
+			Request ids, joining fetches already underway where possible.  Returns {id:future}, where each
+			future resolves to a {id:response} dict covering (at least) that id.  Ids the API has nothing
+			for are simply missing from it.
+
+				:param resource: the path (e.g. /v2/items?ids=) to query for.
+				:param id_list: The list of ids to query for.
+		'''
+		futures = {}
+		with self._lock:
+			own_future, own_ids = concurrent.futures.Future(), []
+			for each_id in id_list:
+				each_id = int(each_id)
+				if each_id in futures:
+					continue
+
+				future = self._in_flight.get((resource, each_id))
+				if not future:
+					future = own_future
+					own_ids.append(each_id)
+					self._in_flight[(resource, each_id)] = future
+
+				futures[each_id] = future
+
+			if own_ids:
+				if resource not in self._pending:
+					self._pending[resource] = []
+					timer = threading.Timer(self.window, self._send, (resource,))
+					timer.daemon = True
+					timer.start()
+				self._pending[resource].append((own_future, own_ids))
+
+		return futures
+
+
+	def _send(self, resource):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Send the pending fetch for a resource, then hand everyone waiting on it the results.
+		'''
+		with self._lock:
+			callers = self._pending.pop(resource)
+
+		pending_ids = [each_id for future, ids in callers for each_id in ids]
+		try:
+			responses = self._fetch(resource, pending_ids)
+		except Exception as e:
+			if len(callers) == 1:
+				self._land(resource, pending_ids)
+				callers[0][0].set_exception(e)
+				return
+
+			logger.debug("Merged fetch of " + str(len(pending_ids)) + " ids from " + resource + " failed, retrying each caller's ids alone: " + str(e))
+			for future, ids in callers:
+				try:
+					caller_responses = self._fetch(resource, ids)
+				except Exception as e:
+					self._land(resource, ids)
+					future.set_exception(e)
+				else:
+					self._land(resource, ids)
+					future.set_result(caller_responses)
+			return
+
+		self._land(resource, pending_ids)
+		for future, ids in callers:
+			future.set_result(responses)
+
+
+	def _fetch(self, resource, id_list):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Fetch ids on the shared fetch workers, returning {id:response}.
+		'''
+		responses = {}
+		for batch_responses in iterIdListApiCall(resource, id_list):
+			responses.update((response["id"], response) for response in batch_responses if isinstance(response, dict) and "id" in response)
+		return responses
+
+
+	def _land(self, resource, ids):
+		'''
+			NOTE: INTERNAL FUNCTION
+			Stop treating ids as in flight, so later callers get fresh data.
+		'''
+		with self._lock:
+			for each_id in ids:
+				self._in_flight.pop((resource, each_id), None)
+
+
+single_flight = SingleFlight()
+
+
+def coalescedIdListApiCall(resource, id_list):
+	'''
+		Like idListApiCall, but shares requests with any other callers after the same ids at the same
+		time (see SingleFlight.)  Results come back in the order of id_list.
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the item listings desired.
+	'''
+	parsed_id_list = _parseIdList(id_list)
+	futures = single_flight.fetch(resource, parsed_id_list)
+
+	responses = {}
+	for future in set(futures.values()):
+		responses.update(future.result())
+
+	return [responses[int(each_id)] for each_id in parsed_id_list if int(each_id) in responses]
+
+
+async def asyncCoalescedIdListApiCall(resource, id_list):
+	'''
+		Awaitable version of coalescedIdListApiCall.
+
+			:param resource: the path (e.g. /v2/items?ids=) to query for.
+			:param id_list: An int/stringified int (or list) of the item listings desired.
+	'''
+	parsed_id_list = _parseIdList(id_list)
+	futures = single_flight.fetch(resource, parsed_id_list)
+
+	responses = {}
+	for result in await asyncio.gather(*[asyncio.wrap_future(future) for future in set(futures.values())]):
+		responses.update(result)
+
+	return [responses[int(each_id)] for each_id in parsed_id_list if int(each_id) in responses]
+
 
 def getAllIds(resource):
 	'''
@@ -190,6 +1646,13 @@ def getAllIds(resource):
 	return apiCall(resource)
 
 
+async def asyncGetAllIds(resource):
+	'''
+		Awaitable version of getAllIds.
+	'''
+	return await asyncApiCall(resource)
+
+
 def getSecretListings(item_api, listing_api):
 	'''
 		Get all items that have listings but no index in the public items API
@@ -237,44 +1700,11 @@ def _determineMaxRequestBatchSize():
 	'''
 		NOTE: INTERNAL FUNCTION
 		Little helper function, tells you what the API limits you to in terms of ID's in a single request,
-		does so by binary search.  At last run, the number was 200.
+		does so by binary search.  At last run, the number was 200.  batch_sizer remembers the answer.
 	'''
 	ids = getAllIds('/v2/items')
 
-	#Arbitrary start point; much higher than current limit.
-	#(But given a guess that the real number is 200+some; this should binary search the target nicely)
-	previous_batch_size = 1000
-	batch_size = 800
-	halt = False
-	while not halt:
-		tmp_batch_size = batch_size
-		try:
-			logger.debug("Trying batch size: " + str(batch_size))
-
-			_idListApiCall('/v2/items?ids=', ids[:batch_size])
-
-			if previous_batch_size < batch_size:
-				batch_size += (batch_size - previous_batch_size)
-			elif previous_batch_size > batch_size:
-				batch_size += (previous_batch_size - batch_size) / 2
-			else:
-				halt = True
-		except Exception as e:
-			logger.exception(e)
-
-			if previous_batch_size > batch_size:
-				batch_size -= (previous_batch_size - batch_size)
-			elif previous_batch_size < batch_size:
-				batch_size -= (batch_size - previous_batch_size) / 2
-			else:
-				batch_size -= 1
-
-			if batch_size <= 0:
-				halt = True
-
-		previous_batch_size = tmp_batch_size
-
-	return batch_size
+	return batch_sizer.probeLimit('/v2/items?ids=', ids)
 
 
 #TODO: variance as well?